@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+"""
+Times searching a big, uncompressed live history.log, like the ones of busy
+build hosts: scanning it for the installation line of a package
+(logscan.scan) and reading the transactions that mention the package
+(transactions.read).
+
+The log is made of the synthetic transactions of bench_suite.py, repeated
+until it reaches the wanted size; the package was installed once, near the
+beginning.
+
+Usage:
+    bench_live_log.py [--size=MB] [--repeat=N] [--output=FILE] [--keep=DIR]
+
+Options:
+    --size=MB      Size of the log, in MB [default: 200].
+    --repeat=N     Keep the best of N runs [default: 3].
+    --output=FILE  Write the results to FILE, as JSON.
+    --keep=DIR     Generate the log in DIR and keep it.
+"""
+
+import os
+import glob
+import gzip
+import json
+import shutil
+import tempfile
+
+import docopt
+
+import bench_suite
+rd = bench_suite.rd
+
+
+def make_log(directory, size):
+    '''Writes a history.log of about size bytes to directory and returns
+    its path.'''
+
+    path = os.path.join(directory, 'history.log')
+    if os.path.exists(path) and os.path.getsize(path) >= size:
+        return path
+
+    corpus = os.path.join(directory, 'corpus')
+    if not os.path.isdir(corpus):
+        os.makedirs(corpus)
+        bench_suite.make_corpus(corpus, 10000)
+    archives = sorted(glob.glob(os.path.join(corpus, 'history.log.*.gz')),
+                      key=rd.logscan.rotation, reverse=True)
+    # the oldest archive holds the installation:
+    first = gzip.open(archives[0]).read()
+    upgrades = ''.join(gzip.open(archive).read() for archive in archives[1:])
+
+    with open(path, 'w') as f:
+        f.write(first)
+        written = len(first)
+        while written < size:
+            f.write(upgrades)
+            written += len(upgrades)
+
+    return path
+
+
+def main():
+    arguments = docopt.docopt(__doc__)
+    size = int(arguments['--size']) << 20
+    repeat = int(arguments['--repeat'])
+
+    root = arguments['--keep'] or tempfile.mkdtemp(prefix='bench-live-log-')
+    try:
+        path = make_log(root, size)
+        package = bench_suite.METAPACKAGE
+        seconds = {}
+        seconds['scan'], lines = bench_suite.best_time(
+            lambda: list(rd.logscan.scan(package, path)), repeat)
+        seconds['read'], found = bench_suite.best_time(
+            lambda: list(rd.transactions.read([path], [package])), repeat)
+        assert len(found) == 1 and len(lines) == 2, (len(found), len(lines))
+    finally:
+        if not arguments['--keep']:
+            shutil.rmtree(root)
+
+    results = {'megabytes': os.path.getsize(path) >> 20 if
+               arguments['--keep'] else size >> 20,
+               'repeat': repeat, 'seconds': seconds}
+    print('%d MB: %s' % (results['megabytes'], '  '.join(
+        '%s %.3f s' % item for item in sorted(seconds.items()))))
+    if arguments['--output']:
+        with open(arguments['--output'], 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True,
+                      separators=(',', ': '))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+"""
+Measures the peak memory (RSS) of planning a removal on the synthetic
+machines of bench_suite.py: reading the history logs, building the
+dependency graph from dpkg's status file and classifying the packages.
+Every size runs in a new Python process, so peaks don't hide each other.
+
+Usage:
+    bench_memory.py [--sizes=LIST] [--output=FILE] [--keep=DIR]
+
+Options:
+    --sizes=LIST   Installed packages per machine, comma separated
+                   [default: 1000,10000,60000].
+    --output=FILE  Write the results to FILE, as JSON.
+    --keep=DIR     Generate the corpora in DIR and keep them.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+import docopt
+
+import bench_suite
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# run in a child process; prints the peak RSS in KB after importing the
+# package, then after planning:
+PLAN = '''
+import glob, resource, sys
+import remove_desktop as rd
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+directory, metapackage = sys.argv[1:]
+found = list(rd.transactions.read(glob.glob(directory + '/history*'),
+                                  [metapackage]))
+d, chosen = rd.transactions.locate(found, [metapackage])
+graph = rd.DependencyGraph.from_status(directory + '/status')
+obsolete = rd.classify(d.keys(), graph)
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def main():
+    arguments = docopt.docopt(__doc__)
+    sizes = [int(size) for size in arguments['--sizes'].split(',')]
+
+    results = {}
+    root = arguments['--keep'] or tempfile.mkdtemp(prefix='bench-memory-')
+    try:
+        for size in sizes:
+            directory = os.path.join(root, str(size))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+                bench_suite.make_corpus(directory, size)
+            output = subprocess.check_output(
+                [sys.executable, '-c', PLAN, directory,
+                 bench_suite.METAPACKAGE], cwd=ROOT)
+            imported, planned = [int(kb) for kb in output.split()]
+            results[str(size)] = {'import_kb': imported,
+                                  'peak_kb': planned,
+                                  'plan_kb': planned - imported}
+            print('%6d packages: peak %7d KB, %7d KB above import' %
+                  (size, planned, planned - imported))
+    finally:
+        if not arguments['--keep']:
+            shutil.rmtree(root)
+
+    if arguments['--output']:
+        with open(arguments['--output'], 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True,
+                      separators=(',', ': '))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+"""
+Measures how fast 'Install:' lines are parsed, in packages/second, on a
+synthetic line like the ones full dist-upgrades write to apt's history log.
+
+Usage:
+    bench_parser.py [--entries=N] [--old-entries=N] [--repeat=N]
+                    [--chunk=BYTES]
+
+Options:
+    --entries=N      Number of packages on the line [default: 100000].
+    --old-entries=N  Number of packages on the line given to the old parser,
+                     whose time grows with the square of the line length
+                     [default: 200].
+    --repeat=N       Keep the best of N runs [default: 5].
+    --chunk=BYTES    Chunk size fed to tokenize() [default: 65536].
+"""
+
+import os
+import re
+import sys
+import time
+import collections
+
+import docopt
+
+# Import remove_desktop modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import remove_desktop as rd
+
+
+def old_parser(line):
+    '''parser() as it was before the tokenizer: the regex is compiled on
+    every call and the filename is stripped with a copy of the line.'''
+
+    pattern = r'.*:Install: '
+    line = re.sub(pattern, '', line)
+
+    sequence = re.finditer(r"""
+        (?P<pkg_name>[a-zA-Z0-9._-]+ | [^:\s]+):
+        (?P<arch>i?\d{3} | amd64) [ ]
+        \( (?P<version>.*?) \),?
+        """, line, flags=re.VERBOSE)
+
+    d = collections.OrderedDict()
+    for match in sequence:
+        key = match.group('pkg_name')
+        d[key] = match.groups()[1:]
+
+    return d
+
+
+def make_line(entries):
+    '''Returns a synthetic 'Install:' line with entries packages.'''
+
+    parts = []
+    for i in range(entries):
+        if i % 3:
+            parts.append('libsynthetic%d-%d:amd64 (%d.%d-0ubuntu1, automatic)'
+                         % (i, i % 7, i % 13, i % 5))
+        else:
+            parts.append('synthetic-package%d:i386 (1:%d.0+dfsg-1)' % (i, i))
+    return '/var/log/apt/history.log.1.gz:Install: ' + ', '.join(parts)
+
+
+def best_time(fct, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        result = fct()
+        times.append(time.time() - start)
+    return min(times), result
+
+
+def main():
+    arguments = docopt.docopt(__doc__)
+    entries = int(arguments['--entries'])
+    old_entries = int(arguments['--old-entries'])
+    repeat = int(arguments['--repeat'])
+    chunk = int(arguments['--chunk'])
+
+    old_line = make_line(old_entries)
+    line = make_line(entries)
+    chunks = [line[i:i + chunk] for i in range(0, len(line), chunk)]
+    print('Install line: %s packages, %s KB' % (entries, len(line) // 1024))
+
+    cases = [('old parser(), %s packages' % old_entries, old_entries,
+              lambda: len(old_parser(old_line))),
+             ('parser()', entries, lambda: len(rd.parser(line))),
+             ('tokenize(), %s byte chunks' % chunk, entries,
+              lambda: sum(1 for entry in rd.transactions.tokenize(chunks)))]
+
+    for name, expected, fct in cases:
+        seconds, count = best_time(fct, repeat)
+        assert count == expected, (name, count)
+        print('%-32s %8.3f s %12d packages/s' %
+              (name, seconds, count / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+"""
+Times full runs of remove_desktop, `remove_desktop -t xubuntu-desktop` from
+the command line to the simulated purge, on the synthetic machines of
+bench_suite.py, without apt and without root rights.
+
+For every size, a run on the corpus is recorded with a RecordingBackend, as
+`remove_desktop --record` does, and the script is run with --replay in a new
+Python process. The recorded backend answers from the corpus' apt-cache
+output, and dpkg's status file is left out of the recording, so the replayed
+run asks apt-cache for reverse dependencies and shows its progress bar, as
+on a machine where the status file can't be read.
+
+Usage:
+    bench_replay.py [--sizes=LIST] [--repeat=N] [--output=FILE] [--keep=DIR]
+
+Options:
+    --sizes=LIST   Installed packages per machine, comma separated
+                   [default: 1000,10000,60000].
+    --repeat=N     Keep the best of N runs [default: 3].
+    --output=FILE  Write the results to FILE, as JSON.
+    --keep=DIR     Generate the corpora in DIR and keep them.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import collections
+
+import docopt
+
+import bench_suite
+rd = bench_suite.rd
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'remove_desktop', 'remove_desktop.py')
+
+
+class CorpusBackend(rd.backends.Backend):
+    '''The package system of a synthetic machine: apt-cache rdepends
+    answers from the corpus in directory, every package is installed and
+    purging is only simulated.'''
+
+    name = 'corpus'
+
+    def __init__(self, directory):
+        super(CorpusBackend, self).__init__()
+        with open(os.path.join(directory, 'rdepends')) as f:
+            self.rdeps = rd.split_rdepends(f.read())
+
+    def is_installed(self, package):
+        return True
+
+    def rdepends(self, packages):
+        return collections.OrderedDict((p, self.rdeps[p]) for p in packages
+                                       if p in self.rdeps)
+
+    def purge(self, packages, out, simulate=False):
+        for package in packages:
+            out.write('Purg %s\n' % package)
+
+
+def record(directory, path):
+    '''Records a run on the corpus in directory to path, making the calls
+    remove_desktop makes when dpkg's status file can't be read.'''
+
+    recorder = rd.backends.RecordingBackend(CorpusBackend(directory))
+    recorder.record_status(os.path.join(directory, 'no-status'))
+    found = list(rd.transactions.read(
+        glob.glob(os.path.join(directory, 'history*')),
+        [bench_suite.METAPACKAGE]))
+    d, chosen = rd.transactions.locate(found, [bench_suite.METAPACKAGE])
+
+    saved = rd.remove_desktop.backend, rd.remove_desktop.outputter
+    with open(os.devnull, 'w') as devnull:
+        rd.remove_desktop.backend = recorder
+        # the progress bar:
+        rd.remove_desktop.outputter = devnull
+        try:
+            graph = rd.remove_desktop.apt_cache_graph(d.keys())
+            obsolete = rd.classify(d.keys(), graph)
+            recorder.record_logs(found)
+            recorder.purge(obsolete, devnull, simulate=True)
+        finally:
+            rd.remove_desktop.backend, rd.remove_desktop.outputter = saved
+    recorder.save(path)
+
+
+def bench_size(directory, size, repeat):
+    '''Returns the best wall time of repeat runs on the corpus of a machine
+    with size packages and the metrics of the last run.'''
+
+    if not os.path.exists(os.path.join(directory, 'status')):
+        bench_suite.make_corpus(directory, size)
+    archive = os.path.join(directory, 'run.json.gz')
+    record(directory, archive)
+
+    run_dir = tempfile.mkdtemp(prefix='run-', dir=directory)
+    try:
+        with open(os.path.join(run_dir, 'main.conf'), 'w') as f:
+            # the files come from the archive:
+            f.write('[LOG]\nlog_level = info\n')
+        metrics_file = os.path.join(run_dir, 'metrics.json')
+        times = []
+        with open(os.devnull, 'w') as devnull:
+            for i in range(repeat):
+                # a cold run every time, the index and the cache of a
+                # replay are thrown away with it:
+                start = time.time()
+                subprocess.check_call(
+                    [sys.executable, SCRIPT, '--test', '--replay', archive,
+                     '--metrics', metrics_file, bench_suite.METAPACKAGE],
+                    stdout=devnull, stderr=devnull, cwd=run_dir)
+                times.append(time.time() - start)
+        with open(metrics_file) as f:
+            metrics = json.load(
+                f, object_pairs_hook=collections.OrderedDict)
+    finally:
+        shutil.rmtree(run_dir)
+
+    return {'packages': size, 'seconds': min(times),
+            'phases': metrics['phases']}
+
+
+def main():
+    arguments = docopt.docopt(__doc__)
+    sizes = [int(size) for size in arguments['--sizes'].split(',')]
+    repeat = int(arguments['--repeat'])
+
+    results = {}
+    root = arguments['--keep'] or tempfile.mkdtemp(prefix='bench-replay-')
+    try:
+        for size in sizes:
+            directory = os.path.join(root, str(size))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            result = results[str(size)] = bench_size(directory, size, repeat)
+            print('%6d packages: %.3f s  %s' % (size, result['seconds'],
+                  '  '.join('%s %.3f' % phase
+                            for phase in result['phases'].items())))
+    finally:
+        if not arguments['--keep']:
+            shutil.rmtree(root)
+
+    if arguments['--output']:
+        with open(arguments['--output'], 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True,
+                      separators=(',', ': '))
+
+
+if __name__ == '__main__':
+    main()
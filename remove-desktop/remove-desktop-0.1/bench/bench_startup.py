@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+"""
+Measures how long remove_desktop takes to start: `--help`, `--version`,
+importing the package and loading a config file, each in a new Python
+process, like a user or a provisioning system runs it.
+
+Usage:
+    bench_startup.py [--repeat=N] [--output=FILE]
+
+Options:
+    --repeat=N     Keep the best of N runs [default: 10].
+    --output=FILE  Write the results to FILE, as JSON.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+import docopt
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCRIPT = os.path.join(ROOT, 'remove_desktop', 'remove_desktop.py')
+
+LOAD_CONFIG = '''
+import logging
+import remove_desktop as rd
+logger = logging.getLogger('bench')
+logger.addHandler(logging.NullHandler())
+rd.utils.read_config(logger, %r, dict(rd.defaults))
+'''
+
+
+def best_time(command, repeat):
+    '''Returns the best wall time of repeat runs of command, in ms.'''
+
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeat):
+            start = time.time()
+            subprocess.call(command, stdout=devnull, stderr=devnull,
+                            cwd=ROOT)
+            times.append(time.time() - start)
+    return min(times) * 1000
+
+
+def main():
+    arguments = docopt.docopt(__doc__)
+    repeat = int(arguments['--repeat'])
+
+    tmp = tempfile.mkdtemp(prefix='bench-startup-')
+    try:
+        conf_file = os.path.join(tmp, 'main.conf')
+        with open(conf_file, 'w') as f:
+            f.write('[LOG]\nlog_level = info\npath = %s\n' % SCRIPT)
+
+        cases = [('python', [sys.executable, '-c', 'pass']),
+                 ('--help', [sys.executable, SCRIPT, '--help']),
+                 ('--version', [sys.executable, SCRIPT, '--version']),
+                 ('import', [sys.executable, '-c', 'import remove_desktop']),
+                 ('load config', [sys.executable, '-c',
+                                  LOAD_CONFIG % conf_file])]
+        results = {}
+        for name, command in cases:
+            results[name] = best_time(command, repeat)
+            print('%-12s %8.1f ms' % (name, results[name]))
+    finally:
+        shutil.rmtree(tmp)
+
+    if arguments['--output']:
+        with open(arguments['--output'], 'w') as f:
+            json.dump({'repeat': repeat, 'ms': results}, f, indent=4,
+                      sort_keys=True, separators=(',', ': '))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+
+"""
+Times every stage of a run on synthetic machines with 1k, 10k and 60k
+installed packages: searching apt's history logs (Locator.search), parsing
+the 'Install:' line (parser), reading the transactions and merging every
+install cycle as the command line does (Locator.locate), splitting
+`apt-cache rdepends` output (split_rdepends), reading dpkg's status file
+into a graph, classifying the packages (classify) and writing the plan.
+
+For every size, a corpus is generated first: rotated, gzipped history logs
+history.log.N.gz, a dpkg status file and the `apt-cache rdepends` output for
+the packages the synthetic metapackage installed. It needs neither root
+rights nor apt.
+
+The results are written as JSON, so two versions can be compared:
+
+    {"python": "2.7.18", "repeat": 3, "sizes": {"1000": {
+        "packages": 1000, "candidates": 333, "obsolete": 250,
+        "seconds": {"search": 0.01, "parser": 0.0004, "locate": 0.01,
+        ...}}, ...}}
+
+Usage:
+    bench_suite.py [--sizes=LIST] [--repeat=N] [--output=FILE] [--keep=DIR]
+
+Options:
+    --sizes=LIST   Installed packages per machine, comma separated
+                   [default: 1000,10000,60000].
+    --repeat=N     Keep the best of N runs of every stage [default: 3].
+    --output=FILE  Write the JSON results to FILE instead of the screen.
+    --keep=DIR     Generate the corpora in DIR and keep them.
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import tempfile
+
+import docopt
+
+# Import remove_desktop modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import remove_desktop as rd
+
+METAPACKAGE = 'synthetic-desktop'
+# rotated logs per machine; the metapackage is installed in the oldest one
+ARCHIVES = 5
+STAGES = ('search', 'parser', 'locate', 'rdepends', 'graph', 'classify',
+          'plan')
+
+
+def name(i):
+    return 'synthetic-package%05d' % i
+
+
+def make_corpus(directory, size, seed=0):
+    '''Writes the history logs, status file and rdepends output of a
+    machine with size installed packages to directory.
+
+    Packages depend only on packages with lower numbers. The metapackage
+    installed the middle third of them; packages above that third, which
+    are kept, depend on some of them.
+    '''
+
+    rand = random.Random(seed)
+    first, last = size // 3, 2 * size // 3
+    depends = {}
+    for i in range(1, size):
+        depends[i] = sorted(set(rand.randrange(i)
+                                for n in range(rand.randint(0, 3))))
+    candidates = [name(i) for i in range(first, last)]
+
+    with open(os.path.join(directory, 'status'), 'w') as f:
+        f.write('Package: %s\nStatus: install ok installed\n'
+                'Depends: %s\n\n' % (METAPACKAGE, ', '.join(candidates)))
+        for i in range(size):
+            f.write('Package: %s\nStatus: install ok installed\n'
+                    'Architecture: amd64\nVersion: 1.%d\n' % (name(i), i))
+            if depends.get(i):
+                f.write('Depends: %s (>= 1.0)\n' %
+                        ', '.join(name(d) for d in depends[i]))
+            f.write('\n')
+
+    rdepends = {}
+    for i, deps in depends.items():
+        for d in deps:
+            rdepends.setdefault(d, []).append(i)
+    with open(os.path.join(directory, 'rdepends'), 'w') as f:
+        for i in range(first, last):
+            f.write('%s\nReverse Depends:\n' % name(i))
+            for r in [METAPACKAGE] + [name(j) for j in rdepends.get(i, ())]:
+                f.write('  %s\n' % r)
+
+    # upgrades of random packages around the install transaction:
+    for archive in range(1, ARCHIVES + 1):
+        f = gzip.open(os.path.join(directory, 'history.log.%d.gz' % archive),
+                      'wb')
+        for t in range(max(1, size // 100)):
+            day = (ARCHIVES - archive) * 30 + t % 28 + 1
+            upgraded = rand.sample(range(size), min(size, 20))
+            f.write('Start-Date: 2014-%02d-%02d  10:00:00\n'
+                    'Commandline: apt-get dist-upgrade\n'
+                    'Upgrade: %s\n'
+                    'End-Date: 2014-%02d-%02d  10:01:00\n\n' %
+                    (day // 28 + 1, day % 28 + 1,
+                     ', '.join('%s:amd64 (1.%d, 1.%d)' % (name(i), i, i + 1)
+                               for i in upgraded),
+                     day // 28 + 1, day % 28 + 1))
+            if archive == ARCHIVES and t == 0:
+                f.write('Start-Date: 2014-01-01  09:00:00\n'
+                        'Commandline: apt-get install %s\n'
+                        'Install: %s:amd64 (1.0), %s\n'
+                        'End-Date: 2014-01-01  09:30:00\n\n' %
+                        (METAPACKAGE, METAPACKAGE,
+                         ', '.join('%s:amd64 (1.%d, automatic)' % (p, i)
+                                   for i, p in enumerate(candidates))))
+        f.close()
+
+
+def best_time(fct, repeat):
+    '''Returns (the best time of repeat calls of fct, what it returned).'''
+
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        result = fct()
+        times.append(time.time() - start)
+    return min(times), result
+
+
+def bench_size(directory, size, repeat):
+    '''Times every stage on the corpus of a machine with size packages.'''
+
+    make_corpus(directory, size)
+    path = os.path.join(directory, 'history*')
+    status = os.path.join(directory, 'status')
+    with open(os.path.join(directory, 'rdepends')) as f:
+        rdepends_output = f.read()
+    seconds = {}
+
+    seconds['search'], line = best_time(
+        lambda: rd.Locator().search(METAPACKAGE, path), repeat)
+    seconds['parser'], parsed = best_time(lambda: rd.parser(line), repeat)
+    # what the command line runs since installs are merged:
+    seconds['locate'], d = best_time(
+        lambda: rd.Locator().locate([METAPACKAGE], path), repeat)
+    assert d.keys() == parsed.keys(), (len(d), len(parsed))
+    seconds['rdepends'], rdeps = best_time(
+        lambda: rd.split_rdepends(rdepends_output), repeat)
+    assert len(rdeps) == len(d) - 1, (len(rdeps), len(d))
+    seconds['graph'], graph = best_time(
+        lambda: rd.DependencyGraph.from_status(status), repeat)
+    packages = d.keys()
+    seconds['classify'], obsolete = best_time(
+        lambda: rd.classify(packages, graph), repeat)
+
+    chosen = {METAPACKAGE: True}
+    plan = rd.fleet.summarize([METAPACKAGE], d, chosen, graph)
+
+    def write_plan():
+        with open(os.path.join(directory, 'plan.json'), 'w') as f:
+            json.dump(plan, f)
+    seconds['plan'], _ = best_time(write_plan, repeat)
+
+    return {'packages': size, 'candidates': len(packages),
+            'obsolete': len(obsolete), 'seconds': seconds}
+
+
+def main():
+    arguments = docopt.docopt(__doc__)
+    sizes = [int(size) for size in arguments['--sizes'].split(',')]
+    repeat = int(arguments['--repeat'])
+
+    # Locator reports through the module's logger, set up by the script:
+    rd.remove_desktop.logger = logging.getLogger('remove_desktop.bench')
+    rd.remove_desktop.logger.addHandler(logging.NullHandler())
+    rd.remove_desktop.logger.propagate = False
+    # Locator.locate() echoes the lines it finds, keep them off the JSON:
+    rd.remove_desktop.outputter = open(os.devnull, 'w')
+
+    results = {'python': platform.python_version(), 'repeat': repeat,
+               'sizes': {}}
+    root = arguments['--keep'] or tempfile.mkdtemp(prefix='bench-suite-')
+    try:
+        for size in sizes:
+            directory = os.path.join(root, str(size))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            result = bench_size(directory, size, repeat)
+            results['sizes'][str(size)] = result
+            sys.stderr.write('%6d packages: %s\n' % (size, '  '.join(
+                '%s %.4f s' % (stage, result['seconds'][stage])
+                for stage in STAGES)))
+    finally:
+        if not arguments['--keep']:
+            shutil.rmtree(root)
+
+    if arguments['--output']:
+        with open(arguments['--output'], 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True,
+                      separators=(',', ': '))
+    else:
+        print(json.dumps(results, indent=4, sort_keys=True,
+                         separators=(',', ': ')))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,8 +13,20 @@ This module sets up the main interface for remove_desktop package.
 # we include them in the interface:
 from . import remove_desktop
 from . import utils
+from . import dpkg_status
+from . import depgraph
+from . import cache
+from . import logscan
+from . import logindex
+from . import transactions
+from . import metrics
+from . import fleet
+from . import daemon
+from . import plans
+from . import backends
 
 from .remove_desktop import (defaults, Locator, validator, parser,
-parser_stage_2, worker)
+split_rdepends, rdepends, parser_stage_2, worker)
+from .depgraph import DependencyGraph, classify
 
 __state__ = "development"
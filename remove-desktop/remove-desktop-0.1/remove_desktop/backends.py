@@ -0,0 +1,496 @@
+### Library file ###
+
+
+#=============================================================================
+# Copyright: 2013 Andrei Chiver andreichiver@gmail.com
+# License: GPL-3
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  On Debian systems, the complete text of the GNU General
+#  Public License version 3 can be found in "/usr/share/common-licenses/GPL-3".
+#=============================================================================
+
+
+
+"""
+What remove_desktop asks the package system: is a package installed, which
+packages depend on it, and purging packages, for real or simulated.
+
+Two backends answer these questions:
+
+    SubprocessBackend -> runs dpkg-query, apt-cache and apt-get; works on
+                         any Debian-like system
+    AptBackend        -> asks libapt in-process through python-apt, so a
+                         question costs no process at all; used when
+                         python-apt is installed. Packages are still
+                         purged by apt-get.
+
+    >>> backend = backends.default()
+    >>> backend.rdepends(['xubuntu-artwork'])
+    OrderedDict([('xubuntu-artwork', ['xubuntu-desktop', 'shimmer-themes'])])
+
+A RecordingBackend remembers the answers of a real run in a gzipped JSON
+archive, together with dpkg's status file and the history log transactions
+the run read; a ReplayBackend gives the answers back from memory and writes
+the files out again, so the same run can be profiled again on any machine,
+without apt.
+"""
+
+import os
+import gzip
+import json
+import threading
+import subprocess
+import collections
+
+import metrics
+import dpkg_status
+
+
+# format of the archives written by save_archive()
+ARCHIVE_VERSION = 2
+
+
+class PurgeError(Exception):
+    '''Purging failed; exit_code is the one apt-get would exit with.'''
+
+    def __init__(self, exit_code, message=''):
+        super(PurgeError, self).__init__(message or
+                                         'exit code %s' % exit_code)
+        self.exit_code = exit_code
+
+
+class Backend(object):
+    '''The questions remove_desktop asks the package system.'''
+
+    name = None
+
+    def is_installed(self, package):
+        '''Tells if package is installed.'''
+
+        raise NotImplementedError
+
+    def rdepends(self, packages):
+        '''Returns an OrderedDict: package name -> list of the packages that
+        depend on it, installed or not, like `apt-cache rdepends` shows
+        them, in the same order as packages. Packages the package system
+        doesn't know are left out.'''
+
+        raise NotImplementedError
+
+    def purge(self, packages, out, simulate=False):
+        '''Purges packages, ignoring the ones that don't exist anymore, and
+        writes what is done to out, a file-like object.
+
+        simulate -> only tell what would be done
+
+        Raises PurgeError if purging fails.
+        '''
+
+        raise NotImplementedError
+
+
+class SubprocessBackend(Backend):
+    '''Asks dpkg-query, apt-cache and apt-get; a process per question.'''
+
+    name = 'subprocess'
+
+    def is_installed(self, package):
+        '''
+        In a shell you can tell using this:
+        $: dpkg-query -W -f '${Status}\\n' <package>
+        install ok installed
+        It exits with 1 for packages dpkg doesn't know. Every architecture
+        of a package has its own line; dpkg_status decides which states are
+        installed, as for the status file.
+        '''
+        try:
+            with metrics.current.subprocess():
+                with open(os.devnull, 'w') as devnull:
+                    output = subprocess.check_output(
+                        ['dpkg-query', '-W', '-f', '${Status}\n', package],
+                        stderr=devnull)
+        except subprocess.CalledProcessError:
+            # 'no packages found matching <package>'
+            return False
+
+        return any(dpkg_status.is_installed_stanza({'Status': status})
+                   for status in output.splitlines())
+
+    def rdepends(self, packages):
+        '''Looks up all packages with a single `apt-cache rdepends` call,
+        see split_rdepends().'''
+
+        import sh
+
+        try:
+            with metrics.current.subprocess():
+                output = sh.apt_cache.rdepends(packages).stdout
+        except sh.ErrorReturnCode_100:
+            # 'No packages found' -> apt-cache knows none of the packages
+            return collections.OrderedDict()
+
+        found = split_rdepends(output)
+        d = collections.OrderedDict()
+        for package in packages:
+            if package in found:
+                d[package] = found[package]
+
+        return d
+
+    def purge(self, packages, out, simulate=False):
+        import sh
+
+        # if package names have changed since they were installed, apt-get
+        # will raise error: 'Can't locate package ...' so we use
+        # --ignore-missing.
+        if simulate:
+            args = ("--simulate", "--ignore-missing", "purge", packages)
+            kwargs = {'_err_to_out': True}
+        else:
+            args = ("--assume-yes", "--ignore-missing", "purge", packages)
+            kwargs = {}
+
+        try:
+            with sh.sudo:
+                """
+                If you use sudo, the user executing the script must have the
+                NOPASSWD option set for whatever command that user is
+                running, otherwise sudo will hang.
+                Solution to bypass the NOPASSWD option:
+                run the script that contains the sh.sudo command with sudo
+                and enter the password.
+                """
+                with metrics.current.subprocess():
+                    # out gets apt-get's output as it comes, in blocks:
+                    sh.apt_get(*args, _out=out, _out_bufsize=0, **kwargs)
+        except sh.ErrorReturnCode as e:
+            raise PurgeError(e.exit_code)
+
+
+class AptBackend(SubprocessBackend):
+    '''Asks libapt's cache in the same process, through python-apt; purging
+    is left to apt-get, whose output the user watches.
+
+    python-apt isn't thread-safe: the cache is opened when it is first
+    needed, and questions from several threads are answered one at a time.
+    If the cache can't be read, eg. broken package lists, questions go to
+    dpkg-query and apt-cache instead.
+
+    Raises ImportError if python-apt isn't installed.
+    '''
+
+    name = 'apt'
+
+    # the relations `apt-cache rdepends` shows by default:
+    RELATIONS = ('Depends', 'PreDepends', 'Recommends', 'Suggests',
+                 'Conflicts', 'Breaks', 'Replaces', 'Obsoletes', 'Enhances')
+
+    def __init__(self):
+        super(AptBackend, self).__init__()
+        import apt
+        self._apt = apt
+        self._cache = None
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        '''apt.Cache, opened when it is first needed, None if it can't be
+        read; opening it reads the package lists once. Call it holding
+        self._lock.'''
+
+        if self._cache is None:
+            try:
+                self._cache = self._apt.Cache()
+            except SystemError:
+                self._cache = False
+        return self._cache or None
+
+    def is_installed(self, package):
+        with self._lock:
+            cache = self.cache
+            if cache is not None:
+                try:
+                    return cache[package].is_installed
+                except KeyError:
+                    return False
+        return super(AptBackend, self).is_installed(package)
+
+    def rdepends(self, packages):
+        with self._lock:
+            cache = self.cache
+            if cache is not None:
+                return self._rdepends(cache, packages)
+        return super(AptBackend, self).rdepends(packages)
+
+    def _rdepends(self, cache, packages):
+        # the low level apt_pkg cache holds the reverse relations:
+        low_level = cache._cache
+        d = collections.OrderedDict()
+        for package in packages:
+            try:
+                pkg = low_level[package]
+            except KeyError:
+                continue
+            rdeps = d[package] = []
+            for dependency in pkg.rev_depends_list:
+                name = dependency.parent_pkg.name
+                if dependency.dep_type_untranslated in self.RELATIONS and \
+                        name not in rdeps:
+                    rdeps.append(name)
+
+        return d
+
+
+class NotRecorded(LookupError):
+    '''A replayed run asked a question the recorded run didn't ask.'''
+
+
+def empty_archive():
+    '''Returns the answers of a run that asked nothing yet:
+    is_installed -> package -> True or False
+    rdepends -> package -> reverse dependencies, None if it's unknown
+    purges -> one {'packages', 'simulate', 'output', 'exit_code'} per
+              purge, in the order they were made
+    status -> the content of dpkg's status file, None if there was none
+    logs -> log file name -> the transactions read from it, as text
+    '''
+
+    return {'version': ARCHIVE_VERSION, 'is_installed': {}, 'rdepends': {},
+            'purges': [], 'status': None, 'logs': {}}
+
+
+def save_archive(path, archive):
+    '''Writes the answers recorded by a RecordingBackend to path, as
+    gzipped JSON.'''
+
+    f = gzip.open(path, 'wb')
+    try:
+        json.dump(archive, f, separators=(',', ':'))
+    finally:
+        f.close()
+
+
+def load_archive(path):
+    '''Reads answers written by save_archive().'''
+
+    f = gzip.open(path, 'rb')
+    try:
+        archive = json.load(f)
+    finally:
+        f.close()
+    if archive.get('version') != ARCHIVE_VERSION:
+        raise ValueError("'%s' was recorded by another version" % path)
+    return archive
+
+
+class RecordingBackend(Backend):
+    '''Asks another backend and remembers its answers, so that the run can
+    be replayed by a ReplayBackend on a machine without apt.
+
+    >>> backend = RecordingBackend(backends.default())
+    >>> backend.record_status(STATUS_FILE)
+    >>> ... run ...
+    >>> backend.record_logs(found)
+    >>> backend.save('run.json.gz')
+    '''
+
+    def __init__(self, backend):
+        super(RecordingBackend, self).__init__()
+        self.backend = backend
+        self.name = '%s, recorded' % backend.name
+        self.archive = empty_archive()
+
+    def is_installed(self, package):
+        answer = self.backend.is_installed(package)
+        self.archive['is_installed'][package] = answer
+        return answer
+
+    def rdepends(self, packages):
+        d = self.backend.rdepends(packages)
+        # one answer per package: a replay can ask in other chunks
+        for package in packages:
+            self.archive['rdepends'][package] = d.get(package)
+        return d
+
+    def purge(self, packages, out, simulate=False):
+        tee = _Tee(out)
+        record = {'packages': list(packages), 'simulate': simulate,
+                  'exit_code': 0}
+        try:
+            self.backend.purge(packages, tee, simulate)
+        except PurgeError as e:
+            record['exit_code'] = e.exit_code
+            raise
+        finally:
+            record['output'] = tee.getvalue()
+            self.archive['purges'].append(record)
+
+    def record_status(self, path):
+        '''Keeps the content of dpkg's status file at path, if there is
+        one.'''
+
+        try:
+            with open(path, 'rb') as f:
+                self.archive['status'] = f.read()
+        except (IOError, OSError):
+            self.archive['status'] = None
+
+    def record_logs(self, found):
+        '''Keeps found, transactions.Transaction objects read from the
+        history logs, grouped by the name of their log file.'''
+
+        logs = self.archive['logs']
+        for transaction in found:
+            name = os.path.basename(transaction.path)
+            logs[name] = logs.get(name, '') + transaction.text()
+
+    def save(self, path):
+        save_archive(path, self.archive)
+
+
+class _Tee(object):
+    '''Writes to a stream and keeps a copy of what was written.'''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+class ReplayBackend(Backend):
+    '''Answers from an archive recorded by a RecordingBackend, from memory;
+    no process is started and apt isn't needed.
+
+    Raises NotRecorded for questions the recorded run didn't ask.
+
+    >>> backend = ReplayBackend('run.json.gz')
+    >>> backend.restore('/tmp/replay')
+    ('/tmp/replay/status', '/tmp/replay/logs/*')
+    '''
+
+    name = 'replay'
+
+    def __init__(self, path):
+        super(ReplayBackend, self).__init__()
+        self.archive = load_archive(path)
+        self._purges = iter(self.archive['purges'])
+
+    def restore(self, directory):
+        '''Writes the recorded status file and history logs to directory,
+        for the replayed run to read instead of this machine's files.
+
+        Returns (the path of the status file, which doesn't exist if the
+        recorded run had none; a shell glob of the logs).
+        '''
+
+        status_file = os.path.join(directory, 'status')
+        if self.archive['status'] is not None:
+            with open(status_file, 'wb') as f:
+                f.write(self.archive['status'].encode('utf-8'))
+
+        logs = os.path.join(directory, 'logs')
+        os.makedirs(logs)
+        for name, text in self.archive['logs'].items():
+            # rotated logs are read as gzip files:
+            opener = gzip.open if name.endswith('.gz') else open
+            f = opener(os.path.join(logs, name), 'wb')
+            try:
+                f.write(text.encode('utf-8'))
+            finally:
+                f.close()
+
+        return status_file, os.path.join(logs, '*')
+
+    def is_installed(self, package):
+        try:
+            return self.archive['is_installed'][package]
+        except KeyError:
+            raise NotRecorded('is_installed', package)
+
+    def rdepends(self, packages):
+        recorded = self.archive['rdepends']
+        d = collections.OrderedDict()
+        for package in packages:
+            if package not in recorded:
+                raise NotRecorded('rdepends', package)
+            if recorded[package] is not None:
+                d[package] = recorded[package]
+        return d
+
+    def purge(self, packages, out, simulate=False):
+        # purges are replayed in the order they were made:
+        record = next(self._purges, None)
+        if record is None or record['packages'] != list(packages) or \
+                record['simulate'] != simulate:
+            raise NotRecorded('purge', packages)
+        out.write(record['output'].encode('utf-8'))
+        if record['exit_code']:
+            raise PurgeError(record['exit_code'])
+
+
+def split_rdepends(output):
+    '''Splits the output of an `apt-cache rdepends` call made with several
+    package names into one list of reverse dependencies per package.
+
+    output -> stdout of `apt-cache rdepends pkg1 pkg2 ...` which is just the
+              output for every package, one after another:
+
+    $: apt-cache rdepends abiword-plugin-mathview xubuntu-artwork
+    abiword-plugin-mathview
+    Reverse Depends:
+      xubuntu-desktop
+      abiword
+    xubuntu-artwork
+    Reverse Depends:
+      xubuntu-desktop
+      shimmer-themes
+
+    Returns an OrderedDict: package name -> list of reverse dependencies.
+    '''
+
+    d = collections.OrderedDict()
+    rdeps = None
+    for line in output.split("\n"):
+        if not line or line == "Reverse Depends:":
+            continue
+        if line[0].isspace():
+            # reverse dependencies are indented, package names are not;
+            # '  |tzdata' is an alternative, still a reverse dependency
+            if rdeps is not None:
+                rdeps.append(line.strip().lstrip('|'))
+        else:
+            rdeps = d.setdefault(line, [])
+
+    return d
+
+
+def default():
+    '''Returns an AptBackend if python-apt is installed and works, a
+    SubprocessBackend otherwise.'''
+
+    try:
+        return AptBackend()
+    except (ImportError, SystemError):
+        # SystemError: libapt failed to initialize, eg. a broken apt.conf
+        return SubprocessBackend()
@@ -0,0 +1,199 @@
+### Library file ###
+
+
+#=============================================================================
+# Copyright: 2013 Andrei Chiver andreichiver@gmail.com
+# License: GPL-3
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  On Debian systems, the complete text of the GNU General
+#  Public License version 3 can be found in "/usr/share/common-licenses/GPL-3".
+#=============================================================================
+
+
+"""
+On-disk cache of reverse dependencies, kept between runs.
+
+The answers of `apt-cache rdepends` and is_installed() change only when
+packages are installed or removed (/var/lib/dpkg/status changes) or when
+the package lists are updated (/var/lib/apt/lists changes). The cache
+remembers the state of those files and throws its content away as soon as
+they change.
+"""
+
+import os
+import json
+import errno
+import fcntl
+import hashlib
+import tempfile
+import contextlib
+
+
+CACHE_FILE = '/var/cache/remove-desktop/rdepends.json'
+APT_LISTS = '/var/lib/apt/lists'
+
+
+def fingerprint(sources):
+    '''Returns a digest of the names, sizes and modification times of the
+    files in sources; directories are described by the files they hold.'''
+
+    digest = hashlib.sha1()
+    for source in sources:
+        if os.path.isdir(source):
+            paths = [os.path.join(source, name)
+                     for name in sorted(os.listdir(source))]
+        else:
+            paths = [source]
+        for path in paths:
+            try:
+                st = os.stat(path)
+                digest.update('%s %d %r\n' % (path, st.st_size, st.st_mtime))
+            except OSError:
+                digest.update('%s missing\n' % path)
+
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def locked(path, exclusive=False):
+    '''Holds a lock on path + '.lock' so that two runs don't read a cache
+    file while the other one writes it.'''
+
+    lock = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        # closing the file releases the lock
+        lock.close()
+
+
+def read_json(path):
+    '''Reads a JSON file written by write_json(); returns None if there is
+    no file yet, it can't be read or it is corrupted.'''
+
+    try:
+        with locked(path):
+            return _load(path)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    '''Writes data to a JSON file, creating its directory if needed.'''
+
+    update_json(path, lambda old: data)
+
+
+def update_json(path, update):
+    '''Replaces the JSON file at path with update(its current content),
+    holding the lock in between, so that two runs saving at the same time
+    don't lose what the other one wrote. update gets None if there is no
+    file yet or it can't be read. Creates the directory if needed.'''
+
+    directory = os.path.dirname(path) or '.'
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    with locked(path, exclusive=True):
+        try:
+            old = _load(path)
+        except (IOError, OSError, ValueError):
+            old = None
+        data = update(old)
+        # readers never see a half written file: write a temporary file
+        # and rename it over the real one.
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        # mkstemp() makes it private to its owner; other users and, for
+        # plans on a share, other hosts read it:
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class RdependsCache(object):
+    '''Installed reverse dependencies per package, saved to a JSON file.
+
+    >>> cache = RdependsCache(CACHE_FILE, [STATUS_FILE, APT_LISTS])
+    >>> cache.get('xubuntu-artwork')       # a miss
+    >>> cache.put('xubuntu-artwork', ['xubuntu-desktop'])
+    >>> cache.save()
+
+    None is a valid value too; it means apt-cache doesn't know the package.
+    '''
+
+    # what get() returns on a miss, None is a cached value
+    MISS = object()
+
+    # part of the key; files saved with another format are thrown away.
+    # 2: alternative reverse dependencies ('|tzdata') are kept
+    FORMAT = 2
+
+    def __init__(self, path=CACHE_FILE, sources=(APT_LISTS,)):
+        super(RdependsCache, self).__init__()
+        self.path = path
+        self.key = '%d:%s' % (self.FORMAT, fingerprint(sources))
+        self.rdepends = {}
+        '''package -> list of installed reverse dependencies or None'''
+        self.hits = 0
+        self.misses = 0
+        self._changed = False
+        self.load()
+
+    def load(self):
+        '''Reads the cache file, unless it was written for other sources.'''
+
+        data = read_json(self.path)
+        if data and data.get('key') == self.key:
+            self.rdepends = data.get('rdepends', {})
+
+    def get(self, package):
+        try:
+            rdeps = self.rdepends[package]
+        except KeyError:
+            self.misses += 1
+            return self.MISS
+        self.hits += 1
+        return rdeps
+
+    def put(self, package, rdeps):
+        self.rdepends[package] = rdeps
+        self._changed = True
+
+    def save(self):
+        '''Writes the cache file if anything new was put in the cache.'''
+
+        if not self._changed:
+            return
+
+        def merge(data):
+            # keep what a run that overlapped this one saved meanwhile:
+            if data and data.get('key') == self.key:
+                rdepends = data.get('rdepends', {})
+                rdepends.update(self.rdepends)
+                self.rdepends = rdepends
+            return {'key': self.key, 'rdepends': self.rdepends}
+
+        update_json(self.path, merge)
+        self._changed = False
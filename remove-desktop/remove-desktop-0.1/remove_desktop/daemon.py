@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+#=============================================================================
+# Copyright: 2013 Andrei Chiver andreichiver@gmail.com
+# License: GPL-3
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  On Debian systems, the complete text of the GNU General
+#  Public License version 3 can be found in "/usr/share/common-licenses/GPL-3".
+#=============================================================================
+
+
+"""
+Planning daemon: keeps the history logs index, the transactions found in
+them and the dependency graph in memory and answers "what would
+remove_desktop purge for these metapackages" over a Unix domain socket.
+Nothing is removed.
+
+The graph is rebuilt only when dpkg's status file changes; the logs are
+read again only when they change.
+
+Every request and every answer is a single line of JSON:
+
+    -> {"plan": ["xubuntu-desktop"]}
+    <- {"missing": [], "installed": [...], "obsolete": [...], "kept": [...],
+        "error": null}
+
+Usage:
+    daemon serve [options]
+    daemon plan [options] <metapackage>...
+    daemon -h | --help
+
+Options:
+    -h --help              Show this screen.
+    -s FILE --socket=FILE  The socket to listen or connect to.
+                           [default: /run/remove-desktop.sock]
+    --path=GLOB            apt's history logs. [default: /var/log/apt/history*]
+    --status=FILE          dpkg's status file. [default: /var/lib/dpkg/status]
+    --index=FILE           Keep the logs index in FILE between restarts.
+
+Eg:
+    daemon serve &
+    daemon plan xubuntu-desktop smb4k
+"""
+
+import os
+import sys
+import json
+import socket
+import threading
+import SocketServer
+
+import cache
+import depgraph
+import dpkg_status
+import fleet
+import logindex
+import transactions
+
+
+SOCKET_FILE = '/run/remove-desktop.sock'
+HISTORY = '/var/log/apt/history*'
+
+
+class Planner(object):
+    '''Plans removals over state kept in memory between queries.
+
+    >>> planner = Planner(HISTORY, dpkg_status.STATUS_FILE)
+    >>> planner.plan(['xubuntu-desktop'])['obsolete']
+    ['xubuntu-desktop', 'xfwm4', ...]
+    '''
+
+    def __init__(self, path=HISTORY, status_file=dpkg_status.STATUS_FILE,
+                 index_file=None):
+        super(Planner, self).__init__()
+        self.path = path
+        self.status_file = status_file
+        self.index = logindex.HistoryIndex(index_file)
+        self.graph = None
+        self.graph_key = None
+        '''graph_key describes the status file graph was built from.'''
+        self.located = {}
+        '''tuple of metapackages -> (logs fingerprint, d, chosen)'''
+        self.reloads = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        '''Catches up with the logs and rebuilds the graph if dpkg's status
+        file changed since it was last read. Returns the graph.'''
+
+        self.index.update(self.path)
+        self.index.save()
+
+        key = cache.fingerprint([self.status_file])
+        if key != self.graph_key:
+            self.graph = depgraph.DependencyGraph.from_status(
+                self.status_file)
+            self.graph_key = key
+            self.reloads += 1
+
+        return self.graph
+
+    def locate(self, metapackages):
+        '''Returns (d, chosen) like transactions.locate(), reading only the
+        logs that mention metapackages and only if they changed since the
+        last query for the same metapackages.'''
+
+        paths = sorted(set(entry['path'] for package in metapackages
+                           for entry in self.index.lookup(package)))
+        key = cache.fingerprint(paths)
+        hit = self.located.get(tuple(metapackages))
+        if hit is not None and hit[0] == key:
+            return hit[1:]
+
+        found = list(transactions.read(paths, metapackages))
+        d, chosen = transactions.locate(found, metapackages)
+        self.located[tuple(metapackages)] = (key, d, chosen)
+        return d, chosen
+
+    def plan(self, metapackages):
+        '''Returns the plan of metapackages, the dict fleet.plan()
+        returns.'''
+
+        with self._lock:
+            graph = self.refresh()
+            d, chosen = self.locate(metapackages)
+        # the graph is never changed once built, it can be shared:
+        return fleet.summarize(metapackages, d, chosen, graph)
+
+
+class PlanHandler(SocketServer.StreamRequestHandler):
+    '''Answers the queries of a connection, one JSON line each.'''
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+                metapackages = request['plan']
+                if isinstance(metapackages, basestring):
+                    metapackages = [metapackages]
+                answer = self.server.planner.plan(metapackages)
+                answer['error'] = None
+            except Exception as e:
+                answer = {'error': '%s: %s' % (type(e).__name__, e)}
+            self.wfile.write(json.dumps(answer) + '\n')
+            self.wfile.flush()
+
+
+class PlanServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''Unix domain socket server answering queries with a Planner.'''
+
+    daemon_threads = True
+
+    def __init__(self, path, planner):
+        # a socket left behind by a daemon that was killed:
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, PlanHandler)
+        self.planner = planner
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def query(metapackages, path=SOCKET_FILE, timeout=None):
+    '''Asks the daemon listening on path for the plan of metapackages.'''
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({'plan': list(metapackages)}) + '\n')
+        f = sock.makefile('rb')
+        try:
+            return json.loads(f.readline())
+        finally:
+            f.close()
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    import docopt
+
+    arguments = docopt.docopt(__doc__, help=True)
+
+    if arguments['serve']:
+        planner = Planner(arguments['--path'], arguments['--status'],
+                          arguments['--index'])
+        # warm up before the first query:
+        planner.refresh()
+        server = PlanServer(arguments['--socket'], planner)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    else:
+        try:
+            answer = query(arguments['<metapackage>'], arguments['--socket'])
+        except socket.error as e:
+            # no socket file, or nobody accepts on it: ENOENT, ECONNREFUSED
+            print("no planner listening on '%s': %s" %
+                  (arguments['--socket'], e))
+            sys.exit(1)
+        print(json.dumps(answer, indent=4, sort_keys=True))
+        sys.exit(1 if answer['error'] or answer['missing'] else 0)
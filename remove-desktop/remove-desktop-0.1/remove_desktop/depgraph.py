@@ -0,0 +1,323 @@
+### Library file ###
+
+
+#=============================================================================
+# Copyright: 2013 Andrei Chiver andreichiver@gmail.com
+# License: GPL-3
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  On Debian systems, the complete text of the GNU General
+#  Public License version 3 can be found in "/usr/share/common-licenses/GPL-3".
+#=============================================================================
+
+
+"""
+Dependency graph of the installed packages.
+
+It answers the question `apt-cache rdepends <package>` answers, but only
+with installed packages that depend directly on <package>, and without
+starting a process for every question.
+
+Package names are interned into dense integer ids and edges are kept in
+compact arrays (compressed sparse rows), so a graph of 60k packages takes a
+few MB instead of a set object per package.
+"""
+
+import array
+import itertools
+import collections
+
+import dpkg_status
+
+
+# item type of the arrays holding package ids
+ID_TYPE = 'i'
+
+# the only fields of dpkg's status file the graph needs:
+FIELDS = ('Package', 'Status', 'Provides', 'Pre-Depends', 'Depends')
+
+
+class NameTable(object):
+    '''Interned package names; every name gets a dense integer id, 0, 1, 2,
+    etc., in the order names are added.
+
+    >>> names = NameTable()
+    >>> names.id('xubuntu-desktop'), names.id('lightdm')
+    (0, 1)
+    >>> names.name(1)
+    'lightdm'
+    '''
+
+    __slots__ = ('_ids', '_names')
+
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+
+    def id(self, name):
+        '''Returns the id of name, adding name if it is new.'''
+
+        try:
+            return self._ids[name]
+        except KeyError:
+            if isinstance(name, str):
+                name = intern(name)
+            i = self._ids[name] = len(self._names)
+            self._names.append(name)
+            return i
+
+    def get(self, name, default=None):
+        '''Returns the id of name, default if it was never added.'''
+
+        return self._ids.get(name, default)
+
+    def name(self, i):
+        return self._names[i]
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self._names)
+
+
+def _rows(size, rows, columns):
+    '''Groups the edges rows[k] -> columns[k] by row, for rows 0..size-1.
+
+    Returns (offsets, ids): the columns of row i are
+    ids[offsets[i]:offsets[i + 1]], in the order they were given.
+    '''
+
+    offsets = array.array('l', [0]) * (size + 1)
+    for row in rows:
+        offsets[row + 1] += 1
+    for i in xrange(size):
+        offsets[i + 1] += offsets[i]
+
+    ids = array.array(ID_TYPE, [0]) * len(rows)
+    position = offsets[:-1]
+    for row, column in itertools.izip(rows, columns):
+        ids[position[row]] = column
+        position[row] += 1
+
+    return offsets, ids
+
+
+class DependencyGraph(object):
+    '''Forward and reverse adjacency over installed packages.
+
+    An edge a -> b means: installed package a depends (Depends: or
+    Pre-Depends:) on installed package b, or on a virtual package that b
+    provides. When a dependency has alternatives, like
+    'xubuntu-icon-theme | gnome-brave-icon-theme', every installed
+    alternative gets an edge; removing one of them could be fine, but
+    keeping it never breaks anything.
+    '''
+
+    def __init__(self):
+        super(DependencyGraph, self).__init__()
+        self.names = NameTable()
+        '''names holds the ids of all packages the graph knows about.'''
+        self._installed = bytearray()
+        '''package id -> 1 if the package is installed'''
+        self._count = 0
+        self._sources = array.array(ID_TYPE)
+        self._targets = array.array(ID_TYPE)
+        '''_sources[k] depends on _targets[k]'''
+        self._index = None
+        '''(depends offsets, depends ids, rdepends offsets, rdepends ids),
+        built from the edges when they are first needed'''
+
+    @classmethod
+    def from_status(cls, path=dpkg_status.STATUS_FILE):
+        '''Builds the graph from a dpkg status file, reading it once.'''
+
+        graph = cls()
+        # (package id, its Pre-Depends and Depends) of installed packages:
+        relations = []
+        # virtual package -> ids of installed packages providing it
+        providers = {}
+        for stanza in dpkg_status.read_status(path, FIELDS):
+            if 'Package' not in stanza or \
+                    not dpkg_status.is_installed_stanza(stanza):
+                continue
+            package = graph.add_installed(stanza['Package'])
+            for names in dpkg_status.parse_relations(
+                    stanza.get('Provides', '')):
+                for name in names:
+                    providers.setdefault(name, []).append(package)
+            if 'Pre-Depends' in stanza or 'Depends' in stanza:
+                relations.append((package,
+                                  stanza.get('Pre-Depends', '') + ',' +
+                                  stanza.get('Depends', '')))
+
+        ids = graph.names.get
+        installed = graph._installed
+        for package, value in relations:
+            for names in dpkg_status.parse_relations(value):
+                for name in names:
+                    dependency = ids(name)
+                    if dependency is not None and installed[dependency]:
+                        graph._add_edge(package, dependency)
+                    for provider in providers.get(name, ()):
+                        graph._add_edge(package, provider)
+        # index now, so that a graph read by several threads is never
+        # changed:
+        graph.adjacency()
+
+        return graph
+
+    def _id(self, name):
+        i = self.names.id(name)
+        if i >= len(self._installed):
+            self._installed.extend(bytearray(i + 1 - len(self._installed)))
+        return i
+
+    def add_installed(self, package):
+        '''Records that package is installed; returns its id.'''
+
+        i = self._id(package)
+        if not self._installed[i]:
+            self._installed[i] = 1
+            self._count += 1
+        return i
+
+    def add_edge(self, package, dependency):
+        '''Records that package depends on dependency.'''
+
+        self._add_edge(self._id(package), self._id(dependency))
+
+    def _add_edge(self, package, dependency):
+        if package == dependency:
+            return
+        self._sources.append(package)
+        self._targets.append(dependency)
+        self._index = None
+
+    def adjacency(self):
+        '''Returns (depends offsets, depends ids, rdepends offsets,
+        rdepends ids): the ids of the packages that package id i depends on
+        are depends_ids[depends_offsets[i]:depends_offsets[i + 1]], and
+        likewise for reverse dependencies. Duplicate edges are dropped.'''
+
+        if self._index is None:
+            size = len(self.names)
+            keys = sorted(set(source * size + target for source, target in
+                              itertools.izip(self._sources, self._targets)))
+            self._sources = array.array(ID_TYPE,
+                                        (key // size for key in keys))
+            self._targets = array.array(ID_TYPE,
+                                        (key % size for key in keys))
+            del keys
+            self._index = (_rows(size, self._sources, self._targets) +
+                           _rows(size, self._targets, self._sources))
+
+        return self._index
+
+    @property
+    def installed(self):
+        '''The names of all installed packages.'''
+
+        return frozenset(self.names.name(i)
+                         for i, flag in enumerate(self._installed) if flag)
+
+    def is_installed(self, package):
+        i = self.names.get(dpkg_status.package_name(package))
+        return i is not None and bool(self._installed[i])
+
+    __contains__ = is_installed
+
+    def __len__(self):
+        return self._count
+
+    def _neighbours(self, package, offsets, ids):
+        i = self.names.get(dpkg_status.package_name(package))
+        if i is None:
+            return []
+        return sorted(self.names.name(j) for j in ids[offsets[i]:
+                                                      offsets[i + 1]])
+
+    def depends(self, package):
+        '''Installed packages that package depends on directly.'''
+
+        offsets, ids = self.adjacency()[:2]
+        return self._neighbours(package, offsets, ids)
+
+    def rdepends(self, package):
+        '''Installed packages that depend directly on package, the
+        equivalent of `apt-cache rdepends --installed <package>`.'''
+
+        offsets, ids = self.adjacency()[2:]
+        return self._neighbours(package, offsets, ids)
+
+
+def classify(candidates, graph):
+    '''Decides which of the candidates can be removed without breaking
+    packages that you want to keep.
+
+    candidates -> package names you would like to remove, eg. the packages
+                  installed together with a metapackage
+    graph -> a DependencyGraph
+
+    A candidate is kept if an installed package which is not a candidate
+    depends on it, directly or through other kept candidates. All the others
+    are removed. Every package and every dependency is visited once, so
+    the cost is linear in the size of the graph.
+
+    Returns the list of packages to remove (the 'obsolete' list worker()
+    takes), in the same order as candidates.
+    '''
+
+    depends_offsets, depends_ids, rdepends_offsets, rdepends_ids = \
+        graph.adjacency()
+    ids = [graph.names.get(package) for package in candidates]
+    # flags by package id:
+    removal = bytearray(len(graph.names))
+    kept = bytearray(len(graph.names))
+    for i in ids:
+        if i is not None:
+            removal[i] = 1
+    queue = collections.deque()
+
+    # candidates needed directly by packages you keep:
+    for i in ids:
+        if i is None or kept[i]:
+            continue
+        for rdep in rdepends_ids[rdepends_offsets[i]:rdepends_offsets[i + 1]]:
+            if not removal[rdep]:
+                kept[i] = 1
+                queue.append(i)
+                break
+
+    # ... and everything they need, in turn:
+    while queue:
+        i = queue.popleft()
+        for dependency in depends_ids[depends_offsets[i]:
+                                      depends_offsets[i + 1]]:
+            if removal[dependency] and not kept[dependency]:
+                kept[dependency] = 1
+                queue.append(dependency)
+
+    obsolete = []
+    # a package name appearing twice is removed only once:
+    seen = set()
+    for package, i in itertools.izip(candidates, ids):
+        if (i is None or not kept[i]) and package not in seen:
+            seen.add(package)
+            obsolete.append(package)
+
+    return obsolete
@@ -0,0 +1,155 @@
+### Library file ###
+
+
+#=============================================================================
+# Copyright: 2013 Andrei Chiver andreichiver@gmail.com
+# License: GPL-3
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  On Debian systems, the complete text of the GNU General
+#  Public License version 3 can be found in "/usr/share/common-licenses/GPL-3".
+#=============================================================================
+
+
+"""
+Reads dpkg's database of packages, /var/lib/dpkg/status, without calling
+dpkg-query.
+
+The file is a list of stanzas separated by blank lines:
+
+    Package: xubuntu-artwork
+    Status: install ok installed
+    Depends: xubuntu-icon-theme, shimmer-themes
+    ...
+"""
+
+STATUS_FILE = '/var/lib/dpkg/status'
+
+# the last word of the 'Status:' field; dpkg knows about these states, all
+# but 'not-installed' and 'config-files' mean the package files are on disk.
+NOT_INSTALLED = ('not-installed', 'config-files')
+
+
+def read_status(path=STATUS_FILE, fields=None):
+    '''Yields one dictionary per package stanza in the dpkg status file.
+
+    Keys are field names ('Package', 'Status', 'Depends', etc.), values are
+    the field values as strings; continuation lines are joined with '\\n'.
+
+    fields -> if given, only these fields are kept, eg. the long
+              'Description:' is skipped when only dependencies are needed.
+    '''
+
+    stanza = {}
+    field = None
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                if stanza:
+                    yield stanza
+                stanza = {}
+                field = None
+            elif line[0].isspace():
+                # continuation of a multi-line field, eg. 'Description:'
+                if field is not None:
+                    stanza[field] += '\n' + line
+            else:
+                field, _, value = line.partition(':')
+                if fields is not None and field not in fields:
+                    field = None
+                    continue
+                stanza[field] = value.strip()
+
+    if stanza:
+        yield stanza
+
+
+def is_installed_stanza(stanza):
+    '''Tells if a stanza returned by read_status() is an installed package.'''
+
+    status = stanza.get('Status', '').split()
+    return bool(status) and status[-1] not in NOT_INSTALLED
+
+
+def package_name(name):
+    '''Strips the architecture qualifier from a package name, eg.
+    'libgpgme++2:i386' -> 'libgpgme++2'.'''
+
+    return name.split(':', 1)[0]
+
+
+def parse_relations(value):
+    '''Parses a relationship field like 'Depends:' or 'Provides:' into a
+    list of alternatives; every alternative is a list of package names.
+    Versions and architecture qualifiers are dropped:
+    >>> parse_relations('libc6 (>= 2.15), xubuntu-icon-theme | gnome-brave-icon-theme, perl:any')
+    [['libc6'], ['xubuntu-icon-theme', 'gnome-brave-icon-theme'], ['perl']]
+    '''
+
+    relations = []
+    for group in value.split(','):
+        names = []
+        for alternative in group.split('|'):
+            # 'libc6 (>= 2.15)' -> 'libc6'
+            name = alternative.split('(', 1)[0].strip()
+            if name:
+                names.append(package_name(name))
+        if names:
+            relations.append(names)
+
+    return relations
+
+
+class InstalledIndex(object):
+    '''The set of names of installed packages, read once from the dpkg
+    status file.
+
+    An index is callable, so it can be used as the callback of
+    parser_stage_2():
+    >>> index = InstalledIndex('/var/lib/dpkg/status')
+    >>> index('xubuntu-desktop')
+    True
+    '''
+
+    def __init__(self, path=STATUS_FILE):
+        super(InstalledIndex, self).__init__()
+        self.path = path
+        self.names = frozenset(stanza['Package']
+                               for stanza in read_status(path)
+                               if 'Package' in stanza and
+                               is_installed_stanza(stanza))
+        '''names holds the exact names of installed packages.'''
+
+    def __contains__(self, package):
+        return package_name(package) in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def __call__(self, package):
+        return package in self
+
+
+# one index per status file and per run:
+_indexes = {}
+
+
+def installed_index(path=STATUS_FILE):
+    '''Returns the InstalledIndex of path, reading the file only the first
+    time it is asked for.'''
+
+    if path not in _indexes:
+        _indexes[path] = InstalledIndex(path)
+    return _indexes[path]
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+#=============================================================================
+# Copyright: 2013 Andrei Chiver andreichiver@gmail.com
+# License: GPL-3
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  On Debian systems, the complete text of the GNU General
+#  Public License version 3 can be found in "/usr/share/common-licenses/GPL-3".
+#=============================================================================
+
+
+"""
+Tell what remove_desktop would purge on many machines, from copies of their
+apt history logs and dpkg status files. Nothing is removed; it needs neither
+root rights nor apt.
+
+<snapshots> is a directory with one directory per host, holding copies of
+/var/log/apt/history* and /var/lib/dpkg/status, either flat:
+
+    snapshots/host1/history.log
+    snapshots/host1/history.log.1.gz
+    snapshots/host1/status
+
+or in their original places:
+
+    snapshots/host2/var/log/apt/history.log
+    snapshots/host2/var/lib/dpkg/status
+
+One JSON object per host is written per line, eg.:
+
+    {"host": "host1", "metapackages": ["xubuntu-desktop"],
+     "missing": [], "installed": [...], "obsolete": [...], "kept": [...],
+     "error": null}
+
+Usage:
+    fleet [options] <snapshots> <metapackage>...
+    fleet -h | --help
+
+Options:
+    -h --help             Show this screen.
+    -j N --jobs=N         Plan N hosts at once. Defaults to the number of CPUs.
+    -o FILE --output=FILE Write the results to FILE instead of the screen.
+
+Eg:
+    fleet /srv/snapshots xubuntu-desktop
+    fleet -j 8 -o plans.jsonl /srv/snapshots kubuntu-desktop smb4k
+"""
+
+import os
+import sys
+import glob
+import json
+import multiprocessing
+
+import transactions
+import depgraph
+
+
+# where the files are found in a host's snapshot, flat copies first:
+HISTORY = ('history.log*', 'var/log/apt/history.log*')
+STATUS = ('status', 'var/lib/dpkg/status')
+
+
+def find_snapshot(host_dir):
+    '''Returns (the history logs, the dpkg status file) of a host's
+    snapshot directory; status is None if there is none.'''
+
+    logs = []
+    for pattern in HISTORY:
+        logs.extend(glob.glob(os.path.join(host_dir, pattern)))
+    status = None
+    for name in STATUS:
+        if os.path.isfile(os.path.join(host_dir, name)):
+            status = os.path.join(host_dir, name)
+            break
+
+    return logs, status
+
+
+def plan(metapackages, logs, status):
+    '''Computes what remove_desktop would purge for metapackages, from
+    history logs and a dpkg status file.
+
+    Returns a dict:
+    missing -> metapackages that were never installed, according to logs
+    installed -> packages installed together with the metapackages
+    obsolete -> the packages that would be purged
+    kept -> the packages that other packages still need
+    '''
+
+    found = list(transactions.read(logs, metapackages))
+    d, chosen = transactions.locate(found, metapackages)
+    graph = depgraph.DependencyGraph.from_status(status)
+    return summarize(metapackages, d, chosen, graph)
+
+
+def summarize(metapackages, d, chosen, graph):
+    '''Classifies the packages in d, as returned by transactions.locate()
+    together with chosen, over graph; returns the dict plan() returns.'''
+
+    packages = d.keys()
+    obsolete = depgraph.classify(packages, graph)
+    removed = set(obsolete)
+
+    return {'missing': [m for m in metapackages if chosen[m] is None],
+            'installed': packages,
+            'obsolete': obsolete,
+            'kept': [p for p in packages if p not in removed]}
+
+
+def plan_host(args):
+    '''Plans a single host; args is (host directory, metapackages). Runs in
+    a worker process, so it never raises: errors are reported in the
+    result.'''
+
+    host_dir, metapackages = args
+    result = {'host': os.path.basename(host_dir.rstrip(os.sep)),
+              'metapackages': metapackages, 'error': None}
+    try:
+        logs, status = find_snapshot(host_dir)
+        if status is None:
+            raise IOError("no dpkg status file in '%s'" % host_dir)
+        result.update(plan(metapackages, logs, status))
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+
+    return result
+
+
+def hosts(snapshots):
+    '''Returns the host directories in snapshots, sorted by name.'''
+
+    return [os.path.join(snapshots, name)
+            for name in sorted(os.listdir(snapshots))
+            if os.path.isdir(os.path.join(snapshots, name))]
+
+
+def analyze(snapshots, metapackages, jobs=None, output=sys.stdout):
+    '''Plans every host in snapshots with a pool of jobs processes and
+    writes a JSON line per host to output, in host name order. Returns the
+    number of hosts that could not be planned.'''
+
+    tasks = [(host_dir, metapackages) for host_dir in hosts(snapshots)]
+    errors = 0
+    if not tasks:
+        return errors
+
+    pool = multiprocessing.Pool(min(jobs or multiprocessing.cpu_count(),
+                                    len(tasks)))
+    try:
+        for result in pool.imap(plan_host, tasks):
+            if result['error']:
+                errors += 1
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return errors
+
+
+if __name__ == '__main__':
+    import docopt
+
+    arguments = docopt.docopt(__doc__, help=True)
+
+    jobs = arguments['--jobs'] or str(multiprocessing.cpu_count())
+    if not jobs.isdigit() or int(jobs) < 1:
+        print("--jobs must be a positive number.")
+        sys.exit(1)
+
+    if not os.path.isdir(arguments['<snapshots>']):
+        print("'%s' is not a directory." % arguments['<snapshots>'])
+        sys.exit(1)
+
+    if arguments['--output']:
+        with open(arguments['--output'], 'w') as output:
+            errors = analyze(arguments['<snapshots>'],
+                             arguments['<metapackage>'], int(jobs), output)
+    else:
+        # stdout stays open for the interpreter to flush
+        errors = analyze(arguments['<snapshots>'], arguments['<metapackage>'],
+                         int(jobs))
+
+    sys.exit(1 if errors else 0)
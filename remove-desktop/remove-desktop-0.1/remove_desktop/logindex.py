@@ -0,0 +1,248 @@
+### Library file ###
+
+
+#=============================================================================
+# Copyright: 2013 Andrei Chiver andreichiver@gmail.com
+# License: GPL-3
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  On Debian systems, the complete text of the GNU General
+#  Public License version 3 can be found in "/usr/share/common-licenses/GPL-3".
+#=============================================================================
+
+
+"""
+Index of apt's history logs: package name -> the transactions that
+installed or removed it, kept between runs.
+
+apt's history.log is a list of transactions:
+
+    Start-Date: 2014-03-25  09:50:02
+    Commandline: apt-get install smb4k
+    Install: smb4k:amd64 (1.0.7-1ubuntu1), libkdecore5:amd64 (...), ...
+    End-Date: 2014-03-25  09:50:07
+
+Rotated logs (history.log.1.gz, history.log.2.gz, etc.) never change, they
+are only renamed, so they are indexed once and recognized by their inode
+and size. The live history.log only grows, so only its new lines are read.
+"""
+
+import os
+import re
+import glob
+import hashlib
+import itertools
+
+import cache
+import logscan
+
+
+INDEX_FILE = '/var/cache/remove-desktop/history.json'
+
+# bytes at the beginning of a log that identify it, see head_digest()
+HEAD_SIZE = 4096
+
+# transaction lines that list packages:
+KINDS = ('Install', 'Reinstall', 'Upgrade', 'Downgrade', 'Remove', 'Purge')
+
+# 'smb4k:amd64 (1.0.7-1ubuntu1)' or, in old logs, 'smb4k (1.0.7-1ubuntu1)'
+PACKAGE = re.compile(r'(?:^|, )([^\s:,()]+)(?::[\w-]+)? \(')
+
+
+class HistoryIndex(object):
+    '''Maps package names to the lines of apt's history logs that mention
+    them, saved to a JSON file.
+
+    >>> index = HistoryIndex(INDEX_FILE)
+    >>> index.update('/var/log/apt/history*')
+    >>> index.lookup('smb4k')
+    [{'path': '/var/log/apt/history.log', 'offset': 2301,
+      'kind': 'Install', 'start_date': '2014-03-25  09:50:02'}]
+    '''
+
+    def __init__(self, path=INDEX_FILE):
+        super(HistoryIndex, self).__init__()
+        self.path = path
+        '''path is the index file; if None, the index lives in memory.'''
+        self.files = {}
+        '''file id (inode) -> {'path', 'size', 'offset', 'start_date',
+        'head', 'head_size'}; head is a digest of the first head_size bytes
+        of the file, which tells the file apart from another one that got
+        the same inode'''
+        self.packages = {}
+        '''package -> list of [file id, offset, kind, start date]'''
+        self._changed = False
+        self.load()
+
+    def load(self):
+        if self.path is None:
+            return
+        data = cache.read_json(self.path)
+        if not data:
+            return
+
+        self.files = data.get('files', {})
+        self.packages = data.get('packages', {})
+
+    def save(self):
+        '''Writes the index file if it was updated.'''
+
+        if not self._changed or self.path is None:
+            return
+
+        cache.write_json(self.path, {'files': self.files,
+                                     'packages': self.packages})
+        self._changed = False
+
+    def update(self, pattern, jobs=1):
+        '''Brings the index up to date with the files matching pattern, a
+        shell glob. Returns self.
+
+        jobs -> index up to jobs new files at once, in a pool of processes;
+                rotated logs are gzipped, decompressing them takes most of
+                the time.
+        '''
+
+        seen = set()
+        # (file id, filename, size) of the files to read:
+        todo = []
+        for filename in logscan.newest_first(glob.glob(pattern)):
+            st = os.stat(filename)
+            file_id = str(st.st_ino)
+            seen.add(file_id)
+            record = self.files.get(file_id)
+            compressed = filename.endswith('.gz')
+
+            if record is not None and record.get('head') == head_digest(
+                    filename, record.get('head_size', 0)):
+                if record['path'] != filename:
+                    # rotated: history.log.1.gz -> history.log.2.gz
+                    record['path'] = filename
+                    self._changed = True
+                if compressed and record['size'] == st.st_size:
+                    continue
+                if not compressed and st.st_size >= record['offset']:
+                    # the live log grew, read only the new lines
+                    todo.append((file_id, filename, st.st_size))
+                    continue
+            # a new file, the inode now belongs to another file or the live
+            # log was truncated and written again
+            self._forget(file_id)
+            self.files[file_id] = {'path': filename, 'offset': 0,
+                                   'start_date': None}
+            todo.append((file_id, filename, st.st_size))
+
+        tasks = [(filename, self.files[file_id]['offset'],
+                  self.files[file_id]['start_date'])
+                 for file_id, filename, size in todo]
+        for (file_id, filename, size), result in itertools.izip(
+                todo, logscan.map_logs(index_log, tasks, jobs)):
+            self._add(file_id, size, *result)
+
+        # files that were deleted or rotated away:
+        for file_id in set(self.files) - seen:
+            self._forget(file_id)
+
+        return self
+
+    def _forget(self, file_id):
+        if file_id not in self.files:
+            return
+        del self.files[file_id]
+        for package in list(self.packages):
+            entries = [e for e in self.packages[package] if e[0] != file_id]
+            if entries:
+                self.packages[package] = entries
+            else:
+                del self.packages[package]
+        self._changed = True
+
+    def _add(self, file_id, size, entries, offset, start_date):
+        '''Adds the entries index_log() found in a file.'''
+
+        for package, entry_offset, kind, entry_date in entries:
+            self.packages.setdefault(package, []).append(
+                [file_id, entry_offset, kind, entry_date])
+        record = self.files[file_id]
+        record.update(size=size, offset=offset, start_date=start_date,
+                      head_size=min(HEAD_SIZE, size))
+        record['head'] = head_digest(record['path'], record['head_size'])
+        self._changed = True
+
+    def lookup(self, package, kinds=KINDS):
+        '''Returns the history entries of package, newest first.'''
+
+        entries = []
+        for file_id, offset, kind, start_date in self.packages.get(package,
+                                                                    ()):
+            if kind in kinds:
+                entries.append({'path': self.files[file_id]['path'],
+                                'offset': offset, 'kind': kind,
+                                'start_date': start_date})
+        # dates look like '2014-03-25  09:50:02', so they sort as strings
+        entries.sort(key=lambda e: e['start_date'], reverse=True)
+        return entries
+
+    def read_line(self, entry):
+        '''Reads the log line of an entry returned by lookup(), as
+        'filename:line'. It is a single read for plain files; gzipped files
+        are decompressed up to the offset.'''
+
+        with logscan.open_log(entry['path']) as f:
+            f.seek(entry['offset'])
+            line = f.readline()
+        return '%s:%s' % (entry['path'], line.rstrip('\n'))
+
+    def lines(self, package, kinds=KINDS):
+        '''Yields the log lines of package's entries, newest first.'''
+
+        for entry in self.lookup(package, kinds):
+            yield self.read_line(entry)
+
+
+def index_log(task):
+    '''Reads a log file from an offset, task being (filename, offset,
+    start date of the transaction at offset); runs in a worker process.
+
+    Returns (list of (package, offset, kind, start date) entries, the offset
+    to read from next time, the start date at that offset).
+    '''
+
+    filename, offset, start_date = task
+    entries = []
+    with logscan.open_log(filename) as f:
+        if offset:
+            f.seek(offset)
+        for line in f:
+            if not line.endswith('\n'):
+                # apt is still writing this line, read it next time
+                break
+            kind, _, value = line.partition(': ')
+            if kind == 'Start-Date':
+                start_date = value.strip()
+            elif kind in KINDS:
+                for package in PACKAGE.findall(value):
+                    entries.append((package, offset, kind, start_date))
+            offset += len(line)
+
+    return entries, offset, start_date
+
+
+def head_digest(filename, size):
+    '''Returns a digest of the first size bytes of a file, as they are
+    stored on disk. Logs are only appended to, so the digest changes only
+    if the file is replaced or truncated.'''
+
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read(size)).hexdigest()
@@ -0,0 +1,202 @@
+### Library file ###
+
+
+#=============================================================================
+# Copyright: 2013 Andrei Chiver andreichiver@gmail.com
+# License: GPL-3
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  On Debian systems, the complete text of the GNU General
+#  Public License version 3 can be found in "/usr/share/common-licenses/GPL-3".
+#=============================================================================
+
+
+"""
+Searches package manager's log files for a package, like `zgrep` does, but
+without starting a process and without holding the output in memory.
+
+Eg. apt's /var/log/apt/history.log and its rotated, gzipped copies
+/var/log/apt/history.log.1.gz, /var/log/apt/history.log.2.gz, etc.
+
+Files are read newest first, and years of rotated logs can be decompressed
+in parallel by a pool of processes, see map_logs(). Plain logs, like the live
+history.log that can grow to hundreds of MB, are memory-mapped instead of
+read: the package is looked for in the mapped bytes and only the lines around
+it are copied into strings, see map_log() and find_lines().
+"""
+
+import re
+import gzip
+import glob
+import mmap
+import itertools
+import multiprocessing
+
+
+# the rotation number of a log, eg. history.log.3.gz -> 3
+ROTATION = re.compile(r'\.(\d+)(?:\.gz)?$')
+
+
+def open_log(path):
+    '''Opens a log file for reading, decompressing it on the fly if it is
+    gzipped.'''
+
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def map_log(path):
+    '''Memory-maps a plain log file, read-only. Returns None if the file
+    is empty, an empty file can't be mapped.'''
+
+    with open(path, 'rb') as f:
+        # the map stays valid after the file is closed
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return None
+
+
+def find_lines(data, token):
+    '''Yields (start, end) of every line of data, a memory-mapped log,
+    which contains token; end is the offset of the '\\n' ending the line.
+    Nothing but the offsets is computed: data is searched in place.'''
+
+    end = 0
+    while True:
+        hit = data.find(token, end)
+        if hit == -1:
+            return
+        start = data.rfind('\n', 0, hit) + 1
+        end = data.find('\n', hit)
+        if end == -1:
+            end = len(data)
+        yield start, end
+        end += 1
+
+
+def token_pattern(*packages):
+    '''Returns a regex that matches any of packages as a whole package
+    name: 'smb4k' matches 'smb4k:amd64 (1.0.7-1ubuntu1)' and 'install smb4k',
+    but not 'smb4k-foo:amd64' or 'libsmb4k'.'''
+
+    # characters that can be part of a package name:
+    name = r'[\w.+-]'
+    alternatives = '|'.join(re.escape(package) for package in packages)
+    return re.compile(r'(?<!%s)(?:%s)(?!%s)' % (name, alternatives, name))
+
+
+def is_install_line(line):
+    '''Tells if line lists the packages installed by an apt transaction.'''
+
+    return 'Install: ' in line
+
+
+def rotation(filename):
+    '''Returns how many times filename was rotated: 0 for history.log, 1
+    for history.log.1.gz, 2 for history.log.2.gz, etc.'''
+
+    match = ROTATION.search(filename)
+    return int(match.group(1)) if match else 0
+
+
+def newest_first(filenames):
+    '''Sorts log files from the live log to the oldest rotated one.'''
+
+    return sorted(filenames, key=lambda filename: (rotation(filename),
+                                                   filename))
+
+
+def map_logs(function, tasks, jobs=1):
+    '''Yields function(task) for every task, in the order of tasks.
+
+    jobs -> with more than 1, tasks run in a pool of jobs processes, so
+            several compressed logs are decompressed at once; function must
+            then be a module level function. Results still come in order:
+            the one of a task is yielded as soon as it and the ones before it
+            are done.
+
+    Closing the generator, eg. once the answer is found, terminates the
+    pool: logs that weren't read yet never are.
+    '''
+
+    if jobs <= 1 or len(tasks) <= 1:
+        for result in itertools.imap(function, tasks):
+            yield result
+        return
+
+    pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+        for result in pool.imap(function, tasks):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def matching_lines(task):
+    '''Returns the lines of a file which contain package, task being
+    (package, filename), as 'filename:line' like zgrep prints them.'''
+
+    package, filename = task
+    pattern = token_pattern(package)
+    lines = []
+    if not filename.endswith('.gz'):
+        data = map_log(filename)
+        if data is None:
+            return lines
+        try:
+            for start, end in find_lines(data, package):
+                line = data[start:end]
+                if pattern.search(line):
+                    lines.append('%s:%s' % (filename, line))
+        finally:
+            data.close()
+        return lines
+
+    with open_log(filename) as f:
+        for line in f:
+            # a plain substring test is much faster than the regex and
+            # rules out almost all lines:
+            if package not in line or not pattern.search(line):
+                continue
+            lines.append('%s:%s' % (filename, line.rstrip('\n')))
+
+    return lines
+
+
+def scan(package, path, stop=None, jobs=1):
+    '''Yields the lines of the files matching path (a shell glob) which
+    contain package, one by one, as 'filename:line' like zgrep prints them.
+    Lines come newest first: the live log first, from its end, then the
+    rotated logs.
+
+    stop -> a function that takes a matching line; once it returns True,
+            the scan ends and the rest of the files are not read.
+    jobs -> read up to jobs files at once, see map_logs()
+    '''
+
+    tasks = [(package, filename)
+             for filename in newest_first(glob.glob(path))]
+    results = map_logs(matching_lines, tasks, jobs)
+    try:
+        for lines in results:
+            for line in reversed(lines):
+                yield line
+                if stop is not None and stop(line):
+                    return
+    finally:
+        # stops the workers still reading older files:
+        results.close()
@@ -0,0 +1,159 @@
+### Library file ###
+
+
+#=============================================================================
+# Copyright: 2013 Andrei Chiver andreichiver@gmail.com
+# License: GPL-3
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  On Debian systems, the complete text of the GNU General
+#  Public License version 3 can be found in "/usr/share/common-licenses/GPL-3".
+#=============================================================================
+
+
+"""
+Tells where the time of a run went: wall time of every phase, how many
+processes were started and how long they took, latency of single packages
+and the peak memory used.
+
+Code that starts a process or does a phase records it in `current`:
+
+    with metrics.current.phase('locate'):
+        d = loc.locate(metapackages, conf['path'], index)
+
+    with metrics.current.subprocess():
+        sh.apt_cache.rdepends(packages)
+"""
+
+import json
+import time
+import resource
+import threading
+import contextlib
+import collections
+
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, p):
+    '''Returns the p-th percentile of values, nearest rank method; None if
+    there are no values.'''
+
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, -(-p * len(values) // 100))      # ceil
+    return values[rank - 1]
+
+
+def peak_rss():
+    '''Returns the peak resident memory, in KB, of this process and of the
+    biggest of its finished child processes.'''
+
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+
+class Metrics(object):
+    '''Measurements of a run. Safe to use from several threads.'''
+
+    def __init__(self):
+        super(Metrics, self).__init__()
+        self.phases = collections.OrderedDict()
+        '''phase name -> seconds, in the order phases started'''
+        self.subprocesses = 0
+        self.subprocess_seconds = 0.0
+        self.samples = collections.OrderedDict()
+        '''name -> list of seconds, eg. the latency of every package'''
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Adds the wall time of the with block to phase name.'''
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = (self.phases.get(name, 0.0) +
+                                     time.time() - start)
+
+    @contextlib.contextmanager
+    def subprocess(self):
+        '''Counts a process started in the with block and its latency.'''
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.subprocesses += 1
+                self.subprocess_seconds += time.time() - start
+
+    def sample(self, name, seconds):
+        '''Records one measurement, eg. the latency of a package.'''
+
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def as_dict(self):
+        samples = collections.OrderedDict()
+        for name, values in self.samples.items():
+            samples[name] = collections.OrderedDict(
+                [('count', len(values))] +
+                [('p%d' % p, percentile(values, p)) for p in PERCENTILES] +
+                [('max', max(values))])
+
+        return collections.OrderedDict([
+            ('phases', self.phases),
+            ('subprocesses', collections.OrderedDict([
+                ('count', self.subprocesses),
+                ('seconds', self.subprocess_seconds)])),
+            ('samples', samples),
+            ('peak_rss_kb', peak_rss())])
+
+    def summary(self):
+        '''Returns a table of the measurements, to print at the end of a
+        run.'''
+
+        data = self.as_dict()
+        lines = ['%-28s %12s' % ('phase', 'seconds')]
+        for name, seconds in data['phases'].items():
+            lines.append('%-28s %12.3f' % (name, seconds))
+        lines.append('%-28s %12.3f' % ('subprocesses (%d)' %
+                                       self.subprocesses,
+                                       self.subprocess_seconds))
+        for name, stats in data['samples'].items():
+            values = '  '.join('p%d %.4f' % (p, stats['p%d' % p])
+                               for p in PERCENTILES)
+            lines.append('%-28s %s' % ('%s (%d)' % (name, stats['count']),
+                                       values))
+        rss = data['peak_rss_kb']
+        lines.append('%-28s %9d KB' % ('peak RSS', rss['self']))
+        lines.append('%-28s %9d KB' % ('peak RSS, child processes',
+                                       rss['children']))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        '''Writes the measurements to path as JSON.'''
+
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=4, separators=(',', ': '))
+
+
+# the measurements of this run:
+current = Metrics()
@@ -0,0 +1,187 @@
+### Library file ###
+
+
+#=============================================================================
+# Copyright: 2013 Andrei Chiver andreichiver@gmail.com
+# License: GPL-3
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  On Debian systems, the complete text of the GNU General
+#  Public License version 3 can be found in "/usr/share/common-licenses/GPL-3".
+#=============================================================================
+
+
+
+"""
+Removal plans saved to a file and applied on identical machines without
+computing them again.
+
+A plan holds what the computing phase decided: the packages to purge, the
+packages kept and, for every kept package, the packages that need it. It is
+keyed by content, not by host: the metapackages, a digest of dpkg's status
+file and a digest of the candidates, the packages installed together with
+the metapackages over all their install cycles, see transactions.locate().
+Machines built from the same image have the same status file and logs, so
+the plan of one of them is valid for all of them.
+
+    >>> d = loc.locate(['xubuntu-desktop'], PATH, index)
+    >>> obsolete = depgraph.classify(d.keys(), graph)
+    >>> plan = plans.build(['xubuntu-desktop'], d, obsolete, graph,
+    ...                    STATUS_FILE)
+    >>> plans.save('/srv/plans/xubuntu.json', plan)
+    ... on another machine:
+    >>> plan = plans.load('/srv/plans/xubuntu.json')
+    >>> plans.matches(plan, ['xubuntu-desktop'], STATUS_FILE, index)
+    True
+"""
+
+import json
+import hashlib
+
+import cache
+import logscan
+import transactions
+
+
+# bytes read at a time when computing the digest of a file
+BLOCK_SIZE = 1 << 20
+
+
+def file_digest(path):
+    '''Returns the SHA-1 digest of the content of the file at path, None if
+    it can't be read.'''
+
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), ''):
+                digest.update(block)
+    except (IOError, OSError):
+        return None
+
+    return digest.hexdigest()
+
+
+def candidates_digest(candidates):
+    '''Returns the SHA-1 digest of candidates, the OrderedDict
+    package name -> (arch, version) transactions.locate() returns; the log
+    files they were read from are left out, logs are rotated differently on
+    every machine.'''
+
+    return hashlib.sha1(json.dumps(candidates.items())).hexdigest()
+
+
+def plan_key(metapackages, status, candidates):
+    '''Returns the key of a plan, a digest of what it was computed from:
+    metapackages, the digest of dpkg's status file and the
+    candidates_digest() of the packages installed with them.'''
+
+    return hashlib.sha1(json.dumps([list(metapackages), status,
+                                    candidates])).hexdigest()
+
+
+def reasons(kept, removed, graph):
+    '''Returns a dict: kept package -> the installed packages that depend
+    on it and are not removed.'''
+
+    removed = set(removed)
+    return dict((package, [rdep for rdep in graph.rdepends(package)
+                           if rdep not in removed])
+                for package in kept)
+
+
+def build(metapackages, candidates, obsolete, graph, status_file):
+    '''Returns the plan that removes obsolete out of candidates, as
+    depgraph.classify() decided over graph.
+
+    candidates -> the OrderedDict transactions.locate() returns for
+                  metapackages, like Locator.locate()
+    status_file -> dpkg's status file graph describes
+
+    The plan is a dict:
+    key -> plan_key() of the fields below
+    metapackages -> the metapackages, in the order they were given
+    status -> file_digest() of status_file
+    candidates -> candidates_digest() of candidates
+    obsolete -> the packages to purge
+    kept -> the packages that other packages still need
+    reasons -> kept package -> the packages that need it
+    '''
+
+    removed = set(obsolete)
+    kept = [p for p in candidates if p not in removed]
+    status = file_digest(status_file)
+    digest = candidates_digest(candidates)
+
+    return {'key': plan_key(metapackages, status, digest),
+            'metapackages': list(metapackages),
+            'status': status,
+            'candidates': digest,
+            'obsolete': list(obsolete),
+            'kept': kept,
+            'reasons': reasons(kept, removed, graph)}
+
+
+def matches(plan, metapackages, status_file, index):
+    '''Tells if plan can be applied to this machine: it was computed for
+    metapackages, from a status file identical to status_file, and the
+    logs give the same candidates: every install cycle of the metapackages
+    and what was removed since, not only the newest installation.
+
+    index -> a logindex.HistoryIndex of the history logs; only the files
+             that mention metapackages are read.
+    '''
+
+    if plan is None or plan.get('metapackages') != list(metapackages):
+        return False
+    # a plan edited by hand or written by another version:
+    if plan.get('key') != plan_key(metapackages, plan.get('status'),
+                                   plan.get('candidates')):
+        return False
+    if plan['status'] is None or plan['status'] != file_digest(status_file):
+        return False
+
+    paths = logscan.newest_first(set(
+        entry['path'] for metapackage in metapackages
+        for entry in index.lookup(metapackage)))
+    found = list(transactions.read(paths, metapackages))
+    d, chosen = transactions.locate(found, metapackages)
+    if None in chosen.values():
+        return False
+
+    return candidates_digest(d) == plan['candidates']
+
+
+def load(path):
+    '''Reads a plan written by save(); None if there is none or it can't
+    be read. Unlike the caches, no lock file is taken: plans sit on shares
+    that are often read-only, and save() replaces the file with a single
+    rename, so it is never seen half written.'''
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save(path, plan):
+    '''Writes plan to path, atomically, so that machines reading it never
+    see half of it; the file can be read by everyone.
+
+    Raises IOError or OSError if path can't be written, eg. a read-only
+    share.
+    '''
+
+    cache.write_json(path, plan)
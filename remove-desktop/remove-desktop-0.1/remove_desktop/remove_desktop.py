@@ -26,55 +26,87 @@ Uninstall metapackages like desktop packages which have a lot of dependencies:
 gnome-desktop, xubuntu-desktop, lubuntu-desktop, kubuntu-desktop, etc.
 
 Usage:
-    remove_desktop [options] <metapackage>
+    remove_desktop [options] <metapackage>...
     remove_desktop -h | --help
     remove_desktop -v | --version
 
 Arguments:
-    <metapackage>    the name of the metapackage(Eg. gnome-desktop)
+    <metapackage>    the name of the metapackage(Eg. gnome-desktop); give
+                     several names to remove them all with a single purge.
 
 Options:
     -h --help      Show this screen.
     -v --version   Show program version.
     -t --test      Just test the script is working, don't remove anything.
+    -j N --jobs=N  Read N compressed logs at once and run N apt-cache
+                   queries at once, when dpkg's status file can't be read.
+                   Defaults to the number of CPUs.
+    --metrics=FILE Write the time taken by every phase, the processes
+                   started and the peak memory used to FILE, as JSON.
+    --plan=FILE    Purge what the plan in FILE says if it was computed on an
+                   identical machine; otherwise compute the plan and save it
+                   to FILE for the next machines.
+    --record=FILE  Save the questions asked to apt and dpkg and their
+                   answers to FILE, a gzipped archive.
+    --replay=FILE  Answer the questions from an archive saved by --record
+                   instead of asking apt and dpkg, and read the status file
+                   and logs it holds; doesn't need root rights, the index
+                   and cache are kept in a temporary directory.
 
 Eg:
     remove_desktop kubuntu-desktop
     remove_desktop xubuntu-desktop
     remove_desktop -t openbox
+    remove_desktop kubuntu-desktop smb4k
+    remove_desktop --plan=/srv/plans/xubuntu.json xubuntu-desktop
+    remove_desktop -t --replay=xubuntu.json.gz xubuntu-desktop
 """
 
 import logging
 from logging import INFO, DEBUG
 import sys
 import os                        # needed to check if root runs the script
-import re
+import atexit
+import time
+import shutil
+import tempfile
 import collections               # OrderedDict
-import subprocess
-import decimal
-
-# Third party libraries
-import docopt                    # creates the command line interface
-import sh
-from sh import glob   # always use sh.glob() instead of glob.glob()
-# sh -> subprocess interface for Python that allows you to call any program as
-# if it were a function
-import colorlog                         # Colorize log text
+import glob
+import functools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# Third party libraries are imported where they are used, so that --help or
+# a dry look at the logs don't pay for them:
+# docopt -> creates the command line interface
+# sh -> subprocess interface for Python that allows you to call any program
+# as if it were a function
+# colorlog -> Colorize log text
 
 # Own modules
 import utils
+import dpkg_status
+import depgraph
+import cache as cache_module
+import logscan
+import logindex
+import transactions
+import metrics
+import plans
+import backends
+from backends import split_rdepends
 
 
-__all__ = ["defaults", "Locator", "validator", "parser", "parser_stage_2",
-           "worker"]
+__all__ = ["defaults", "Locator", "validator", "parser", "split_rdepends",
+           "rdepends", "parser_stage_2", "worker"]
 
 
 def __dir__():
     '''This method will be called by dir() and must return the list of
     attributes. This defines the interface of this module.'''
 
-    return ["defaults", "Locator", "validator", "parser", "parser_stage_2",
-            "worker"]
+    return ["defaults", "Locator", "validator", "parser", "split_rdepends",
+            "rdepends", "parser_stage_2", "worker"]
 
 
 ### SOME DEFAULT CONFIGURATION ###
@@ -83,17 +115,25 @@ defaults = {'log_level': 'DEBUG',
             'path': "/var/log/apt/history*",
             'conf_file': 'main.conf',
             'log_file': 'out.log',
+            'status_file': "/var/lib/dpkg/status",
+            'cache_file': "/var/cache/remove-desktop/rdepends.json",
+            'index_file': "/var/cache/remove-desktop/history.json",
             }
 
 # 'log_level'    just 2 levels: DEBUG or INFO
 # 'path'         path to pkg manager's log files
 # 'conf_file'    config file user can edit
 # 'log_file'     app's log file
+# 'status_file'  dpkg's database of packages
+# 'cache_file'   reverse dependencies remembered between runs
+# 'index_file'   index of package manager's log files
 
 
 class Locator(object):
-    def __init__(self):
+    def __init__(self, jobs=1):
         super(Locator, self).__init__()
+        self.jobs = jobs
+        '''jobs is how many log files are decompressed at once.'''
         self.paths = []
         '''paths holds paths to package managers log files.'''
         self.main_line = ""
@@ -102,62 +142,133 @@ class Locator(object):
         command of the form:
         Install: lightdm-gtk-greeter:i386 (1.3.1-0ubuntu1), ...
         '''
-        self.installation_lines = []
+        self.main_lines = collections.OrderedDict()
+        '''
+        main_lines holds the installation line of every metapackage
+        given to .locate(); main_line is the one of the first.
         '''
-        Holds possible main_line candidates, only one of them is the
-        installation command line.
+
+    def lines(self, package, path, index=None):
+        '''Returns an iterator over the lines of files in path, a shell
+        glob, that mention package, read one at a time like zgrep prints
+        them.
+
+        index -> a logindex.HistoryIndex of the files in path; if given,
+                 only the lines that installed package are read, newest
+                 first, straight from the logs instead of searching them.
         '''
 
-    def search(self, package, path):
-        '''Looks for package in files in path using zgrep shell binary.'''
+        if index is not None:
+            return index.lines(package, ('Install',))
+        return logscan.scan(package, path, jobs=self.jobs)
 
+    def search(self, package, path, index=None, verbose=False):
+        '''Looks for the installation command line of package in files in
+        path, a shell glob, and returns it; the newest one if package was
+        installed several times. Lines are read lazily, newest first, and
+        the search stops as soon as the line is found, so the older files
+        are not read and nothing is kept in memory.
+
+        index -> see .lines()
+        verbose -> print every matching line read on the way
+        '''
+
+        lines = self.lines(package, path, index)
+        if verbose:
+            lines = self._echo(lines)
         try:
-            log_lines = sh.zgrep(package, glob(path))
-        except sh.ErrorReturnCode_1 as e:      # buffer overflown??
-            # don't know why this happens when using sh.
-            log_lines = e.stdout
+            line = self._check(lines)
+        finally:
+            # close the files that were left half read:
+            if hasattr(lines, 'close'):
+                lines.close()
+
+        if line is None:
+            logger.critical("The line with the package installation command "
+                            "was not found. Exiting...")
+            sys.exit()
+
+        self.main_line = line
+        return line
+
+    def locate(self, packages, path, index=None):
+        '''Reads the transactions in files in path, a shell glob, that
+        list any of packages and returns the packages installed together
+        with them, as parser() does: an OrderedDict
+        package name -> (arch, version).
+
+        packages -> a metapackage name or a list of them; the logs are read
+                    only once for all of them.
+
+        The installing transaction is the one whose command line asked for
+        a package; if a package was installed several times, all those
+        transactions are merged, see transactions.merge().
+
+        index -> a logindex.HistoryIndex of the files in path; if given,
+                 only files that mention packages are read.
+        '''
 
-        log_lines = log_lines.split("\n")
-        # get all but the last line -> get rid of last '' empty line
-        log_lines = log_lines[:-1]
+        if isinstance(packages, basestring):
+            packages = [packages]
 
-        for line in log_lines:
-            #logger.debug("Following line was found:\n%s" % line)
+        if index is not None:
+            paths = logscan.newest_first(set(
+                entry['path'] for package in packages
+                for entry in index.lookup(package)))
+        else:
+            paths = logscan.newest_first(glob.glob(path))
+
+        # read the logs once, select and merge from memory; unlike
+        # .search(), every file is needed: merge() goes back to the first
+        # installation.
+        found = list(transactions.read(paths, packages, self.jobs))
+        d, installing = transactions.locate(found, packages)
+        for package, chosen in installing.items():
+            if chosen is None:
+                logger.critical("The line with the installation command of "
+                                "'%s' was not found. Exiting..." % package)
+                sys.exit()
+
+            self.main_lines[package] = chosen.line('Install')
+            logger.info("The transaction that installed '%s' was found: "
+                        "%s, '%s'" % (package, chosen.start_date,
+                                      chosen.commandline))
             logger.debug("Following line containing metapackage was found "
                          "in package manager's log files:")
-            print(line)
-            self.installation_lines.append(line)
+            echo(self.main_lines[package])
 
-        if not self.installation_lines:
-            logger.info("zgrep could not find in logs any info that ",
-                        "can be used to uninstall the package.",
-                        "Exiting...")
-            sys.exit()
-        else:
-            logger.info("Search results from zgrep where collected.")
+            cycles = len([t for t in found if package in t.install])
+            if cycles > 1:
+                logger.info("'%s' was installed %s times, merging what was "
+                            "installed every time." % (package, cycles))
+
+        self.main_line = self.main_lines[packages[0]]
+        return d
 
-        self._check()
-        return self.main_line
+    @staticmethod
+    def _echo(lines):
+        '''Prints lines as they pass by.'''
 
-    def _check(self):
-        '''Parses self.installation_lines and decides based on hints which
-        one is the self.main_line. Called by .search()'''
+        for line in lines:
+            logger.debug("Following line containing metapackage was found "
+                         "in package manager's log files:")
+            echo(line)
+            yield line
+
+    def _check(self, lines):
+        '''Decides based on hints which one of lines is the installation
+        command line and returns it, None if there is none. Lines after it
+        are not read. Called by .search()'''
         # checker should be an object which has different hints as properties
         # & methods => self.checker = Checker()
         # hints can be tests based on unittest.TestCase
-        for line in self.installation_lines:
-            match = re.search('Install: ', line)
-            if match:
+        for line in lines:
+            if logscan.is_install_line(line):
                 logger.info("The line with the package installation command "
                             "was found.")
-                self.main_line = line
-                return
-            else:
-                continue
+                return line
 
-        logger.critical("The line with the package installation command "
-                        "was not found. Exiting...")
-        sys.exit()
+        return None
 
 
 def validator(package):
@@ -170,54 +281,161 @@ def validator(package):
 
 
 def parser(line):
-    '''Sanitizes the line and returns a string only of package names.'''
-
-    # trim the filename by substituting it with an empty space:
-    pattern = r'.*:Install: '
-    line = re.sub(pattern, '', line)
-
-    sequence = re.finditer(r"""
-        # blanks are ignored inside pattern because of re.VERBOSE
-        (?P<pkg_name>[a-zA-Z0-9._-]+ | [^:\s]+):     # Eg.  lightdm-gtk-greeter:
-        (?P<arch>i?\d{3} | amd64) [ ]                # Eg. 'i386 ' notice one blank ' '
-        \( (?P<version>.*?) \),?            # Eg.  (1.3.1-0ubuntu1), or
-                                            # (1.3.1-0ubuntu1)  without
-                                            # trailing comma(last in the line)
-        # in first group, A | B was used, where A, B are regexs. B catches all
-        # weird package names that don't contain ':' or any whitespace
-        """, line, flags=re.VERBOSE)
+    '''Returns an OrderedDict of the packages in an 'Install:' line:
+    package name -> (arch, version)
+
+    Eg. for the line:
+    /var/log/apt/history.log.7.gz:Install: lightdm-gtk-greeter:i386 (1.3.1-0ubuntu1), pidgin-libnotify:i386 (0.14-4ubuntu11, automatic)
+    it returns:
+    OrderedDict([('lightdm-gtk-greeter', ('i386', '1.3.1-0ubuntu1')),
+                 ('pidgin-libnotify', ('i386', '0.14-4ubuntu11, automatic'))])
+    '''
+
+    # skip the filename without copying the rest of the line; lines can
+    # have thousands of packages.
+    start = line.find('Install: ')
+    start = start + len('Install: ') if start != -1 else 0
 
     # preserve same order as found in apt archives/log files:
     d = collections.OrderedDict()
-    for match in sequence:
-        key = match.group('pkg_name')
+    for key, arch, version in transactions.ENTRY.findall(line, start):
         # TODO: validator(key)
-        d[key] = match.groups()[1:]
+        d[key] = (arch, version)
 
     return d
 
 
+def rdepends(packages):
+    '''Looks up the reverse dependencies of all packages at once, with the
+    package system backend; with the subprocess backend, that's a single
+    `apt-cache rdepends` call instead of one call per package.
+
+    Returns an OrderedDict: package name -> list of reverse dependencies,
+    in the same order as packages. Packages unknown to apt-cache are left
+    out, the caller decides what to do about them.
+    '''
+
+    return backend.rdepends(packages)
+
+
+def installed_rdepends(packages, installed):
+    '''Looks up the reverse dependencies of packages with rdepends() and
+    keeps only the installed ones.
+
+    installed -> a dictionary shared between calls, it remembers what
+                 is_installed() said about every reverse dependency.
+
+    Returns (packages, OrderedDict as returned by rdepends()).
+    '''
+
+    start = time.time()
+    found = rdepends(packages)
+    for package, rdeps in found.items():
+        for rdep in rdeps:
+            if rdep not in installed:
+                # apt-cache rdepends shows uninstalled packages too!
+                # but we need only installed ones.
+                installed[rdep] = is_installed(rdep)
+        found[package] = [rdep for rdep in rdeps if installed[rdep]]
+
+    # packages are looked up together, each one takes its share:
+    latency = (time.time() - start) / max(1, len(packages))
+    for package in packages:
+        metrics.current.sample('package latency', latency)
+
+    return packages, found
+
+
+def apt_cache_graph(packages, jobs=1, cache=None):
+    '''Builds a DependencyGraph of packages and their installed reverse
+    dependencies using `apt-cache rdepends` and is_installed(), for systems
+    where dpkg's status file can't be read.
+
+    jobs -> number of threads; packages are split in chunks and every
+            thread looks up one chunk at a time with a single apt-cache call.
+    cache -> a cache.RdependsCache; only packages it doesn't know about
+             are looked up, and their answers are saved in it.
+    '''
+
+    # package -> installed reverse dependencies, None if apt-cache doesn't
+    # know the package:
+    results = {}
+    todo = []
+    miss = cache_module.RdependsCache.MISS
+    for package in packages:
+        rdeps = cache.get(package) if cache else miss
+        if rdeps is miss:
+            todo.append(package)
+        else:
+            results[package] = rdeps
+    err_counter = len([p for p in results if results[p] is None])
+
+    # a few chunks per thread, so the progress bar moves and threads that
+    # finish early get more work:
+    size = max(1, len(todo) // (jobs * 4))
+    chunks = [todo[i:i + size] for i in range(0, len(todo), size)]
+    # ask only once about every reverse dependency:
+    installed = {}
+    task = functools.partial(installed_rdepends, installed=installed)
+
+    ### Print a progress bar, as computing what packages to remove takes time
+    progress = utils.ProgressBar(len(packages), stream=outputter)
+    progress.advance(len(packages) - len(todo))
+
+    pool = ThreadPool(jobs)
+    try:
+        if err_counter > 2:
+            logger.error("Too many package naming errors, exiting...")
+            sys.exit()
+
+        for chunk, found in pool.imap_unordered(task, chunks):
+            progress.advance(len(chunk))
+            for package in chunk:
+                results[package] = found.get(package)
+                if cache:
+                    cache.put(package, results[package])
+            # 'No packages found' for these packages
+            # this occurs if repositories have changed, old pkg was removed
+            # or parser() didn't get the correct name -> regex's <pkg_name>
+            # group character range is incomplete -> it doesn't contain
+            # the character in the package name.
+            # In this case, no neighbouring package names are wrong.
+            # Well, when we're talking about tens or hundreds of pkgs, just
+            # a couple of them can be ignored.
+            err_counter += len([p for p in chunk if p not in found])
+            if err_counter > 2:
+                logger.error("Too many package naming errors, exiting...")
+                sys.exit()
+    finally:
+        pool.terminate()
+        if cache:
+            cache.save()
+
+    progress.done()
+
+    # chunks finish in any order, keep the order parser() produced:
+    graph = depgraph.DependencyGraph()
+    for package in packages:
+        for rdep in results[package] or ():
+            graph.add_installed(rdep)
+            graph.add_edge(rdep, package)
+
+    return graph
+
+
 def is_installed(package):
     '''
-    Tell if a package is installed on the system or not.
+    Tell if a package is installed on the system or not, asking the package
+    system backend.
     In a shell you can tell using this:
     $: dpkg-query -l | grep <package>
     If output is empty => package isn't installed
     '''
-    try:
-        subprocess.check_output("dpkg-query -l | grep '%s'" % package,
-                                shell=True)
-        # if above doesn't raise an exception => package is installed
-        return True
-    except subprocess.CalledProcessError:
-        # usually, this exception is raised when output of cmd if None
-        # so this means that package is not installed
-        pass
 
-    return False
+    return backend.is_installed(package)
 
 
-def parser_stage_2(rdeps, packages, callback=is_installed):
+def parser_stage_2(rdeps, packages, callback=None):
     '''Find which packages can't be removed because are needed as dependencies
     for packages that you don't want to remove.
 
@@ -226,6 +444,8 @@ def parser_stage_2(rdeps, packages, callback=is_installed):
     callback -> introduced to make testing easy. In real case scenario,
                 callback can be a fct. that checks if a package is installed,
                 when testing, it can be a fct. that tells whatever you want.
+                By default, it is an index of installed packages read once
+                from defaults['status_file'].
 
     One way to find packages that can't be removed is to use:
     $: apt-cache rdepends <package>
@@ -263,6 +483,9 @@ def parser_stage_2(rdeps, packages, callback=is_installed):
     if not rdeps:
         return "remove"
 
+    if callback is None:
+        callback = dpkg_status.installed_index(defaults['status_file'])
+
     for p in rdeps:
         if p in packages:
             # if p is going to be removed anyway, its dependencies will
@@ -280,7 +503,8 @@ def parser_stage_2(rdeps, packages, callback=is_installed):
 
 
 def worker(packages):
-    '''Executes sudo apt-get purge package_names'''
+    '''Executes sudo apt-get purge package_names, through the package
+    system backend.'''
 
     # Some stats:
     logger.info('A total number of %s packages will be purged.' %
@@ -289,45 +513,55 @@ def worker(packages):
     #logger.debug('These are:\n %s \n\n' % ' '.join(packages))
     # bypass logger.debug above to print text white:
     logger.debug('These are:')
-    print(' '.join(packages))
+    echo(' '.join(packages))
 
     logger.info('The rest will be kept because are needed as dependencies '
                 'for packages that you want to keep.')
 
-    with sh.sudo:
-        """
-        If you use sudo, the user executing the script must have the
-        NOPASSWD option set for whatever command that user is running,
-        otherwise sudo will hang.
-        Solution to bypass the NOPASSWD option:
-        run the script that contains the sh.sudo command with sudo and
-        enter the password.
-        """
-
-        try:
+    # apt-get's output goes to the console and to the log file in big
+    # blocks, see utils.StreamSink:
+    sink = utils.StreamSink(outputter or sys.stdout)
+    try:
+        with sink:
             if not arguments['--test']:
                 logger.info("Purging...")
-                sh.apt_get("--assume-yes", "--ignore-missing", "purge",
-                           packages,
-                           _out=outputter)    # _out=sys.stdout
-            # sh.apt_get(list_of_package_names_not_string)
-            # if package names have changed since they were installed, apt-get
-            # will raise error: 'Can't locate package ...' so we use
-            # --ignore-missing.
-            # _out=sys.stdout to let the original output of underlying cmd
-            # to be visible
-            # OR
-            # _out=utils.Tee(file_handler.stream) to write to console and to file.
             else:
                 logger.info("Testing purging...")
-                sh.apt_get("--simulate", "--ignore-missing", "purge",
-                           packages,  _err_to_out=True,
-                           _out=outputter)   # utils.Tee(file_handler.stream))
-        except sh.ErrorReturnCode as e:
-            logger.critical(e)
+            backend.purge(packages, sink, simulate=arguments['--test'])
+    except backends.PurgeError as e:
+        logger.critical("apt-get failed with exit code %s, it last "
+                        "wrote:\n%s" % (e.exit_code, sink.tail()))
+    except backends.NotRecorded as e:
+        not_recorded(e)
+
+
+def not_recorded(error):
+    '''Stops a --replay run that asked a question the recorded run didn't,
+    error being the backends.NotRecorded raised.'''
 
+    question, packages = error.args
+    logger.critical("The recorded run wasn't asked %s about %s: record it "
+                    "again with the same metapackages and options. "
+                    "Exiting..." % (question, packages))
+    sys.exit(1)
+
+
+def set_up_logging(default_level, log_file, stdout=None):
+    '''Returns (the logger, a started utils.QueueListener).
+
+    The logger only puts records in a queue; the listener writes them to the
+    console and to log_file in a background thread, together with the text
+    written to a utils.QueueWriter of listener.queue, which goes to stdout
+    (sys.stdout by default) and log_file.
+    '''
+
+    import colorlog
+    import Queue
+
+    class ColoredColumnFormatter(utils.ColumnFormatter,
+                                 colorlog.ColoredFormatter):
+        '''utils.ColumnFormatter with colors, for the command line.'''
 
-def set_up_logging(default_level, log_file):
     logger = logging.getLogger('Main')
     # Set default log level; DEBUG -> most detailed level
     logger.setLevel(default_level)
@@ -335,27 +569,17 @@ def set_up_logging(default_level, log_file):
     ### SET UP A CONSOLE HANDLER ###
     # Handlers send the log records (created by loggers) to the appropriate
     # destination: a console, a file, over the internet, by email, etc.
-
-    # This line enables pretty printing of log messages:
-    logging.StreamHandler.emit = utils.emit
-    # all classes that inherit StreamHandler, eg. FileHandler, etc. will use it
-
-    console_handler = logging.StreamHandler()       # stream -> sys.stdout
+    console_handler = logging.StreamHandler()       # stream -> sys.stderr
 
     # Formatters specify the layout of log records in the final output.
     # Set formatter for Stream Handler to colorize text for the command line.
-    #message_format = '%(asctime)s %(funcName)s: %(levelname)s - %(message)s'
-    message_format = "%(yellow)s %(asctime)s %(purple)s %(funcName)s: " +\
-                     "%(log_color)s %(levelname)s %(reset)s %(blue)s " +\
-                     "%(message)s"
+    message_format = "%(yellow)s%(asctime)s %(purple)s%(func_column)s " +\
+                     "%(log_color)s%(level_column)s%(reset)s %(blue)s" +\
+                     "%(message)s%(reset)s"
     # the syntax of message_format accepts colors, unlike python's std format.
-    formatter = colorlog.ColoredFormatter(message_format,
-                                          datefmt=None,
-                                          reset=True,
-                                          )
-
+    formatter = ColoredColumnFormatter(message_format, datefmt=None,
+                                       reset=True)
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
 
     ###  SET UP A HANDLER THAT LOGS TO FILE ###
     file_handler = logging.FileHandler(filename=log_file, mode='w')
@@ -364,13 +588,34 @@ def set_up_logging(default_level, log_file):
     #file_handler.setLevel(logging.DEBUG)
 
     # Set formatter for File Handler
-    message_format = '%(asctime)s %(funcName)s: %(levelname)s %(message)s'
-    formatter = logging.Formatter(fmt=message_format)
+    message_format = '%(asctime)s %(func_column)s %(level_column)s %(message)s'
+    file_handler.setFormatter(utils.ColumnFormatter(fmt=message_format))
+
+    ### HAND RECORDS TO A BACKGROUND THREAD ###
+    log_queue = Queue.Queue()
+    logger.addHandler(utils.QueueHandler(log_queue))
+    listener = utils.QueueListener(log_queue,
+                                   [console_handler, file_handler],
+                                   [stdout or sys.stdout, file_handler.stream])
+    listener.start()
+
+    return logger, listener
+
+
+# Where echo() writes: the script sets it to a utils.QueueWriter, so that
+# the text reaches both the console and the log file.
+outputter = None
+
+
+# Answers the questions about packages; the script picks the fastest
+# backend available, see backends.default().
+backend = backends.SubprocessBackend()
 
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
 
-    return logger
+def echo(text):
+    '''Prints text to outputter, or to sys.stdout if it isn't set.'''
+
+    (outputter or sys.stdout).write('%s\n' % text)
 
 
 ## MAIN ##
@@ -382,139 +627,167 @@ if __name__ == '__main__':
 
     # Create a beautiful CLI interface from the help string, in this case, __doc__
     # and read the script arguments
+    import docopt
     arguments = docopt.docopt(__doc__, help=True, version="Remove Desktop 0.1")
     # script is stopped here by docopt if called with wrong arguments
 
-    # for all use cases other than --help, --version, run as root:
-    if os.geteuid() != 0:
+    jobs = arguments['--jobs'] or str(multiprocessing.cpu_count())
+    if not jobs.isdigit() or int(jobs) < 1:
+        print("--jobs must be a positive number.")
+        sys.exit(1)
+    jobs = int(jobs)
+
+    # for all use cases other than --help, --version, --replay, run as root:
+    if os.geteuid() != 0 and not arguments['--replay']:
         print("sorry, you need to run this as root user.")
         sys.exit(1)
 
-    logger = set_up_logging(defaults['log_level'], defaults['log_file'])
+    logger, listener = set_up_logging(defaults['log_level'],
+                                      defaults['log_file'])
+    # write what is still queued when the program ends, even with sys.exit():
+    atexit.register(listener.stop)
 
     # Create a file like obj. that writes both to sys.stdout(as 'print' does) and
-    # to log file:
-    file_handler = logger.handlers[1]
-    outputter = utils.Tee(file_handler.stream)
-    # from now on, every time 'print' is used, outputter is used.
+    # to log file, in order with the log records:
+    outputter = utils.QueueWriter(listener.queue)
+    # from now on, echo() writes to outputter.
 
     # read user config from file, thus updating default config:
-    if os.path.exists(defaults['conf_file']):
-        conf = utils.read_config(logger, defaults['conf_file'], defaults)
-    else:
-        print('no config file found')
-        conf = defaults      # shallow copy!
+    with metrics.current.phase('config'):
+        if os.path.exists(defaults['conf_file']):
+            conf = utils.read_config(logger, defaults['conf_file'], defaults)
+        else:
+            echo('no config file found')
+            conf = defaults      # shallow copy!
 
     logger.setLevel(conf['log_level'])
 
-    metapackage = arguments['<metapackage>']
-    logger.debug('metapackage argument: %s' % metapackage)
+    if arguments['--replay']:
+        backend = backends.ReplayBackend(arguments['--replay'])
+        # the recorded machine's files, and an index and a cache that
+        # leave this machine's alone:
+        replay_dir = tempfile.mkdtemp(prefix='remove-desktop-replay-')
+        atexit.register(shutil.rmtree, replay_dir, True)
+        status_file, path = backend.restore(replay_dir)
+        conf = dict(conf, status_file=status_file, path=path,
+                    index_file=os.path.join(replay_dir, 'history.json'),
+                    cache_file=os.path.join(replay_dir, 'rdepends.json'))
+    else:
+        backend = backends.default()
+        if arguments['--record']:
+            backend = backends.RecordingBackend(backend)
+            backend.record_status(conf['status_file'])
+            # save what was asked even if the run stops with sys.exit():
+            atexit.register(backend.save, arguments['--record'])
+    logger.debug("Asking the package system through the '%s' backend." %
+                 backend.name)
+
+    metapackages = arguments['<metapackage>']
+    logger.debug('metapackage arguments: %s' % ' '.join(metapackages))
 
     ### look up package with `apt-cache search` and if it doesn't find it, say
     ### package name is invalid, but try to show suggestions; create a validate fct.
-    loc = Locator()
-    results = loc.search(metapackage, conf['path'])
-    d = parser(results)
-
-    # Some stats:
-    logger.info('A total number of %s packages were installed.' % len(d.keys()))
-    #logger.debug('These are:\n' + ' '.join(d.keys()))
-    logger.debug('These are:')
-    print(' '.join(d.keys()))
-
-    logger.info("Computing what packages to remove and what to keep in order "
-                "not to break packages that need them as dependencies:")
-    packages = d.keys()
-
-    # TODO: validator(packages) -> show which ones are wrong.
-
-    # storage for packages that will be removed:
-    obsolete = []
-
-    ### Print a progress bar, as computing what packages to remove takes time
-    #########################################################################
-    # this progress bar is for smaller identical tasks of known quantity
-    # Ref:
-    # http://thelivingpearl.com/2012/12/31/creating-progress-bars-with-python/
-
-    # Progress bar will have a resolution of 5% = 5/100 = 1/20
-    # resolution will be: res = len(packages) / 20
-    res = decimal.Decimal(len(packages)) / 20
-    # If we have 95 packages, for 5%, res will be 4.75
-    # Theoretically, for every 4.75 packages handled by task, progress
-    # bar increases. In practice, progress bar increases every
-    # int(4.75 * i) where i in range(1,21)
-    marks = (int(res * i) for i in range(1, 21))
-    i = marks.next()
-
-    # if it fills for every 20% completion time, uncomment below:
-    print 'Computing [                    ]',
-    print '\b' * 22,
-    sys.stdout.flush()
-
-    # if it fills for every 10% completion time, uncomment below:
-    #print 'Starting [          ]',
-    #print '\b' * 12,
-
-    # adjust according to n; if n=10 => '\b' * 12
-    # , (comma) suppresses carriage return(Enter) for python <= 2.7.5
-    # The special character \b returns the printing cursor one
-    # step backwards
-
-    for index, package in enumerate(packages):
-        err_counter = 0
-        try:
-            rdeps = sh.apt_cache.rdepends(package)
-        except sh.ErrorReturnCode_100 as e:
-            # catch 'No packages found' error
-            # this occurs if repositories have changed, old pkg was removed
-            # or parser() didn't get the correct name -> regex's <pkg_name>
-            # group character range is incomplete -> it doesn't contain
-            # the character in the package name.
-            # In this case, no neighbouring package names are wrong.
-            # Well, when we're talking about tens or hundreds of pkgs, just
-            # a couple of them can be ignored.
-            err_counter += 1
-            continue
-        finally:
-            if err_counter > 2:
-                logger.error("Too many package naming errors, exiting...")
-                sys.exit()
-
-        '''
-        >>> rdeps.stdout.split("\n")
-        ['abiword-plugin-mathview',
-        'Reverse Depends:',
-        '  xubuntu-desktop',
-        '  abiword',
-        '']
-        '''
-        # get all lines but the first 2:
-        rdeps = rdeps.stdout.split("\n")[2:-1]
-        rdeps = [pkg.lstrip() for pkg in rdeps]
-        '''
-        >>> rdeps
-        ['xubuntu-desktop', 'abiword']
-        '''
-        # this is the smaller, identical task for all packages:
-        flag = parser_stage_2(rdeps, packages)
-
-        if flag == "remove":
-            obsolete.append(package)
-
-        # Increase progress bar with 1 unit
-        if index + 1 == i:
-            print '\b.',
-            sys.stdout.flush()
-            try:
-                i = marks.next()
-            except StopIteration:
-                pass
+    # read only the log lines that were added since the last run:
+    with metrics.current.phase('index'):
+        index = logindex.HistoryIndex(conf['index_file']).update(
+            conf['path'], jobs)
+        index.save()
+
+    # a plan computed on an identical machine:
+    plan = None
+    if arguments['--plan']:
+        with metrics.current.phase('plan'):
+            plan = plans.load(arguments['--plan'])
+            if plans.matches(plan, metapackages, conf['status_file'], index):
+                logger.info("The plan in '%s' was computed on an identical "
+                            "machine, applying it." % arguments['--plan'])
+            elif plan is not None:
+                logger.info("The plan in '%s' was computed on another "
+                            "machine, computing a new one." %
+                            arguments['--plan'])
+                plan = None
+
+    if plan is not None:
+        obsolete = plan['obsolete']
+        logger.info('%s packages will be kept because are needed as '
+                    'dependencies.' % len(plan['kept']))
+    else:
+        loc = Locator(jobs)
+        # packages installed by any of the metapackages; they are
+        # classified together so a package needed only by another
+        # metapackage is removed too.
+        with metrics.current.phase('locate'):
+            d = loc.locate(metapackages, conf['path'], index)
+
+        # Some stats:
+        logger.info('A total number of %s packages were installed.' %
+                    len(d.keys()))
+        #logger.debug('These are:\n' + ' '.join(d.keys()))
+        logger.debug('These are:')
+        echo(' '.join(d.keys()))
+
+        logger.info("Computing what packages to remove and what to keep in "
+                    "order not to break packages that need them as "
+                    "dependencies:")
+        packages = d.keys()
+
+        # TODO: validator(packages) -> show which ones are wrong.
+
+        with metrics.current.phase('graph'):
+            if os.path.exists(conf['status_file']):
+                # dpkg's database already knows who depends on whom among
+                # installed packages, no need to ask apt-cache:
+                graph = depgraph.DependencyGraph.from_status(
+                    conf['status_file'])
+            else:
+                logger.info("'%s' was not found, asking apt-cache instead." %
+                            conf['status_file'])
+                rdepends_cache = cache_module.RdependsCache(
+                    conf['cache_file'],
+                    [conf['status_file'], cache_module.APT_LISTS])
+                try:
+                    graph = apt_cache_graph(packages, jobs, rdepends_cache)
+                except backends.NotRecorded as e:
+                    not_recorded(e)
+                logger.info("Reverse dependencies cache: %s hits, %s "
+                            "misses." % (rdepends_cache.hits,
+                                         rdepends_cache.misses))
+
+        # storage for packages that will be removed:
+        with metrics.current.phase('classify'):
+            obsolete = depgraph.classify(packages, graph)
+
+        if arguments['--plan']:
+            if os.path.exists(conf['status_file']):
+                try:
+                    plans.save(arguments['--plan'],
+                               plans.build(metapackages, d, obsolete, graph,
+                                           conf['status_file']))
+                    logger.info("The plan was saved to '%s'." %
+                                arguments['--plan'])
+                except (IOError, OSError) as e:
+                    # eg. a read-only share; the purge goes on
+                    logger.error("The plan can't be saved to '%s': %s" %
+                                 (arguments['--plan'], e))
+            else:
+                logger.warning("The plan can't be saved without '%s'." %
+                               conf['status_file'])
 
-    print '\b] Done!'
-    print
+    if isinstance(backend, backends.RecordingBackend):
+        # what a replay reads instead of this machine's logs, read again
+        # before the purge adds a transaction to them:
+        paths = set(entry['path'] for metapackage in metapackages
+                    for entry in index.lookup(metapackage))
+        backend.record_logs(transactions.read(logscan.newest_first(paths),
+                                              metapackages))
 
     if obsolete:
-        worker(obsolete)
+        with metrics.current.phase('worker'):
+            worker(obsolete)
+
+    logger.info("Where the time went:")
+    echo(metrics.current.summary())
+    if arguments['--metrics']:
+        metrics.current.save(arguments['--metrics'])
 
     logger.info("Program terminated")
@@ -0,0 +1,355 @@
+### Library file ###
+
+
+#=============================================================================
+# Copyright: 2013 Andrei Chiver andreichiver@gmail.com
+# License: GPL-3
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  On Debian systems, the complete text of the GNU General
+#  Public License version 3 can be found in "/usr/share/common-licenses/GPL-3".
+#=============================================================================
+
+
+"""
+Reads apt's history logs as transactions instead of single lines.
+
+Every transaction is a block of lines:
+
+    Start-Date: 2014-03-25  09:50:02
+    Commandline: apt-get install smb4k
+    Requested-By: andrei (1000)
+    Install: smb4k:amd64 (1.0.7-1ubuntu1), libkdecore5:amd64 (...), ...
+    Upgrade: ...
+    Remove: ...
+    Purge: ...
+    End-Date: 2014-03-25  09:50:07
+"""
+
+import re
+import collections
+
+import logscan
+
+
+# One entry of a package list, compiled once:
+# 'smb4k:amd64 (1.0.7-1ubuntu1)' or, in old logs, 'smb4k (1.0.7-1ubuntu1)'
+# groups: name, arch, version (eg. '0.14-4ubuntu11, automatic')
+ENTRY = re.compile(r'([^\s:,()]+)(?::([\w-]+))? \(([^)]*)\)')
+
+AUTOMATIC = ', automatic'
+
+# transaction lines that list packages:
+LISTS = ('Install', 'Upgrade', 'Remove', 'Purge')
+
+
+def parse_packages(value):
+    '''Parses the value of an 'Install:', 'Remove:', etc. line into the
+    same OrderedDict parser() returns:
+    package name -> (arch, version)
+    '''
+
+    d = collections.OrderedDict()
+    for name, arch, version in ENTRY.findall(value):
+        # a few architectures, shared by thousands of entries:
+        d[name] = (intern(arch), version)
+    return d
+
+
+def tokenize(chunks):
+    '''Yields (name, arch, version, automatic) for every entry of a package
+    list that comes in pieces, eg. a huge 'Install:' line read from a file
+    64 KB at a time:
+    >>> list(tokenize(['Install: pidgin-libnotify:i386 (0.14-4ub',
+    ...                'untu11, automatic), xchat:i386 (2.8.8-7)']))
+    [('pidgin-libnotify', 'i386', '0.14-4ubuntu11', True),
+     ('xchat', 'i386', '2.8.8-7', False)]
+
+    Only the text after the last complete entry is carried over to the
+    next chunk; an entry cut in two is matched once the rest of it comes.
+    parser() and parse_packages() keep the flag in the version string, as
+    their callers expect.
+    '''
+
+    finditer = ENTRY.finditer
+    tail = ''
+    for chunk in chunks:
+        buf = tail + chunk if tail else chunk
+        end = 0
+        for match in finditer(buf):
+            # '' for old logs without architectures, as findall() gives
+            name, arch, version = match.groups('')
+            if version.endswith(AUTOMATIC):
+                yield name, arch, version[:-len(AUTOMATIC)], True
+            else:
+                yield name, arch, version, False
+            end = match.end()
+        tail = buf[end:]
+
+
+class Transaction(object):
+    '''One apt transaction. Package lists are kept as they were written in
+    the log and parsed only when they are asked for, through .install,
+    .upgrade, .remove and .purge.'''
+
+    __slots__ = ('path', 'start_date', 'end_date', 'commandline',
+                 'requested_by', 'lists')
+
+    def __init__(self, path=None):
+        self.path = path
+        '''path holds the log file the transaction was read from.'''
+        self.start_date = None
+        self.end_date = None
+        self.commandline = None
+        self.requested_by = None
+        self.lists = {}
+        ''''Install', 'Remove', etc. -> the raw list of packages'''
+
+    @property
+    def install(self):
+        return parse_packages(self.lists.get('Install', ''))
+
+    @property
+    def upgrade(self):
+        return parse_packages(self.lists.get('Upgrade', ''))
+
+    @property
+    def remove(self):
+        return parse_packages(self.lists.get('Remove', ''))
+
+    @property
+    def purge(self):
+        return parse_packages(self.lists.get('Purge', ''))
+
+    def line(self, kind='Install'):
+        '''Returns the log line of a package list, as 'filename:line'.'''
+
+        return '%s:%s: %s' % (self.path, kind, self.lists.get(kind, ''))
+
+    def text(self):
+        '''Returns the transaction as apt writes it to the history log;
+        parse() reads it back.'''
+
+        lines = ['', 'Start-Date: %s' % self.start_date]
+        if self.commandline is not None:
+            lines.append('Commandline: %s' % self.commandline)
+        if self.requested_by is not None:
+            lines.append('Requested-By: %s' % self.requested_by)
+        for kind in LISTS:
+            if kind in self.lists:
+                lines.append('%s: %s' % (kind, self.lists[kind]))
+        lines.append('End-Date: %s' % self.end_date)
+        return '\n'.join(lines) + '\n'
+
+    def mentions(self, pattern):
+        '''Tells if a package list matches pattern, a compiled regex.'''
+
+        return any(pattern.search(value) for value in self.lists.values())
+
+    def requested(self, package):
+        '''Tells if the command line of the transaction asked to install
+        package, eg. 'apt-get install smb4k' or 'apt install -y smb4k=1.0'.
+        '''
+
+        if not self.commandline:
+            return False
+        words = self.commandline.split()
+        if 'install' not in words:
+            return False
+        # 'smb4k=1.0' or 'smb4k/trusty' -> 'smb4k'
+        return package in [re.split(r'[=/]', word)[0] for word in words]
+
+    def __repr__(self):
+        return '<Transaction %s %r>' % (self.start_date, self.commandline)
+
+
+def parse(lines, path=None, packages=None):
+    '''Yields one Transaction per block of lines, as they are read.
+
+    lines -> lines of a history log, eg. an open file
+    packages -> a package name or a list of them; if given, only
+                transactions listing one of them are yielded
+    '''
+
+    if isinstance(packages, basestring):
+        packages = [packages]
+    pattern = logscan.token_pattern(*packages) if packages else None
+    transaction = None
+    for line in lines:
+        field, _, value = line.rstrip('\n').partition(': ')
+        if field == 'Start-Date':
+            transaction = Transaction(path)
+            transaction.start_date = value
+        elif transaction is None:
+            # lines before the first Start-Date, eg. a truncated log
+            continue
+        elif field == 'End-Date':
+            transaction.end_date = value
+            if pattern is None or transaction.mentions(pattern):
+                yield transaction
+            transaction = None
+        elif field == 'Commandline':
+            transaction.commandline = value
+        elif field == 'Requested-By':
+            transaction.requested_by = value
+        elif field in LISTS:
+            transaction.lists[field] = value
+
+
+def read(paths, packages=None, jobs=1):
+    '''Yields the transactions of all log files in paths, plain or
+    gzipped; see parse().
+
+    jobs -> with more than 1, up to jobs files are decompressed and parsed
+            at once by a pool of processes, see logscan.map_logs();
+            transactions still come in the order of paths.
+    '''
+
+    if jobs <= 1:
+        for path in paths:
+            for transaction in read_log(path, packages):
+                yield transaction
+        return
+
+    tasks = [(path, packages) for path in paths]
+    for found in logscan.map_logs(read_file, tasks, jobs):
+        for transaction in found:
+            yield transaction
+
+
+def read_file(task):
+    '''Returns the list of transactions of a log file, task being
+    (path, packages) as read() takes them; runs in a worker process.'''
+
+    path, packages = task
+    return list(read_log(path, packages))
+
+
+def read_log(path, packages=None):
+    '''Yields the transactions of a log file; see parse().
+
+    A plain log is memory-mapped when packages are given: only the
+    transactions around the places where a package name appears are
+    copied and parsed, the rest of the file is never turned into strings.
+    '''
+
+    if packages and not path.endswith('.gz'):
+        data = logscan.map_log(path)
+        if data is None:
+            return
+        try:
+            for start, end in blocks(data, packages):
+                for transaction in parse(data[start:end].splitlines(True),
+                                         path, packages):
+                    yield transaction
+        finally:
+            data.close()
+        return
+
+    with logscan.open_log(path) as f:
+        for transaction in parse(f, path, packages):
+            yield transaction
+
+
+def blocks(data, packages):
+    '''Returns the sorted (start, end) offsets of the transactions of data,
+    a memory-mapped log, in which a package name of packages appears;
+    a transaction spans from its 'Start-Date:' line to the end of its
+    'End-Date:' line. Transactions next to each other come as one block.
+    '''
+
+    if isinstance(packages, basestring):
+        packages = [packages]
+    found = []
+    for package in packages:
+        position = 0
+        while True:
+            hit = data.find(package, position)
+            if hit == -1:
+                break
+            end = data.find('\nEnd-Date: ', hit)
+            if end == -1:
+                # apt is still writing this transaction
+                break
+            end = data.find('\n', end + 1)
+            end = len(data) if end == -1 else end + 1
+            start = data.rfind('Start-Date: ', 0, hit)
+            # lines before the first Start-Date are skipped by parse()
+            found.append((max(start, 0), end))
+            # the rest of the transaction is in the block already:
+            position = end
+
+    merged = []
+    for start, end in sorted(found):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def select(transactions, package):
+    '''Returns the transaction that installed package: the newest one whose
+    command line asked for package or, if there is none, eg. package was
+    installed with a graphical package manager, the newest one that
+    installed it. Returns None if package was never installed.'''
+
+    installing = [t for t in transactions if package in t.install]
+    installing.sort(key=lambda t: t.start_date)
+    for transaction in reversed(installing):
+        if transaction.requested(package):
+            return transaction
+    return installing[-1] if installing else None
+
+
+def merge(transactions, package):
+    '''Returns the packages installed together with package, as parser()
+    does for a single 'Install:' line, but over all the times package was
+    installed: if it was removed and installed again, the second
+    transaction lists only what was missing at that moment.
+
+    Packages removed or purged after they were installed are left out,
+    unless they were installed again.
+    '''
+
+    d = collections.OrderedDict()
+    for transaction in sorted(transactions, key=lambda t: t.start_date):
+        install = transaction.install
+        if package in install:
+            d.update(install)
+        for name in list(transaction.remove) + list(transaction.purge):
+            if name != package:
+                d.pop(name, None)
+
+    return d
+
+
+def locate(transactions, packages):
+    '''Selects and merges the installing transactions of every package in
+    packages, see select() and merge().
+
+    Returns (an OrderedDict like the one parser() returns, with the packages
+    installed together with any of packages; an OrderedDict
+    package -> the Transaction that installed it, None if not found).
+    '''
+
+    d = collections.OrderedDict()
+    chosen = collections.OrderedDict()
+    for package in packages:
+        chosen[package] = select(transactions, package)
+        if chosen[package] is not None:
+            d.update(merge(transactions, package))
+
+    return d, chosen
@@ -24,141 +24,275 @@
 
 import logging
 import sys
+import time
+import threading
+import collections
 import ConfigParser
-import unittest
-from StringIO import StringIO
 import glob
 
 
-class Tee(object):
-    '''Emulates 'tee' shell cmd, you can write to multiple files
-    at once.'''
-    def __init__(self, file_like_obj):
-        #def __init__(self, name, mode):
-        #self.file = open(name, mode)
-        self.file = file_like_obj
-        self.stdout = sys.stdout
-        # this makes print() to output text to a Tee obj by default:
-        sys.stdout = self
+class StreamSink(object):
+    '''Passes the output of a child process, eg. apt-get's, on to stream in
+    big blocks instead of chunk by chunk:
+    - chunks are collected until there are block_size bytes, or until
+      interval seconds have passed, then written and flushed at once;
+    - the last tail_size bytes are kept, to tell what went wrong if the
+      process fails.
 
-    def __del__(self):
-        #reset my stdout the the default stdout:
-        sys.stdout = sys.__stdout__   # self.stdout
-        self.file.close()
+    >>> with StreamSink(outputter) as sink:
+    ...     sh.apt_get('purge', packages, _out=sink, _out_bufsize=0)
+
+    _out_bufsize=0 makes sh hand over whatever it reads from the pipe
+    instead of splitting it into lines.
+    '''
+
+    def __init__(self, stream, block_size=64 * 1024, tail_size=16 * 1024,
+                 interval=0.5):
+        self.stream = stream
+        self.block_size = block_size
+        self.tail_size = tail_size
+        self.interval = interval
+        self._chunks = []
+        self._size = 0
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+
+    def start(self):
+        '''Flushes every interval seconds in a background thread, so output
+        doesn't wait in the buffer while the process is quiet.'''
+
+        self._thread = threading.Thread(target=self._tick)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _tick(self):
+        while not self._closed.wait(self.interval):
+            with self._lock:
+                self._flush()
 
     def write(self, data):
-        self.file.write(data)
-        # redirect to console when writing to a Tee instance:
-        self.stdout.write(data)
+        with self._lock:
+            self._chunks.append(data)
+            self._size += len(data)
+            self._tail.append(data)
+            self._tail_size += len(data)
+            while self._tail_size - len(self._tail[0]) >= self.tail_size:
+                self._tail_size -= len(self._tail.popleft())
+            if self._size >= self.block_size:
+                self._flush()
 
     def flush(self):
-        self.file.flush()
-        self.stdout.flush()
+        '''sh calls it after every write; the buffer is written only if
+        interval seconds passed since it was last written.'''
+
+        with self._lock:
+            if time.time() - self._flushed >= self.interval:
+                self._flush()
+
+    def _flush(self):
+        if self._chunks:
+            self.stream.write(''.join(self._chunks))
+            self.stream.flush()
+            self._chunks = []
+            self._size = 0
+        self._flushed = time.time()
 
     def close(self):
-        self.__del__()
-
-
-def emit(self, record):
-    """
-    The content of this function is taken from logging.StreamHandler.emit()
-    and tailored a bit to pretty print the record.
-
-    Read the docs of logging.StreamHandler.emit() if you need more info.
-    """
-
-    ### My customization, taken from header of logging module ####
-    try:
-        unicode
-        _unicode = True
-    except NameError:
-        _unicode = False
-    ### end customization ###
-    ############################################
-
-    try:
-        msg = self.format(record)
-
-        ### My customization ####################
-
-        ''' Eg:
-        >>> msg          # as it appears formatted with ANSI color codes,
-                         # printed to a file
-        '[33m 2013-07-05 09:58:42,475 [35m check: [37m INFO [39;49;0m [34m This is the log msg.[39;49;0m'
-
-        but on terminal you get, with colored text:
-        '2013-07-04 22:22:53,749 check: INFO This is the log msg.'
-        '''
-        # logging.FileHandler inherits logging.StreamHandler
-        # FileHandler.emit() delegates to StreamHandler.emit()
-        # if message formats differ between the two, we need to operate
-        # accordingly
-        if not isinstance(self, logging.FileHandler):
-            # when self is a logging.StreamHandler obj
-            l = msg.split(' ', 7)
-            '''
-            >>> l
-            ['[33m',
-             '2013-07-04',
-             '22:22:53,749',
-             '[35m',
-             'check:',
-             '[37m',
-             'INFO',
-             '[39;49;0m [34m - This is the log msg.[39;49;0m']
-            '''
-            l[4] = l[4].ljust(12)      # l[4] contains funcName -> 'check:'
-            l[6] = l[6].ljust(6)       # l[6] contains log level -> 'INFO'
-            # the values for .ljust() are to be set according to the shortest
-            # and longest function names.
-            '''
-            >>> l[4]
-            'check:     '
-            >>> l[6]
-            'INFO    '
-            '''
-        else:
-            # when self is a logging.FileHandler obj
-            l = msg.split(' ', 4)
-            l[2] = l[2].ljust(12)      # l[2] contains funcName -> 'check:'
-            l[3] = l[3].ljust(8)       # l[3] contains log level -> 'INFO'
-
-        msg = ' '.join(l)
-        '''
-        >>> msg
-        '2013-07-04 22:22:53,749 check:      INFO     This is the log msg.'
-        '''
-        ### end customization ###
-        #############################################
-
-        stream = self.stream
-        fs = "%s\n"
-        if not _unicode:  # if no unicode support...
-            stream.write(fs % msg)
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self._flush()
+
+    def tail(self):
+        '''Returns the last tail_size bytes of output.'''
+
+        with self._lock:
+            return ''.join(self._tail)[-self.tail_size:]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ProgressBar(object):
+    '''Prints a progress bar, as computing what packages to remove takes
+    time:
+
+    Computing [.......             ]
+
+    This progress bar is for smaller identical tasks of known quantity.
+    Ref:
+    http://thelivingpearl.com/2012/12/31/creating-progress-bars-with-python/
+    '''
+
+    # Progress bar will have a resolution of 5% = 5/100 = 1/20
+    width = 20
+
+    def __init__(self, total, title='Computing', stream=None):
+        self.stream = stream or sys.stdout
+        self.total = total
+        self.count = 0
+        self.dots = 0
+
+        # The special character \b returns the printing cursor one
+        # step backwards
+        self.stream.write('%s [%s]%s' % (title, ' ' * self.width,
+                                         '\b' * (self.width + 1)))
+        self.stream.flush()
+
+    def advance(self, n=1):
+        '''Tells that n more tasks are done.'''
+
+        self.count += n
+        # If we have 95 packages, for 5%, the bar increases every 4.75
+        # packages handled by task:
+        dots = min(self.width, self.count * self.width // max(self.total, 1))
+        if dots > self.dots:
+            self.stream.write('.' * (dots - self.dots))
+            self.stream.flush()
+            self.dots = dots
+
+    def done(self):
+        # fill whatever is left, eg. when tasks were skipped:
+        self.stream.write('.' * (self.width - self.dots) + '] Done!\n\n')
+        self.dots = self.width
+        self.stream.flush()
+
+
+### Logging stuff ###
+
+class ColumnFormatter(logging.Formatter):
+    '''Lines up function names and log levels in columns:
+
+    2013-07-04 22:22:53,749 check:      INFO     This is the log msg.
+    2013-07-04 22:22:53,751 worker:     DEBUG    These are:
+
+    The format can use %(func_column)s and %(level_column)s, which are
+    funcName + ':' and levelname padded to the width of the columns.
+    '''
+
+    func_width = 12
+    level_width = 8
+
+    def format(self, record):
+        record.func_column = (record.funcName + ':').ljust(self.func_width)
+        record.level_column = record.levelname.ljust(self.level_width)
+        return super(ColumnFormatter, self).format(record)
+
+
+class QueueHandler(logging.Handler):
+    '''Hands log records to a QueueListener through queue, so the thread
+    that logs never waits for the console or the disk. Like the handler of
+    the same name in Python 3's logging.handlers.'''
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        '''Merges the arguments into the message and the traceback into
+        exc_text, as the record is formatted in another thread.'''
+
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+
+class QueueWriter(object):
+    '''A file like object that hands text to a QueueListener through
+    queue, eg. what 'print' writes, so it comes out in order with the log
+    records.'''
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write(self, data):
+        if data:
+            self.queue.put_nowait(data)
+
+    def flush(self):
+        pass
+
+
+class QueueListener(object):
+    '''Writes, in a background thread, what QueueHandler and QueueWriter
+    put in queue:
+    - log records go to every one of handlers;
+    - text goes to every one of streams.
+
+    Text is flushed once the queue is empty, not after every write.
+    '''
+
+    _sentinel = None
+
+    def __init__(self, queue, handlers, streams=()):
+        self.queue = queue
+        self.handlers = handlers
+        self.streams = streams
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Writes whatever is still in the queue and stops the thread.'''
+
+        if self._thread is None:
+            return
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+    def handle(self, item):
+        if isinstance(item, logging.LogRecord):
+            for handler in self.handlers:
+                if item.levelno >= handler.level:
+                    handler.handle(item)
         else:
-            try:
-                if (isinstance(msg, unicode) and
-                        getattr(stream, 'encoding', None)):
-                    ufs = fs.decode(stream.encoding)
-                    try:
-                        stream.write(ufs % msg)
-                    except UnicodeEncodeError:
-                        #Printing to terminals sometimes fails. For example,
-                        #with an encoding of 'cp1251', the above write will
-                        #work if written to a stream opened or wrapped by
-                        #the codecs module, but fail when writing to a
-                        #terminal even when the codepage is set to cp1251.
-                        #An extra encoding step seems to be needed.
-                        stream.write((ufs % msg).encode(stream.encoding))
-                else:
-                    stream.write(fs % msg)
-            except UnicodeError:
-                stream.write(fs % msg.encode("UTF-8"))
+            for stream in self.streams:
+                stream.write(item)
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+        for stream in self.streams:
+            stream.flush()
+
+    def _monitor(self):
+        while True:
+            item = self.queue.get()
+            if item is self._sentinel:
+                break
+            self.handle(item)
+            if self.queue.empty():
+                self.flush()
         self.flush()
-    except (KeyboardInterrupt, SystemExit):
-        raise
-    except:
-        self.handleError(record)
+
+
+### End Logging stuff ###
 
 
 ### Config file stuff ###
@@ -214,8 +348,14 @@ def write_default_config_file(d):
     config.add_comment("LOG", "Debug level can be 'info' or 'debug'")
     config.set("LOG", "log_level", d['log_level'])
     config.add_comment("LOG", "Set path to default package manager's log files.")
-    config.add_comment("LOG", "Path is given as argument to 'zgrep'. It can be a shell path or a shell glob, etc.")
+    config.add_comment("LOG", "Path can be a shell path or a shell glob, etc. Files can be plain or gzipped.")
     config.set("LOG", "path", d['path'])
+    config.add_comment("LOG", "dpkg's database, used to tell which packages are installed.")
+    config.set("LOG", "status_file", d['status_file'])
+    config.add_comment("LOG", "Reverse dependencies are remembered here between runs.")
+    config.set("LOG", "cache_file", d['cache_file'])
+    config.add_comment("LOG", "Index of the log files in 'path', updated on every run.")
+    config.set("LOG", "index_file", d['index_file'])
 
     # TODO: write all config params to file, using a for loop?
 
@@ -239,8 +379,7 @@ def read_config(logger, filename, defaults):
     for section in config.sections():
         new_config = dict(config.items(section))
         logger.debug("reading values for section '%s'" % section)
-        if validate(logger, defaults, new_config):
-            defaults.update(new_config)
+        defaults.update(validate(logger, defaults, new_config))
         #for option, value in config.items(section):
         #    if option in defaults:
         #        if validate(defaults):
@@ -254,120 +393,61 @@ def read_config(logger, filename, defaults):
     return defaults
 
 
-def validate(logger, defaults, new_config):
-    '''Tests value based on the type of option. It takes advantage of
-    test cases already defined in test.py.'''
-
-    # select only some test classes to be run:
-    loader = unittest.defaultTestLoader
-    # replace test data with actual data:
-    TestConfigValidate.defaults = defaults
-    TestConfigValidate.new_config = new_config
-    suite = loader.loadTestsFromTestCase(TestConfigValidate)
-    # disable TextTestRunner output by passing a stream that no one reads
-    runner = unittest.TextTestRunner(stream=StringIO(), verbosity=1)
-    logger.debug("parsing values...")
-    test_result = runner.run(suite)
-
-    if test_result.failures:          # or .errors if unexpected exceptions
-        logger.info("Errors in configuration file, exiting!")
-        sys.exit()
-
-    return True
-
-
-class TestConfigValidate(unittest.TestCase):
-    # this is what you get after reading a config file:
-    defaults = {'log_level': 'DEBUG',
-                'path': "/var/log/apt/history*",
-                'conf_file': 'main.conf',
-                'log_file': 'out.log',
-                }
-
-    # 'log_level'    just 2 levels: DEBUG or INFO
-    # 'path'         path to pkg manager's log files
-    # 'conf_file'    config file user can edit
-    # 'log_file'     app's log file
-
-    # defaults is a class level var so it can be changed outside of the class
-    # and thus the change will apply to all class instances.
-
-    new_config = {'log_level': 'DEBUG',
-                  'path': "/var/log/apt/history*",
-                  'conf_file': 'main.conf',
-                  'log_file': 'out.log',
-                  }
+# How the values of config file options are checked; options that are not
+# listed here take any value.
+# option -> (normalize the value, tell if it is valid, message if it's not)
+CONFIG_RULES = {
+    # Log level should be uppercase as it is in logging module
+    'log_level': (lambda value: value.upper(),
+                  lambda value: value in ('INFO', 'DEBUG'),
+                  "'%s' of option 'log_level' is not a valid value.\n"
+                  "Choose one of: INFO or DEBUG"),
+    # Path must be a shell glob which, after shell expansion, should resolve
+    # to an absolute or relative path to one or more files.
+    'path': (None,
+             glob.glob,
+             "'path' doesn't contain a valid path: '%s'"),
+}
+
+
+def config_errors(defaults, new_config, rules=CONFIG_RULES):
+    '''Checks the options read from a config file against defaults (the
+    valid options) and rules.
+
+    Returns (new_config with normalized values, list of error messages).
+    '''
 
-    def setUp(self):
-        '''This is run for every instance of this class.'''
+    config = {}
+    errors = []
+    for option, value in new_config.items():
+        if option not in defaults:
+            errors.append("'%s' is not a valid option.\n"
+                          "These are the valid options that you can set: %s"
+                          % (option, ', '.join(sorted(defaults))))
+            continue
+        normalize, is_valid, message = rules.get(option, (None, None, None))
+        if normalize is not None:
+            value = normalize(value)
+        if is_valid is not None and not is_valid(value):
+            errors.append(message % value)
+        config[option] = value
 
-        for d in [self.defaults, self.new_config]:
-            # make values case insensitive:
-            for key, value in d.items():
-                d[key] = value.lower()
+    return config, errors
 
-            # Log level should be uppercase as it is in logging module
-            d['log_level'] = d['log_level'].upper()
 
-    def test_options_are_valid(self):
-        #        raise KeyError("'%s' is not a valid option" % option)
-        # it should take keys as args or have self.new_config as class
-        # attribute
-        default_options = set(self.defaults.keys())
-        real_options = set(self.new_config.keys())
-        for option in real_options:
-            try:
-                # set up a nice error message for user
-                self.assertIn(option, default_options)
-            except AssertionError:
-                print("Configuration file: "
-                      "'%s' is not a valid option.\n"
-                      "These are the valid options that you can set: %s \n" %
-                      (option, ', '.join(default_options)))
-                # without it, the test passes because of 'except':
-                raise
-
-    def test_valid_log_level(self):
-        log_level = self.new_config['log_level']
-        possible_values = ['INFO', 'DEBUG']
-        # suppress the ugly AssertionError message upon failure
-        # using a 'try: ... except' block.
-        # I could have used self.fail(msg="A pretty error message...") but
-        # that's ugly too for the user.
-        try:
-            self.assertIn(log_level, possible_values)
-        except AssertionError:
-            print("Configuration file: "
-                  "'%s' of option '%s' is not a valid value.\n"
-                  "Choose one of: %s" %
-                  (log_level, 'log_level', ' or '.join(possible_values)))
-            # without it, the test passes because of 'except':
-            raise
+def validate(logger, defaults, new_config):
+    '''Returns new_config with normalized values, see config_errors();
+    exits if any value is wrong.'''
 
-    def test_valid_path(self):
-        '''Path must be a shell glob which, after shell expansion, should
-        resolve to an absolute or relative path to one or more files (not
-        directories).
-        '''
-        path = self.new_config['path']
-        files = glob.glob(path)
-        try:
-            self.assertNotEqual(files, [])
-        except AssertionError:
-            print("Configuration file: "
-                  "'path' doesn't contain a valid path: '%s'" %
-                  (path))
-            # without it, the test passes because of 'except':
-            raise
+    logger.debug("parsing values...")
+    config, errors = config_errors(defaults, new_config)
+    if errors:
+        for error in errors:
+            print("Configuration file: %s" % error)
+        logger.info("Errors in configuration file, exiting!")
+        sys.exit()
 
-#    def test_valid_conf_filename(self):
-#        '''Don't know what to test about a filename which gets created anyway
-#        if it doesn't exist.'''
-#        pass
-#
-#    def test_valid_log_filename(self):
-#        '''The same as test_valid_conf_filename.'''
-#        pass
+    return config
 
 
 ### End Config file stuff ###
@@ -2,11 +2,29 @@
 
 import unittest
 import collections
+import os
+import sys
+import logging
+import time
+import gzip
+import glob
+import json
+import shutil
+import tempfile
+import threading
+import Queue
+import subprocess
+import types
+from StringIO import StringIO
 
 # Import remove_desktop modules
 import remove_desktop as rd
 #import utils
 
+# fixtures stored in files:
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+STATUS_FILE = os.path.join(DATA_DIR, 'status')
+
 
 class TestParser(unittest.TestCase):
     def setUp(self):
@@ -42,6 +60,104 @@ class TestParser(unittest.TestCase):
         x = len(self.d.keys())
         self.assertEqual(4, x)
 
+    def test_parser_knows_other_architectures(self):
+        d = rd.parser("Install: libc6:arm64 (2.19-0ubuntu6), "
+                      "fonts-lyx:all (2.0.6-1)")
+        self.assertEqual(('arm64', '2.19-0ubuntu6'), d['libc6'])
+        self.assertEqual(('all', '2.0.6-1'), d['fonts-lyx'])
+
+
+class TestTokenize(unittest.TestCase):
+    def setUp(self):
+        self.line = "/var/log/apt/history.log.7.gz:Install: " + \
+                    "lightdm-gtk-greeter:i386 (1.3.1-0ubuntu1), " + \
+                    "pidgin-libnotify:i386 (0.14-4ubuntu11, automatic), " + \
+                    "libgpgme++2:i386 (4.9.2-0ubuntu1, automatic), " + \
+                    "libxfcegui4-4:i386 (4.10.0-1, automatic)"
+
+    def test_entries_are_the_same_in_any_chunk_size(self):
+        whole = list(rd.transactions.tokenize([self.line]))
+        for size in (1, 7, 64):
+            chunks = [self.line[i:i + size]
+                      for i in range(0, len(self.line), size)]
+            self.assertEqual(whole, list(rd.transactions.tokenize(chunks)))
+
+    def test_automatic_flag_is_split_from_version(self):
+        entries = list(rd.transactions.tokenize([self.line]))
+        self.assertEqual(('lightdm-gtk-greeter', 'i386', '1.3.1-0ubuntu1',
+                          False), entries[0])
+        self.assertEqual(('pidgin-libnotify', 'i386', '0.14-4ubuntu11',
+                          True), entries[1])
+        self.assertEqual(('libxfcegui4-4', 'i386', '4.10.0-1', True),
+                         entries[3])
+
+    def test_parser_keeps_its_values(self):
+        d = rd.parser(self.line)
+        entries = list(rd.transactions.tokenize([self.line]))
+        self.assertEqual(list(d.keys()), [entry[0] for entry in entries])
+        # the flag stays in the version for parser()'s callers:
+        self.assertEqual(('i386', '0.14-4ubuntu11, automatic'),
+                         d['pidgin-libnotify'])
+        for name, arch, version, automatic in entries:
+            self.assertEqual(
+                (arch, version + (', automatic' if automatic else '')),
+                d[name])
+
+    def test_old_logs_without_architectures(self):
+        self.assertEqual([('smb4k', '', '1.0.7-1ubuntu1', False)],
+                         list(rd.transactions.tokenize(
+                             ['Install: smb4k (1.0.7', '-1ubuntu1)'])))
+
+
+class TestSplitRdepends(unittest.TestCase):
+    def setUp(self):
+        '''
+        Output of a single call:
+        $: apt-cache rdepends abiword-plugin-mathview xubuntu-artwork
+        '''
+        self.output = "abiword-plugin-mathview\n" + \
+                      "Reverse Depends:\n" + \
+                      "  xubuntu-desktop\n" + \
+                      "  abiword\n" + \
+                      "xubuntu-artwork\n" + \
+                      "Reverse Depends:\n" + \
+                      "  xubuntu-desktop\n" + \
+                      "  shimmer-themes\n" + \
+                      "  gnome-brave-icon-theme\n"
+        self.d = rd.split_rdepends(self.output)
+
+    def test_returns_ordered_dict(self):
+        self.assertEqual(['abiword-plugin-mathview', 'xubuntu-artwork'],
+                         list(self.d.keys()))
+
+    def test_rdeps_are_split_per_package(self):
+        self.assertEqual(['xubuntu-desktop', 'abiword'],
+                         self.d['abiword-plugin-mathview'])
+        self.assertEqual(['xubuntu-desktop', 'shimmer-themes',
+                          'gnome-brave-icon-theme'],
+                         self.d['xubuntu-artwork'])
+
+    def test_package_without_rdeps(self):
+        d = rd.split_rdepends("xubuntu-desktop\nReverse Depends:\n")
+        self.assertEqual([], d['xubuntu-desktop'])
+
+    def test_alternatives_are_reverse_dependencies(self):
+        '''
+        $: apt-cache rdepends tzdata libc6
+        '''
+        d = rd.split_rdepends("tzdata\n"
+                              "Reverse Depends:\n"
+                              "  |tzdata-java\n"
+                              "  libc6\n"
+                              "  |python-tz\n"
+                              "libc6\n"
+                              "Reverse Depends:\n"
+                              "  |zlib1g\n"
+                              "  |gcc-4.8-base\n"
+                              "  tzdata\n")
+        self.assertEqual(['tzdata-java', 'libc6', 'python-tz'], d['tzdata'])
+        self.assertEqual(['zlib1g', 'gcc-4.8-base', 'tzdata'], d['libc6'])
+
 
 class TestParserStage2(unittest.TestCase):
     def setUp(self):
@@ -191,16 +307,1426 @@ class TestParserStage2(unittest.TestCase):
                                                    callback=is_installed))
 
 
+class TestInstalledIndex(unittest.TestCase):
+    def setUp(self):
+        '''test/data/status is a tiny /var/lib/dpkg/status.'''
+        self.index = rd.dpkg_status.InstalledIndex(STATUS_FILE)
+
+    def test_installed_packages_are_found(self):
+        self.assertIn('xubuntu-desktop', self.index)
+        self.assertIn('libc6', self.index)
+        self.assertEqual(10, len(self.index))
+
+    def test_not_installed_packages_are_not_found(self):
+        # removed, but its config files are still there:
+        self.assertNotIn('gnome-brave-icon-theme', self.index)
+        # purged:
+        self.assertNotIn('ubuntustudio-desktop', self.index)
+
+    def test_names_match_exactly(self):
+        '''`dpkg-query -l | grep xubuntu` would match these too.'''
+        self.assertNotIn('xubuntu', self.index)
+        self.assertNotIn('xubuntu-desktop-extra', self.index)
+
+    def test_architecture_qualifier_is_ignored(self):
+        self.assertTrue(self.index('gtk2-engines-murrine:i386'))
+
+    def test_index_as_parser_stage_2_callback(self):
+        rdeps = ['xubuntu-desktop', 'gnome-brave-icon-theme',
+                 'ubuntustudio-desktop']
+        self.assertEqual("remove",
+                         rd.parser_stage_2(rdeps, ['xubuntu-desktop'],
+                                           callback=self.index))
+        rdeps.append('lubuntu-core')
+        self.assertEqual("keep",
+                         rd.parser_stage_2(rdeps, ['xubuntu-desktop'],
+                                           callback=self.index))
+
+
+class TestDependencyGraph(unittest.TestCase):
+    def setUp(self):
+        self.graph = rd.depgraph.DependencyGraph.from_status(STATUS_FILE)
+
+    def test_graph_holds_installed_packages_only(self):
+        self.assertEqual(10, len(self.graph))
+        self.assertNotIn('gnome-brave-icon-theme', self.graph)
+
+    def test_rdepends(self):
+        self.assertEqual(['lubuntu-core', 'xubuntu-desktop'],
+                         self.graph.rdepends('lightdm-gtk-greeter'))
+        self.assertEqual(['xubuntu-default-settings', 'xubuntu-desktop'],
+                         self.graph.rdepends('xubuntu-artwork'))
+
+    def test_metapackage_has_no_rdepends(self):
+        self.assertEqual([], self.graph.rdepends('xubuntu-desktop'))
+
+    def test_pre_depends_and_architecture_qualifiers(self):
+        self.assertEqual(['lightdm', 'lightdm-gtk-greeter'],
+                         self.graph.rdepends('libc6:i386'))
+        self.assertEqual(['shimmer-themes'],
+                         self.graph.rdepends('gtk2-engines-murrine'))
+
+    def test_uninstalled_alternatives_are_left_out(self):
+        self.assertEqual(['shimmer-themes', 'xubuntu-icon-theme'],
+                         self.graph.depends('xubuntu-artwork'))
+        self.assertEqual([], self.graph.rdepends('gnome-brave-icon-theme'))
+
+    def test_provides(self):
+        '''xubuntu-default-settings depends on a virtual package provided
+        by shimmer-themes.'''
+        self.assertEqual(['xubuntu-artwork', 'xubuntu-default-settings'],
+                         self.graph.rdepends('shimmer-themes'))
+
+    def test_names_have_dense_ids(self):
+        names = self.graph.names
+        self.assertEqual(range(len(names)),
+                         [names.get(name) for name in names])
+        self.assertEqual('lightdm', names.name(names.get('lightdm')))
+        self.assertEqual(names.get('lightdm'), names.id('lightdm'))
+        self.assertIsNone(names.get('gnome-brave-icon-theme'))
+
+    def test_duplicate_edges_are_kept_once(self):
+        graph = rd.DependencyGraph()
+        graph.add_installed('lubuntu-core')
+        graph.add_installed('lightdm')
+        graph.add_edge('lubuntu-core', 'lightdm')
+        self.assertEqual(['lubuntu-core'], graph.rdepends('lightdm'))
+        graph.add_edge('lubuntu-core', 'lightdm')
+        graph.add_edge('xubuntu-desktop', 'lightdm')
+        self.assertEqual(['lubuntu-core', 'xubuntu-desktop'],
+                         graph.rdepends('lightdm'))
+        self.assertEqual(2, len(graph))
+        self.assertEqual(set(['lubuntu-core', 'lightdm']), graph.installed)
+
+    def test_read_only_some_fields(self):
+        stanzas = list(rd.dpkg_status.read_status(STATUS_FILE,
+                                                  ('Package', 'Status')))
+        self.assertTrue(stanzas)
+        for stanza in stanzas:
+            self.assertLessEqual(set(stanza), set(['Package', 'Status']))
+
+    def test_parse_relations(self):
+        self.assertEqual([['libc6'], ['murrine', 'gtk2-engines'], ['perl']],
+                         rd.dpkg_status.parse_relations(
+                             'libc6 (>= 2.15), murrine (>= 1) | gtk2-engines,'
+                             ' perl:any'))
+
+
+class TestClassify(unittest.TestCase):
+    def setUp(self):
+        self.graph = rd.DependencyGraph.from_status(STATUS_FILE)
+        # installed together with xubuntu-desktop:
+        self.packages = ['xubuntu-desktop', 'xubuntu-default-settings',
+                         'xubuntu-artwork', 'shimmer-themes',
+                         'xubuntu-icon-theme', 'gtk2-engines-murrine',
+                         'lightdm-gtk-greeter', 'lightdm']
+
+    def test_packages_needed_by_other_packages_are_kept(self):
+        '''lubuntu-core needs lightdm-gtk-greeter and lightdm.'''
+        self.assertEqual(['xubuntu-desktop', 'xubuntu-default-settings',
+                          'xubuntu-artwork', 'shimmer-themes',
+                          'xubuntu-icon-theme', 'gtk2-engines-murrine'],
+                         rd.classify(self.packages, self.graph))
+
+    def test_packages_are_kept_transitively(self):
+        '''xubuntu-default-settings stays, so shimmer-themes stays and
+        gtk2-engines-murrine, needed only by shimmer-themes, stays too.'''
+        candidates = ['xubuntu-artwork', 'shimmer-themes',
+                      'gtk2-engines-murrine']
+        self.assertEqual([], rd.classify(candidates, self.graph))
+
+    def test_uninstalled_packages_are_removed(self):
+        candidates = ['gnome-brave-icon-theme', 'lightdm']
+        self.assertEqual(['gnome-brave-icon-theme'],
+                         rd.classify(candidates, self.graph))
+
+    def test_duplicates_are_removed_once(self):
+        self.assertEqual(['xubuntu-desktop'],
+                         rd.classify(['xubuntu-desktop', 'xubuntu-desktop'],
+                                     self.graph))
+
+
+class TestAptCacheGraph(unittest.TestCase):
+    '''apt_cache_graph() is used when dpkg's status file can't be read.'''
+
+    rdeps = {'xubuntu-artwork': ['xubuntu-desktop', 'gnome-brave-icon-theme'],
+             'lightdm-gtk-greeter': ['xubuntu-desktop', 'lubuntu-core'],
+             'xubuntu-desktop': []}
+
+    def setUp(self):
+        module = rd.remove_desktop
+        self.saved = (module.rdepends, module.is_installed, sys.stdout)
+
+        def rdepends(packages):
+            '''Simulates `apt-cache rdepends` on a virtual testing OS.'''
+            return collections.OrderedDict((p, self.rdeps[p])
+                                           for p in packages
+                                           if p in self.rdeps)
+
+        module.rdepends = rdepends
+        module.is_installed = lambda p: p != 'gnome-brave-icon-theme'
+        # hide the progress bar:
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        module = rd.remove_desktop
+        module.rdepends, module.is_installed, sys.stdout = self.saved
+
+    def test_graph_is_the_same_for_any_number_of_jobs(self):
+        packages = ['xubuntu-desktop', 'xubuntu-artwork',
+                    'lightdm-gtk-greeter']
+        for jobs in (1, 3):
+            graph = rd.remove_desktop.apt_cache_graph(packages, jobs)
+            self.assertEqual(['xubuntu-desktop'],
+                             graph.rdepends('xubuntu-artwork'))
+            self.assertEqual(['lubuntu-core', 'xubuntu-desktop'],
+                             graph.rdepends('lightdm-gtk-greeter'))
+            self.assertEqual(['xubuntu-desktop', 'xubuntu-artwork'],
+                             rd.classify(packages, graph))
+
+    def test_second_run_uses_the_cache(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'rdepends.json')
+        packages = ['xubuntu-artwork', 'lightdm-gtk-greeter']
+
+        cache = rd.cache.RdependsCache(path, [STATUS_FILE])
+        rd.remove_desktop.apt_cache_graph(packages, 2, cache)
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+
+        # apt-cache isn't asked anymore:
+        rd.remove_desktop.rdepends = None
+        cache = rd.cache.RdependsCache(path, [STATUS_FILE])
+        graph = rd.remove_desktop.apt_cache_graph(packages, 2, cache)
+        self.assertEqual((2, 0), (cache.hits, cache.misses))
+        self.assertEqual(['lubuntu-core', 'xubuntu-desktop'],
+                         graph.rdepends('lightdm-gtk-greeter'))
+
+
+class TestRdependsCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'cache', 'rdepends.json')
+        # stands for /var/lib/dpkg/status:
+        self.source = os.path.join(self.tmp, 'status')
+        with open(self.source, 'w') as f:
+            f.write('Package: xubuntu-desktop\n')
+
+    def test_saved_values_are_found(self):
+        cache = rd.cache.RdependsCache(self.path, [self.source])
+        self.assertIs(cache.MISS, cache.get('xubuntu-artwork'))
+        cache.put('xubuntu-artwork', ['xubuntu-desktop'])
+        cache.put('no-such-package', None)
+        cache.save()
+
+        cache = rd.cache.RdependsCache(self.path, [self.source])
+        self.assertEqual(['xubuntu-desktop'], cache.get('xubuntu-artwork'))
+        self.assertIsNone(cache.get('no-such-package'))
+        self.assertEqual((2, 0), (cache.hits, cache.misses))
+
+    def test_overlapping_runs_keep_each_others_entries(self):
+        first = rd.cache.RdependsCache(self.path, [self.source])
+        second = rd.cache.RdependsCache(self.path, [self.source])
+        first.put('xubuntu-artwork', ['xubuntu-desktop'])
+        second.put('lightdm', ['lubuntu-core'])
+        first.save()
+        second.save()
+
+        cache = rd.cache.RdependsCache(self.path, [self.source])
+        self.assertEqual(['xubuntu-desktop'], cache.get('xubuntu-artwork'))
+        self.assertEqual(['lubuntu-core'], cache.get('lightdm'))
+
+    def test_cache_is_invalidated_when_sources_change(self):
+        cache = rd.cache.RdependsCache(self.path, [self.source])
+        cache.put('xubuntu-artwork', ['xubuntu-desktop'])
+        cache.save()
+
+        with open(self.source, 'a') as f:
+            f.write('Status: install ok installed\n')
+
+        cache = rd.cache.RdependsCache(self.path, [self.source])
+        self.assertIs(cache.MISS, cache.get('xubuntu-artwork'))
+
+
+def write_history(directory):
+    '''Writes a tiny /var/log/apt/history.log and a rotated, gzipped
+    history.log.1.gz to directory.'''
+
+    with open(os.path.join(directory, 'history.log'), 'w') as f:
+        f.write("Start-Date: 2014-03-25  09:50:02\n"
+                "Commandline: apt-get install smb4k-foo\n"
+                "Install: smb4k-foo:amd64 (1.0)\n"
+                "End-Date: 2014-03-25  09:50:07\n")
+    f = gzip.open(os.path.join(directory, 'history.log.1.gz'), 'wb')
+    f.write("Start-Date: 2014-03-24  09:50:02\n"
+            "Commandline: apt-get install smb4k\n"
+            "Install: libsmb4k:amd64 (1.0), smb4k:amd64 (1.0.7-1ubuntu1)\n"
+            "End-Date: 2014-03-24  09:50:07\n"
+            "Start-Date: 2014-03-26  09:50:02\n"
+            "Commandline: apt-get purge smb4k\n"
+            "Purge: smb4k:amd64 (1.0.7-1ubuntu1)\n"
+            "End-Date: 2014-03-26  09:50:07\n")
+    f.close()
+
+
+class TestLogScan(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'history*')
+        write_history(self.tmp)
+
+    def test_package_matches_whole_names_only(self):
+        lines = list(rd.logscan.scan('smb4k', self.path))
+        self.assertEqual(4, len(lines))
+        for line in lines:
+            self.assertTrue(line.startswith(self.tmp))
+            self.assertNotIn('smb4k-foo', line)
+
+    def test_scan_stops_early(self):
+        lines = list(rd.logscan.scan('smb4k', self.path,
+                                     stop=rd.logscan.is_install_line))
+        # newest first: the purge, then the installation
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[0].endswith(
+            ':Purge: smb4k:amd64 (1.0.7-1ubuntu1)'))
+        self.assertTrue(lines[-1].endswith(
+            ':Install: libsmb4k:amd64 (1.0), smb4k:amd64 (1.0.7-1ubuntu1)'))
+        self.assertEqual(['smb4k'], list(rd.parser(lines[-1]).keys())[1:])
+
+    def test_nothing_found(self):
+        self.assertEqual([], list(rd.logscan.scan('xubuntu-desktop',
+                                                  self.path)))
+
+    def test_live_log_is_mapped(self):
+        live = os.path.join(self.tmp, 'history.log')
+        with open(live, 'a') as f:
+            f.write("Start-Date: 2014-03-27  09:50:02\n"
+                    "Install: smb4k:amd64 (1.0.8)")
+        self.assertEqual(['%s:Install: smb4k:amd64 (1.0.8)' % live],
+                         rd.logscan.matching_lines(('smb4k', live)))
+        self.assertEqual(['%s:Commandline: apt-get install smb4k-foo' % live,
+                          '%s:Install: smb4k-foo:amd64 (1.0)' % live],
+                         rd.logscan.matching_lines(('smb4k-foo', live)))
+
+        # an empty live log, just rotated:
+        open(live, 'w').close()
+        self.assertEqual([], rd.logscan.matching_lines(('smb4k', live)))
+
+    def test_logs_are_read_newest_first(self):
+        self.assertEqual(['history.log', 'history.log.2.gz',
+                          'history.log.10.gz'],
+                         rd.logscan.newest_first(['history.log.10.gz',
+                                                  'history.log',
+                                                  'history.log.2.gz']))
+
+    def test_pool_gives_the_same_lines(self):
+        for i in range(2, 5):
+            shutil.copy(os.path.join(self.tmp, 'history.log.1.gz'),
+                        os.path.join(self.tmp, 'history.log.%d.gz' % i))
+        lines = list(rd.logscan.scan('smb4k', self.path))
+        self.assertEqual(16, len(lines))
+        self.assertEqual(lines, list(rd.logscan.scan('smb4k', self.path,
+                                                     jobs=3)))
+        self.assertEqual(lines[:3], list(rd.logscan.scan(
+            'smb4k', self.path, stop=rd.logscan.is_install_line, jobs=3)))
+
+
+class TestHistoryIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.logs = os.path.join(self.tmp, 'log')
+        os.mkdir(self.logs)
+        write_history(self.logs)
+        self.path = os.path.join(self.logs, 'history*')
+        self.index_file = os.path.join(self.tmp, 'cache', 'history.json')
+        self.index = rd.logindex.HistoryIndex(self.index_file)
+        self.index.update(self.path)
+
+    def test_lookup_newest_first(self):
+        entries = self.index.lookup('smb4k')
+        self.assertEqual(['Purge', 'Install'], [e['kind'] for e in entries])
+        self.assertEqual('2014-03-24  09:50:02', entries[1]['start_date'])
+
+    def test_lines_are_read_from_offsets(self):
+        lines = list(self.index.lines('smb4k', ('Install',)))
+        self.assertEqual(1, len(lines))
+        self.assertTrue(lines[0].endswith(
+            '.gz:Install: libsmb4k:amd64 (1.0), smb4k:amd64 (1.0.7-1ubuntu1)'))
+        self.assertEqual([], self.index.lookup('smb4k-foo', ('Purge',)))
+
+    def test_pool_builds_the_same_index(self):
+        for i in range(2, 5):
+            shutil.copy(os.path.join(self.logs, 'history.log.1.gz'),
+                        os.path.join(self.logs, 'history.log.%d.gz' % i))
+        index = rd.logindex.HistoryIndex(None).update(self.path)
+        pooled = rd.logindex.HistoryIndex(None).update(self.path, jobs=3)
+        self.assertEqual(8, len(pooled.lookup('smb4k')))
+        self.assertEqual(index.lookup('smb4k'), pooled.lookup('smb4k'))
+        self.assertEqual(index.files, pooled.files)
+
+        # transactions read by the pool are the same too:
+        paths = rd.logscan.newest_first(glob.glob(self.path))
+        self.assertEqual(
+            [repr(t) for t in rd.transactions.read(paths, ['smb4k'])],
+            [repr(t) for t in rd.transactions.read(paths, ['smb4k'], 3)])
+
+    def test_replaced_live_log_is_indexed_again(self):
+        '''The live log was truncated and, before the next run, apt wrote
+        more than was indexed the last time.'''
+        live = os.path.join(self.logs, 'history.log')
+        with open(live, 'r+') as f:
+            f.truncate(0)
+            f.write("Start-Date: 2014-04-01  08:00:00\n"
+                    "Commandline: apt-get install xubuntu-desktop\n"
+                    "Install: xubuntu-desktop:amd64 (2.9), "
+                    "xubuntu-icon-theme:amd64 (0.4, automatic)\n"
+                    "End-Date: 2014-04-01  08:01:00\n")
+        self.index.update(self.path)
+        self.assertEqual([], self.index.lookup('smb4k-foo'))
+        self.assertEqual(['%s:Install: xubuntu-desktop:amd64 (2.9), '
+                          'xubuntu-icon-theme:amd64 (0.4, automatic)' % live],
+                         list(self.index.lines('xubuntu-icon-theme')))
+
+    def test_index_is_saved(self):
+        self.index.save()
+        index = rd.logindex.HistoryIndex(self.index_file)
+        self.assertEqual(self.index.lookup('smb4k'), index.lookup('smb4k'))
+
+    def test_live_log_is_indexed_incrementally(self):
+        with open(os.path.join(self.logs, 'history.log'), 'a') as f:
+            f.write("Start-Date: 2014-03-27  09:50:02\n"
+                    "Install: smb4k:amd64 (1.0.8)\n"
+                    "End-Date: 2014-03-27  09:50:07\n")
+        self.index.update(self.path)
+        entries = self.index.lookup('smb4k')
+        self.assertEqual(['Install', 'Purge', 'Install'],
+                         [e['kind'] for e in entries])
+        self.assertEqual(1, len(self.index.lookup('smb4k-foo')))
+        self.assertEqual(['%s/history.log:Install: smb4k:amd64 (1.0.8)' %
+                          self.logs],
+                         list(self.index.lines('smb4k', ('Install',)))[:1])
+
+    def test_rotated_logs_are_not_read_again(self):
+        os.rename(os.path.join(self.logs, 'history.log.1.gz'),
+                  os.path.join(self.logs, 'history.log.2.gz'))
+        offsets = [e['offset'] for e in self.index.lookup('smb4k')]
+        self.index.update(self.path)
+        entries = self.index.lookup('smb4k')
+        self.assertEqual(offsets, [e['offset'] for e in entries])
+        self.assertTrue(entries[0]['path'].endswith('history.log.2.gz'))
+
+    def test_deleted_logs_are_forgotten(self):
+        os.remove(os.path.join(self.logs, 'history.log.1.gz'))
+        self.index.update(self.path)
+        self.assertEqual([], self.index.lookup('smb4k'))
+
+
+class TestTransactions(unittest.TestCase):
+    def setUp(self):
+        '''xubuntu-desktop was installed, removed with apt-get and installed
+        again; the last time apt installed only the metapackage.'''
+        self.log = StringIO(
+            "Start-Date: 2013-06-01  10:00:00\n"
+            "Commandline: apt-get install xubuntu-desktop\n"
+            "Requested-By: andrei (1000)\n"
+            "Install: xubuntu-desktop:i386 (2.3), "
+            "xfwm4:i386 (4.10.0-1, automatic), thunar:i386 (1.4.0-1, automatic)\n"
+            "End-Date: 2013-06-01  10:05:00\n"
+            "\n"
+            "Start-Date: 2013-06-02  10:00:00\n"
+            "Commandline: apt-get remove xubuntu-desktop thunar\n"
+            "Remove: xubuntu-desktop:i386 (2.3), thunar:i386 (1.4.0-1)\n"
+            "End-Date: 2013-06-02  10:01:00\n"
+            "\n"
+            "Start-Date: 2013-06-03  10:00:00\n"
+            "Commandline: apt-get dist-upgrade\n"
+            "Install: xubuntu-desktop:i386 (2.3), gimp:i386 (2.8)\n"
+            "Upgrade: xfwm4:i386 (4.10.0-1, 4.10.1-1)\n"
+            "End-Date: 2013-06-03  10:30:00\n"
+            "\n"
+            "Start-Date: 2013-06-04  10:00:00\n"
+            "Commandline: apt-get install xubuntu-desktop\n"
+            "Install: xubuntu-desktop:i386 (2.3)\n"
+            "End-Date: 2013-06-04  10:01:00\n")
+        self.found = list(rd.transactions.parse(self.log, 'history.log',
+                                                'xubuntu-desktop'))
+
+    def test_one_record_per_transaction(self):
+        self.assertEqual(4, len(self.found))
+        t = self.found[0]
+        self.assertEqual('2013-06-01  10:00:00', t.start_date)
+        self.assertEqual('2013-06-01  10:05:00', t.end_date)
+        self.assertEqual('apt-get install xubuntu-desktop', t.commandline)
+        self.assertEqual('andrei (1000)', t.requested_by)
+        self.assertEqual({'xfwm4': ('i386', '4.10.0-1, 4.10.1-1')},
+                         self.found[2].upgrade)
+
+    def test_mapped_log_gives_the_same_transactions(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'history.log')
+        with open(path, 'w') as f:
+            # a truncated transaction, then the log, then one apt is still
+            # writing:
+            f.write("Install: xubuntu-desktop:i386 (2.2)\n"
+                    "End-Date: 2013-05-01  10:05:00\n\n")
+            f.write(self.log.getvalue())
+            f.write("\nStart-Date: 2013-06-05  10:00:00\n"
+                    "Remove: xubuntu-desktop:i386 (2.3)\n")
+        for packages in (['xubuntu-desktop'], ['gimp', 'xfwm4'], ['xfwm']):
+            with open(path) as f:
+                expected = [(t.start_date, t.lists) for t in
+                            rd.transactions.parse(f, path, packages)]
+            self.assertEqual(expected,
+                             [(t.start_date, t.lists) for t in
+                              rd.transactions.read_log(path, packages)])
+        self.assertEqual(4, len(list(rd.transactions.read_log(
+            path, ['xubuntu-desktop']))))
+
+    def test_package_lists_are_shaped_like_parser_output(self):
+        line = "Install: lightdm-gtk-greeter:i386 (1.3.1-0ubuntu1), " + \
+               "pidgin-libnotify:i386 (0.14-4ubuntu11, automatic)"
+        self.assertEqual(rd.parser(line),
+                         rd.transactions.parse_packages(line[9:]))
+
+    def test_select_transaction_requested_on_command_line(self):
+        chosen = rd.transactions.select(self.found, 'xubuntu-desktop')
+        self.assertEqual('2013-06-04  10:00:00', chosen.start_date)
+        self.assertEqual('history.log:Install: xubuntu-desktop:i386 (2.3)',
+                         chosen.line())
+        chosen = rd.transactions.select(self.found, 'gimp')
+        self.assertEqual('2013-06-03  10:00:00', chosen.start_date)
+        self.assertIsNone(rd.transactions.select(self.found, 'abiword'))
+
+    def test_install_cycles_are_merged(self):
+        d = rd.transactions.merge(self.found, 'xubuntu-desktop')
+        self.assertEqual(['xubuntu-desktop', 'xfwm4', 'gimp'], list(d.keys()))
+        self.assertEqual(('i386', '4.10.0-1, automatic'), d['xfwm4'])
+        self.assertIsInstance(d, collections.OrderedDict)
+
+
+class TestLocator(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        write_history(self.tmp)
+        with open(os.path.join(self.tmp, 'history.log'), 'a') as f:
+            f.write("Start-Date: 2014-03-28  09:50:02\n"
+                    "Commandline: apt-get install xubuntu-desktop\n"
+                    "Install: xubuntu-desktop:amd64 (2.3), "
+                    "libsmb4k:amd64 (1.0, automatic), "
+                    "thunar:amd64 (1.4.0-1, automatic)\n"
+                    "End-Date: 2014-03-28  09:55:07\n")
+        self.path = os.path.join(self.tmp, 'history*')
+
+        # Locator logs through the module's logger, set up by the script:
+        rd.remove_desktop.logger = logging.getLogger('test')
+        rd.remove_desktop.logger.addHandler(logging.NullHandler())
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        del rd.remove_desktop.logger
+
+    def test_locate_several_metapackages(self):
+        loc = rd.Locator()
+        d = loc.locate(['xubuntu-desktop', 'smb4k'], self.path)
+        self.assertEqual(['xubuntu-desktop', 'libsmb4k', 'thunar', 'smb4k'],
+                         list(d.keys()))
+        self.assertEqual(['xubuntu-desktop', 'smb4k'],
+                         list(loc.main_lines.keys()))
+        self.assertEqual(loc.main_lines['xubuntu-desktop'], loc.main_line)
+
+    def test_locate_with_index(self):
+        index = rd.logindex.HistoryIndex(os.path.join(self.tmp, 'index.json'))
+        index.update(self.path)
+        self.assertEqual(rd.Locator().locate('smb4k', self.path),
+                         rd.Locator().locate('smb4k', self.path, index))
+
+    def test_search_stops_at_the_installation_line(self):
+        read = []
+
+        def lines():
+            for line in ['history.log:Commandline: apt-get install smb4k',
+                         'history.log:Install: smb4k:amd64 (1.0)',
+                         'history.log:Purge: smb4k:amd64 (1.0)']:
+                read.append(line)
+                yield line
+
+        loc = rd.Locator()
+        loc.lines = lambda package, path, index=None: lines()
+        self.assertEqual('history.log:Install: smb4k:amd64 (1.0)',
+                         loc.search('smb4k', self.path))
+        self.assertEqual(2, len(read))
+        # nothing is printed unless asked for:
+        self.assertEqual('', sys.stdout.getvalue())
+
+    def test_search_prints_lines_if_verbose(self):
+        line = rd.Locator().search('smb4k', self.path, verbose=True)
+        self.assertTrue(line.endswith(':Install: libsmb4k:amd64 (1.0), '
+                                      'smb4k:amd64 (1.0.7-1ubuntu1)'))
+        self.assertTrue(sys.stdout.getvalue().endswith(line + '\n'))
+
+        index = rd.logindex.HistoryIndex(os.path.join(self.tmp, 'index.json'))
+        index.update(self.path)
+        self.assertEqual(line, rd.Locator().search('smb4k', self.path, index))
+
+    def test_search_exits_if_not_installed(self):
+        self.assertRaises(SystemExit, rd.Locator().search, 'abiword',
+                          self.path)
+
+
+class TestFleet(unittest.TestCase):
+    def setUp(self):
+        '''Snapshots of three hosts: a flat one, one keeping the original
+        paths and one without a dpkg status file.'''
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        log = ("Start-Date: 2013-06-01  10:00:00\n"
+               "Commandline: apt-get install xubuntu-desktop\n"
+               "Install: xubuntu-desktop:i386 (2.3), "
+               "xubuntu-artwork:i386 (1.0, automatic), "
+               "lightdm-gtk-greeter:i386 (1.3.1, automatic), "
+               "lightdm:i386 (1.4, automatic)\n"
+               "End-Date: 2013-06-01  10:05:00\n")
+        for host, history, status in (
+                ('host1', 'history.log', 'status'),
+                ('host2', 'var/log/apt/history.log', 'var/lib/dpkg/status'),
+                ('host3', 'history.log', None)):
+            history = os.path.join(self.tmp, host, history)
+            os.makedirs(os.path.dirname(history))
+            with open(history, 'w') as f:
+                f.write(log)
+            if status:
+                status = os.path.join(self.tmp, host, status)
+                if not os.path.isdir(os.path.dirname(status)):
+                    os.makedirs(os.path.dirname(status))
+                shutil.copy(STATUS_FILE, status)
+
+    def test_find_snapshot(self):
+        logs, status = rd.fleet.find_snapshot(os.path.join(self.tmp, 'host2'))
+        self.assertEqual([os.path.join(self.tmp,
+                                       'host2/var/log/apt/history.log')], logs)
+        self.assertEqual(os.path.join(self.tmp, 'host2/var/lib/dpkg/status'),
+                         status)
+
+    def test_every_host_is_planned(self):
+        output = StringIO()
+        errors = rd.fleet.analyze(self.tmp, ['xubuntu-desktop', 'smb4k'],
+                                  jobs=2, output=output)
+        self.assertEqual(1, errors)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(['host1', 'host2', 'host3'],
+                         [r['host'] for r in results])
+        for result in results[:2]:
+            self.assertIsNone(result['error'])
+            self.assertEqual(['smb4k'], result['missing'])
+            # xubuntu-default-settings and lubuntu-core still need them:
+            self.assertEqual(['xubuntu-desktop'], result['obsolete'])
+            self.assertEqual(['xubuntu-artwork', 'lightdm-gtk-greeter',
+                              'lightdm'], result['kept'])
+        self.assertIn('status', results[2]['error'])
+
+    def test_command_line_writes_to_stdout(self):
+        script = os.path.join(os.path.dirname(DATA_DIR), '..',
+                              'remove_desktop', 'fleet.py')
+        # code that runs after main(), when the interpreter exits:
+        code = ("import sys, runpy, atexit; "
+                "atexit.register(lambda: sys.stdout.write('done\\n')); "
+                "sys.argv = sys.argv[1:]; "
+                "runpy.run_path(sys.argv[0], run_name='__main__')")
+        process = subprocess.Popen(
+            [sys.executable, '-c', code, script, '-j', '1', self.tmp,
+             'xubuntu-desktop'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=os.path.dirname(script))
+        output, errors = process.communicate()
+        self.assertEqual(1, process.returncode, errors)
+        lines = output.splitlines()
+        self.assertEqual(['host1', 'host2', 'host3'],
+                         [json.loads(line)['host'] for line in lines[:3]])
+        # stdout is still open:
+        self.assertEqual(['done'], lines[3:])
+        self.assertEqual('', errors)
+
+
+class TestPlanDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        with open(os.path.join(self.tmp, 'history.log'), 'w') as f:
+            f.write("Start-Date: 2013-06-01  10:00:00\n"
+                    "Commandline: apt-get install xubuntu-desktop\n"
+                    "Install: xubuntu-desktop:i386 (2.3), "
+                    "xubuntu-icon-theme:i386 (0.1, automatic)\n"
+                    "End-Date: 2013-06-01  10:05:00\n")
+        self.status = os.path.join(self.tmp, 'status')
+        shutil.copy(STATUS_FILE, self.status)
+        self.planner = rd.daemon.Planner(os.path.join(self.tmp, 'history*'),
+                                         self.status)
+
+    def test_graph_is_rebuilt_only_when_status_changes(self):
+        plan = self.planner.plan(['xubuntu-desktop'])
+        # xubuntu-artwork still needs the icon theme:
+        self.assertEqual(['xubuntu-desktop'], plan['obsolete'])
+        self.planner.plan(['xubuntu-desktop'])
+        self.assertEqual(1, self.planner.reloads)
+
+        # xubuntu-artwork was removed:
+        with open(self.status, 'w') as f:
+            f.write(open(STATUS_FILE).read().replace(
+                'Package: xubuntu-artwork\nStatus: install ok installed',
+                'Package: xubuntu-artwork\nStatus: deinstall ok '
+                'config-files'))
+        os.utime(self.status, (0, 0))
+        plan = self.planner.plan(['xubuntu-desktop'])
+        self.assertEqual(2, self.planner.reloads)
+        self.assertEqual(['xubuntu-desktop', 'xubuntu-icon-theme'],
+                         plan['obsolete'])
+
+    def test_query_over_socket(self):
+        path = os.path.join(self.tmp, 'socket')
+        server = rd.daemon.PlanServer(path, self.planner)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        try:
+            answer = rd.daemon.query(['xubuntu-desktop', 'smb4k'], path,
+                                     timeout=10)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertIsNone(answer['error'])
+        self.assertEqual(['smb4k'], answer['missing'])
+        self.assertEqual(['xubuntu-desktop'], answer['obsolete'])
+        self.assertFalse(os.path.exists(path))
+
+    def test_plan_without_daemon(self):
+        script = os.path.join(os.path.dirname(DATA_DIR), '..',
+                              'remove_desktop', 'daemon.py')
+        path = os.path.join(self.tmp, 'socket')
+        process = subprocess.Popen(
+            [sys.executable, script, 'plan', '--socket', path,
+             'xubuntu-desktop'],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(1, process.returncode)
+        self.assertIn("no planner listening on '%s'" % path, output)
+        self.assertNotIn('Traceback', output)
+
+
+class TestBackends(unittest.TestCase):
+    class VirtualBackend(rd.backends.Backend):
+        '''The package system of a virtual testing OS.'''
+
+        name = 'virtual'
+        rdeps = {'xubuntu-artwork': ['xubuntu-desktop',
+                                     'gnome-brave-icon-theme']}
+
+        def is_installed(self, package):
+            return package != 'gnome-brave-icon-theme'
+
+        def rdepends(self, packages):
+            return collections.OrderedDict((p, self.rdeps[p])
+                                           for p in packages
+                                           if p in self.rdeps)
+
+        def purge(self, packages, out, simulate=False):
+            for package in packages:
+                out.write('Purg %s\n' % package)
+            if 'lightdm' in packages:
+                raise rd.backends.PurgeError(100)
+
+    def setUp(self):
+        self.saved = rd.remove_desktop.backend
+        rd.remove_desktop.backend = self.VirtualBackend()
+
+    def tearDown(self):
+        rd.remove_desktop.backend = self.saved
+
+    def test_questions_go_to_the_backend(self):
+        self.assertEqual({'xubuntu-artwork': ['xubuntu-desktop',
+                                              'gnome-brave-icon-theme']},
+                         rd.rdepends(['xubuntu-artwork', 'smb4k']))
+        self.assertFalse(rd.remove_desktop.is_installed(
+            'gnome-brave-icon-theme'))
+        self.assertEqual(
+            (['xubuntu-artwork'], {'xubuntu-artwork': ['xubuntu-desktop']}),
+            rd.remove_desktop.installed_rdepends(['xubuntu-artwork'], {}))
+
+    def test_subprocess_backend_asks_dpkg_query_for_the_exact_name(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        # a dpkg-query that knows the packages of a virtual testing OS:
+        with open(os.path.join(tmp, 'dpkg-query'), 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'echo "$@" >> %s/calls\n'
+                    'case "$4" in\n'
+                    '  libfoo2) echo "install ok installed";;\n'
+                    '  foo-data) echo "deinstall ok config-files";;\n'
+                    '  libc6) echo "install ok installed"; '
+                    'echo "install ok not-installed";;\n'
+                    '  *) echo "dpkg-query: no packages found matching $4" '
+                    '>&2; exit 1;;\n'
+                    'esac\n' % tmp)
+        os.chmod(f.name, 0755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = tmp + os.pathsep + path
+        self.addCleanup(os.environ.__setitem__, 'PATH', path)
+
+        backend = rd.backends.SubprocessBackend()
+        self.assertTrue(backend.is_installed('libfoo2'))
+        # not a substring of libfoo2:
+        self.assertFalse(backend.is_installed('foo'))
+        self.assertFalse(backend.is_installed('foo-data'))
+        # installed for one architecture:
+        self.assertTrue(backend.is_installed('libc6'))
+        # the name is an argument, not a piece of a shell command:
+        self.assertFalse(backend.is_installed("x'; touch %s/owned; '" % tmp))
+        self.assertFalse(os.path.exists(os.path.join(tmp, 'owned')))
+        with open(os.path.join(tmp, 'calls')) as f:
+            # the format ends with a newline:
+            self.assertEqual(['-W -f ${Status}', ' libfoo2'],
+                             f.read().splitlines()[:2])
+
+    def test_interface_is_abstract(self):
+        backend = rd.backends.Backend()
+        self.assertRaises(NotImplementedError, backend.is_installed, 'x')
+        self.assertRaises(NotImplementedError, backend.rdepends, ['x'])
+        self.assertRaises(NotImplementedError, backend.purge, ['x'],
+                          StringIO())
+
+
+class FakeApt(types.ModuleType):
+    '''Stands for python-apt: its cache knows a few packages of a virtual
+    testing OS and notices when two threads use it at once.'''
+
+    class Dependency(object):
+        def __init__(self, name, dep_type):
+            self.parent_pkg = collections.namedtuple('Pkg', 'name')(name)
+            self.dep_type_untranslated = dep_type
+
+    def __init__(self):
+        super(FakeApt, self).__init__('apt')
+        self.opened = 0
+        self.broken = False
+        self.concurrent = False
+        self.busy = threading.Lock()
+        Dependency = self.Dependency
+        self.rev_depends = {
+            'xubuntu-artwork': [Dependency('xubuntu-desktop', 'Depends'),
+                                Dependency('shimmer-themes', 'Recommends'),
+                                Dependency('xubuntu-desktop', 'Suggests'),
+                                Dependency('xubuntu-default', 'Replaces'),
+                                Dependency('lubuntu-artwork', 'Conflicts')],
+            'smb4k': []}
+        self.installed = set(['xubuntu-artwork', 'xubuntu-desktop'])
+
+    def Cache(self):
+        self.opened += 1
+        # reading the package lists takes a while:
+        time.sleep(0.01)
+        if self.broken:
+            raise SystemError('E:The package lists or status file could '
+                              'not be parsed or opened.')
+        return FakeApt._Cache(self)
+
+    class _Cache(object):
+        def __init__(self, apt):
+            self.apt = apt
+            self._cache = self
+
+        def __getitem__(self, name):
+            if not self.apt.busy.acquire(False):
+                self.apt.concurrent = True
+                self.apt.busy.acquire()
+            try:
+                # long enough for another thread to come in:
+                time.sleep(0.001)
+                if name not in self.apt.rev_depends and \
+                        name not in self.apt.installed:
+                    raise KeyError(name)
+                return collections.namedtuple(
+                    'Package', 'is_installed rev_depends_list')(
+                    name in self.apt.installed,
+                    self.apt.rev_depends.get(name, []))
+            finally:
+                self.apt.busy.release()
+
+
+class TestAptBackend(unittest.TestCase):
+    def setUp(self):
+        self.apt = FakeApt()
+        self.saved = sys.modules.get('apt')
+        sys.modules['apt'] = self.apt
+        self.addCleanup(self.restore)
+
+    def restore(self):
+        if self.saved is None:
+            del sys.modules['apt']
+        else:
+            sys.modules['apt'] = self.saved
+
+    def test_default_is_the_apt_backend_with_python_apt(self):
+        backend = rd.backends.default()
+        self.assertIsInstance(backend, rd.backends.AptBackend)
+        # runs that read dpkg's status file never ask the backend, the
+        # package lists are read only when needed:
+        self.assertEqual(0, self.apt.opened)
+        backend.is_installed('smb4k')
+        backend.rdepends(['smb4k'])
+        self.assertEqual(1, self.apt.opened)
+
+    def test_default_is_the_subprocess_backend_without_python_apt(self):
+        # makes `import apt` raise ImportError:
+        sys.modules['apt'] = None
+        backend = rd.backends.default()
+        self.assertIsInstance(backend, rd.backends.SubprocessBackend)
+        self.assertNotIsInstance(backend, rd.backends.AptBackend)
+
+    def test_questions_are_asked_to_the_cache(self):
+        backend = rd.backends.AptBackend()
+        self.assertTrue(backend.is_installed('xubuntu-artwork'))
+        self.assertFalse(backend.is_installed('smb4k'))
+        self.assertFalse(backend.is_installed('unknown-package'))
+        # the relations apt-cache rdepends shows, once per package, and
+        # nothing for unknown packages:
+        self.assertEqual(
+            collections.OrderedDict([
+                ('smb4k', []),
+                ('xubuntu-artwork', ['xubuntu-desktop', 'shimmer-themes',
+                                     'xubuntu-default', 'lubuntu-artwork'])]),
+            backend.rdepends(['smb4k', 'unknown-package', 'xubuntu-artwork']))
+
+    def test_threads_use_the_cache_one_at_a_time(self):
+        backend = rd.backends.AptBackend()
+        saved = rd.remove_desktop.backend
+        rd.remove_desktop.backend = backend
+        self.addCleanup(setattr, rd.remove_desktop, 'backend', saved)
+        packages = ['xubuntu-artwork', 'smb4k'] * 20
+        graph = rd.remove_desktop.apt_cache_graph(packages, jobs=4)
+        self.assertFalse(self.apt.concurrent)
+        self.assertEqual(1, self.apt.opened)
+        self.assertEqual(['xubuntu-desktop'],
+                         list(graph.rdepends('xubuntu-artwork')))
+
+    def test_broken_cache_falls_back_to_subprocesses(self):
+        self.apt.broken = True
+        asked = []
+        subprocess_backend = rd.backends.SubprocessBackend
+        for name in ('is_installed', 'rdepends'):
+            self.addCleanup(setattr, subprocess_backend, name,
+                            subprocess_backend.__dict__[name])
+        subprocess_backend.is_installed = \
+            lambda backend, package: asked.append(package) or True
+        subprocess_backend.rdepends = \
+            lambda backend, packages: asked.append(packages) or {}
+
+        backend = rd.backends.AptBackend()
+        self.assertTrue(backend.is_installed('smb4k'))
+        self.assertEqual({}, backend.rdepends(['xubuntu-artwork']))
+        self.assertEqual(['smb4k', ['xubuntu-artwork']], asked)
+        # the cache isn't opened again for every question:
+        self.assertEqual(1, self.apt.opened)
+
+    def test_packages_are_purged_by_apt_get(self):
+        self.assertTrue(issubclass(rd.backends.AptBackend,
+                                   rd.backends.SubprocessBackend))
+        self.assertEqual(rd.backends.SubprocessBackend.purge,
+                         rd.backends.AptBackend.purge)
+
+
+class TestRecordReplay(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.archive = os.path.join(self.tmp, 'run.json.gz')
+
+        recorder = rd.backends.RecordingBackend(
+            TestBackends.VirtualBackend())
+        self.rdepends = recorder.rdepends(['xubuntu-artwork', 'smb4k'])
+        recorder.is_installed('gnome-brave-icon-theme')
+        self.output = StringIO()
+        recorder.purge(['xubuntu-desktop'], self.output, simulate=True)
+        self.assertRaises(rd.backends.PurgeError, recorder.purge,
+                          ['lightdm'], StringIO())
+        recorder.save(self.archive)
+        self.replay = rd.backends.ReplayBackend(self.archive)
+
+    def test_answers_are_replayed(self):
+        self.assertEqual(self.rdepends,
+                         self.replay.rdepends(['xubuntu-artwork', 'smb4k']))
+        # in other chunks than they were recorded:
+        self.assertEqual({}, self.replay.rdepends(['smb4k']))
+        self.assertFalse(self.replay.is_installed('gnome-brave-icon-theme'))
+
+        output = StringIO()
+        self.replay.purge(['xubuntu-desktop'], output, simulate=True)
+        self.assertEqual(self.output.getvalue(), output.getvalue())
+        with self.assertRaises(rd.backends.PurgeError) as raised:
+            self.replay.purge(['lightdm'], StringIO())
+        self.assertEqual(100, raised.exception.exit_code)
+
+    def test_questions_not_recorded(self):
+        self.assertRaises(rd.backends.NotRecorded, self.replay.rdepends,
+                          ['lightdm'])
+        self.assertRaises(rd.backends.NotRecorded, self.replay.is_installed,
+                          'lightdm')
+        # not simulated when it was recorded:
+        self.assertRaises(rd.backends.NotRecorded, self.replay.purge,
+                          ['xubuntu-desktop'], StringIO())
+
+    def test_archive_is_gzipped_json(self):
+        archive = json.load(gzip.open(self.archive))
+        self.assertEqual(rd.backends.ARCHIVE_VERSION, archive['version'])
+        self.assertEqual({'xubuntu-artwork': ['xubuntu-desktop',
+                                              'gnome-brave-icon-theme'],
+                          'smb4k': None}, archive['rdepends'])
+
+
+class TestReplayedRun(unittest.TestCase):
+    '''Records a run on the files of a virtual machine and replays it.'''
+
+    SCRIPT = os.path.join(os.path.dirname(DATA_DIR), '..', 'remove_desktop',
+                          'remove_desktop.py')
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.archive = os.path.join(self.tmp, 'run.json.gz')
+        logs = os.path.join(self.tmp, 'apt')
+        os.mkdir(logs)
+        with open(os.path.join(logs, 'history.log'), 'w') as f:
+            f.write("\nStart-Date: 2014-02-01  10:00:00\n"
+                    "Commandline: apt-get install smb4k\n"
+                    "Install: smb4k:i386 (1.0)\n"
+                    "End-Date: 2014-02-01  10:05:00\n"
+                    "\nStart-Date: 2014-03-01  10:00:00\n"
+                    "Commandline: apt-get upgrade\n"
+                    "Requested-By: andrei (1000)\n"
+                    "Upgrade: xubuntu-icon-theme:i386 (0.1, 0.2)\n"
+                    "End-Date: 2014-03-01  10:05:00\n")
+        f = gzip.open(os.path.join(logs, 'history.log.1.gz'), 'wb')
+        f.write("\nStart-Date: 2013-06-01  10:00:00\n"
+                "Commandline: apt-get install xubuntu-desktop\n"
+                "Install: xubuntu-desktop:i386 (2.3), "
+                "xubuntu-icon-theme:i386 (0.1, automatic)\n"
+                "End-Date: 2013-06-01  10:05:00\n")
+        f.close()
+        self.paths = glob.glob(os.path.join(logs, '*'))
+
+    def record(self, purges=True):
+        '''Records what a run removing xubuntu-desktop reads and asks.'''
+
+        recorder = rd.backends.RecordingBackend(
+            TestBackends.VirtualBackend())
+        recorder.record_status(STATUS_FILE)
+        self.found = list(rd.transactions.read(self.paths,
+                                               ['xubuntu-desktop']))
+        recorder.record_logs(self.found)
+        if purges:
+            recorder.purge(['xubuntu-desktop'], StringIO(), simulate=True)
+        recorder.save(self.archive)
+
+    def replay(self):
+        '''Returns (exit code, output) of the script run with --replay, in
+        a directory without config file.'''
+
+        run_dir = os.path.join(self.tmp, 'run')
+        os.mkdir(run_dir)
+        process = subprocess.Popen(
+            [sys.executable, self.SCRIPT, '--test', '--replay', self.archive,
+             'xubuntu-desktop'],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=run_dir)
+        output = process.communicate()[0]
+        return process.returncode, output
+
+    def test_status_file_and_logs_are_restored(self):
+        self.record()
+        replay = rd.backends.ReplayBackend(self.archive)
+        restored = os.path.join(self.tmp, 'restored')
+        os.mkdir(restored)
+        status_file, path = replay.restore(restored)
+
+        self.assertEqual(open(STATUS_FILE).read(), open(status_file).read())
+        # only the transactions that were read, in files of the same names:
+        self.assertEqual(['history.log.1.gz'],
+                         [os.path.basename(p) for p in glob.glob(path)])
+        found = list(rd.transactions.read(glob.glob(path),
+                                          ['xubuntu-desktop']))
+        self.assertEqual([t.text() for t in self.found],
+                         [t.text() for t in found])
+        self.assertEqual(self.found[0].install, found[0].install)
+
+    def test_transaction_text_is_read_back(self):
+        found = list(rd.transactions.read(self.paths))
+        with open(os.path.join(self.tmp, 'copy.log'), 'w') as f:
+            f.write(''.join(t.text() for t in found))
+        copy = list(rd.transactions.read([f.name]))
+        self.assertEqual(3, len(copy))
+        for original, read in zip(found, copy):
+            self.assertEqual(
+                (original.start_date, original.end_date,
+                 original.commandline, original.requested_by,
+                 original.lists),
+                (read.start_date, read.end_date, read.commandline,
+                 read.requested_by, read.lists))
+
+    def test_run_is_replayed(self):
+        self.record()
+        code, output = self.replay()
+        self.assertEqual(0, code, output)
+        self.assertIn('Purg xubuntu-desktop', output)
+        # the index and cache of the replay are thrown away with it:
+        self.assertEqual(['out.log'], os.listdir(os.path.join(self.tmp,
+                                                              'run')))
+
+    def test_question_not_recorded_stops_the_run(self):
+        self.record(purges=False)
+        code, output = self.replay()
+        self.assertEqual(1, code, output)
+        self.assertIn("wasn't asked purge about ['xubuntu-desktop']", output)
+        self.assertNotIn('Traceback', output)
+
+
+class TestPlans(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.log = os.path.join(self.tmp, 'history.log')
+        with open(self.log, 'w') as f:
+            f.write("Start-Date: 2013-06-01  10:00:00\n"
+                    "Commandline: apt-get install xubuntu-desktop\n"
+                    "Install: xubuntu-desktop:i386 (2.3), "
+                    "xubuntu-icon-theme:i386 (0.1, automatic)\n"
+                    "End-Date: 2013-06-01  10:05:00\n")
+        self.status = os.path.join(self.tmp, 'status')
+        shutil.copy(STATUS_FILE, self.status)
+        self.metapackages = ['xubuntu-desktop']
+
+        found = list(rd.transactions.read([self.log], self.metapackages))
+        d, chosen = rd.transactions.locate(found, self.metapackages)
+        graph = rd.DependencyGraph.from_status(self.status)
+        obsolete = rd.classify(d.keys(), graph)
+        self.plan = rd.plans.build(self.metapackages, d, obsolete, graph,
+                                   self.status)
+
+    def index(self):
+        return rd.logindex.HistoryIndex(None).update(
+            os.path.join(self.tmp, 'history*'))
+
+    def test_plan_holds_what_was_decided_and_why(self):
+        self.assertEqual(['xubuntu-desktop'], self.plan['obsolete'])
+        self.assertEqual(['xubuntu-icon-theme'], self.plan['kept'])
+        self.assertEqual({'xubuntu-icon-theme': ['xubuntu-artwork']},
+                         self.plan['reasons'])
+
+    def test_plan_matches_an_identical_machine(self):
+        path = os.path.join(self.tmp, 'plan.json')
+        rd.plans.save(path, self.plan)
+        # another machine, with its logs rotated:
+        os.rename(self.log, self.log + '.1')
+        plan = rd.plans.load(path)
+        self.assertEqual(self.plan, plan)
+        self.assertTrue(rd.plans.matches(plan, self.metapackages,
+                                         self.status, self.index()))
+
+    def test_plan_file_is_shared(self):
+        share = os.path.join(self.tmp, 'share')
+        path = os.path.join(share, 'plan.json')
+        rd.plans.save(path, self.plan)
+        os.remove(path + '.lock')
+        # readable by the other hosts and users:
+        self.assertEqual(0644, os.stat(path).st_mode & 0777)
+        # read without a lock file, which a read-only share can't hold:
+        self.assertEqual(self.plan, rd.plans.load(path))
+        self.assertEqual(['plan.json'], os.listdir(share))
+        self.assertIsNone(rd.plans.load(os.path.join(share, 'missing')))
+
+    def test_plan_that_cannot_be_saved_raises(self):
+        # a file where the directory should be:
+        path = os.path.join(self.status, 'plan.json')
+        self.assertRaises((IOError, OSError), rd.plans.save, path, self.plan)
+
+    def test_plan_does_not_match_another_status(self):
+        with open(self.status, 'a') as f:
+            f.write('\nPackage: smb4k\nStatus: install ok installed\n')
+        self.assertFalse(rd.plans.matches(self.plan, self.metapackages,
+                                          self.status, self.index()))
+
+    def test_plan_does_not_match_another_transaction(self):
+        with open(self.log, 'w') as f:
+            f.write("Start-Date: 2013-06-01  10:00:00\n"
+                    "Commandline: apt-get install xubuntu-desktop\n"
+                    "Install: xubuntu-desktop:i386 (2.3)\n"
+                    "End-Date: 2013-06-01  10:05:00\n")
+        self.assertFalse(rd.plans.matches(self.plan, self.metapackages,
+                                          self.status, self.index()))
+
+    def test_plan_does_not_match_after_a_reinstall(self):
+        # the planned transaction is still in the logs, but a newer one
+        # installed xubuntu-desktop again:
+        with open(self.log + '.1', 'w') as f:
+            f.write(open(self.log).read())
+        with open(self.log, 'w') as f:
+            f.write("Start-Date: 2014-02-01  10:00:00\n"
+                    "Commandline: apt-get install xubuntu-desktop\n"
+                    "Install: xubuntu-desktop:i386 (2.4)\n"
+                    "End-Date: 2014-02-01  10:05:00\n")
+        self.assertFalse(rd.plans.matches(self.plan, self.metapackages,
+                                          self.status, self.index()))
+
+    def test_plan_does_not_match_another_history(self):
+        # the same newest installation, but an earlier install cycle
+        # brought smb4k too, and it was never removed:
+        with open(self.log + '.1', 'w') as f:
+            f.write("Start-Date: 2012-01-01  10:00:00\n"
+                    "Commandline: apt-get install xubuntu-desktop\n"
+                    "Install: xubuntu-desktop:i386 (2.1), "
+                    "smb4k:i386 (1.0, automatic)\n"
+                    "End-Date: 2012-01-01  10:05:00\n"
+                    "Start-Date: 2012-05-01  10:00:00\n"
+                    "Commandline: apt-get purge xubuntu-desktop\n"
+                    "Purge: xubuntu-desktop:i386 (2.1)\n"
+                    "End-Date: 2012-05-01  10:05:00\n")
+        self.assertFalse(rd.plans.matches(self.plan, self.metapackages,
+                                          self.status, self.index()))
+        # purged with xubuntu-desktop, the plan holds again:
+        with open(self.log + '.1', 'w') as f:
+            f.write("Start-Date: 2012-01-01  10:00:00\n"
+                    "Commandline: apt-get install xubuntu-desktop\n"
+                    "Install: xubuntu-desktop:i386 (2.1), "
+                    "smb4k:i386 (1.0, automatic)\n"
+                    "End-Date: 2012-01-01  10:05:00\n"
+                    "Start-Date: 2012-05-01  10:00:00\n"
+                    "Commandline: apt-get purge xubuntu-desktop smb4k\n"
+                    "Purge: xubuntu-desktop:i386 (2.1), smb4k:i386 (1.0)\n"
+                    "End-Date: 2012-05-01  10:05:00\n")
+        self.assertTrue(rd.plans.matches(self.plan, self.metapackages,
+                                         self.status, self.index()))
+
+    def test_plan_does_not_match_other_metapackages(self):
+        self.assertFalse(rd.plans.matches(self.plan, ['lubuntu-desktop'],
+                                          self.status, self.index()))
+        self.assertFalse(rd.plans.matches(None, self.metapackages,
+                                          self.status, self.index()))
+
+    def test_edited_plan_does_not_match(self):
+        self.plan['status'] = rd.plans.file_digest(self.status)[::-1]
+        self.assertFalse(rd.plans.matches(self.plan, self.metapackages,
+                                          self.status, self.index()))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = rd.metrics.Metrics()
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(50, rd.metrics.percentile(values, 50))
+        self.assertEqual(99, rd.metrics.percentile(values, 99))
+        self.assertEqual(7, rd.metrics.percentile([7], 90))
+        self.assertIsNone(rd.metrics.percentile([], 50))
+
+    def test_phases_and_subprocesses_add_up(self):
+        for i in range(2):
+            with self.metrics.phase('locate'):
+                with self.metrics.subprocess():
+                    pass
+        with self.metrics.phase('classify'):
+            pass
+        self.assertEqual(['locate', 'classify'], list(self.metrics.phases))
+        self.assertEqual(2, self.metrics.subprocesses)
+        self.assertGreaterEqual(self.metrics.phases['locate'],
+                                self.metrics.subprocess_seconds)
+
+    def test_summary_and_json(self):
+        with self.metrics.phase('worker'):
+            pass
+        for i in range(10):
+            self.metrics.sample('package latency', i / 100.0)
+        self.assertIn('package latency (10)', self.metrics.summary())
+        self.assertIn('peak RSS', self.metrics.summary())
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.metrics.save(os.path.join(tmp, 'metrics.json'))
+        with open(os.path.join(tmp, 'metrics.json')) as f:
+            data = json.load(f)
+        stats = data['samples']['package latency']
+        self.assertEqual((0.08, 0.09), (stats['p90'], stats['max']))
+        self.assertIn('worker', data['phases'])
+        self.assertGreater(data['peak_rss_kb']['self'], 0)
+
+
+class TestConfigValidate(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        write_history(self.tmp)
+        self.defaults = dict(rd.defaults)
+        self.logger = logging.getLogger('test.config')
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.propagate = False
+
+    def test_values_are_normalized(self):
+        config, errors = rd.utils.config_errors(
+            self.defaults, {'log_level': 'info',
+                            'path': os.path.join(self.tmp, 'history*')})
+        self.assertEqual([], errors)
+        self.assertEqual('INFO', config['log_level'])
+        # paths are case sensitive:
+        self.assertEqual(os.path.join(self.tmp, 'history*'), config['path'])
+
+    def test_wrong_values_and_options(self):
+        config, errors = rd.utils.config_errors(
+            self.defaults, {'log_level': 'verbose', 'colour': 'yes',
+                            'path': os.path.join(self.tmp, 'nothing*')})
+        self.assertEqual(3, len(errors))
+        self.assertNotIn('colour', config)
+
+    def test_read_config(self):
+        conf_file = os.path.join(self.tmp, 'main.conf')
+        with open(conf_file, 'w') as f:
+            f.write("[LOG]\nlog_level = info\npath = %s\n" %
+                    os.path.join(self.tmp, 'history*'))
+        conf = rd.utils.read_config(self.logger, conf_file, self.defaults)
+        self.assertEqual('INFO', conf['log_level'])
+        self.assertEqual(rd.defaults['status_file'], conf['status_file'])
+
+        with open(conf_file, 'w') as f:
+            f.write("[LOG]\nlog_level = verbose\n")
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertRaises(SystemExit, rd.utils.read_config, self.logger,
+                              conf_file, self.defaults)
+        finally:
+            sys.stdout = stdout
+
+
+class TestStartup(unittest.TestCase):
+    def test_heavy_modules_are_not_imported(self):
+        '''sh, colorlog and docopt are imported only when needed.'''
+        code = ("import sys, remove_desktop; "
+                "print(' '.join(m for m in ('sh', 'colorlog', 'docopt', "
+                "'unittest') if m in sys.modules))")
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.join(os.path.dirname(DATA_DIR), '..'))
+        self.assertEqual('', output.strip())
+
+
+class TestQueueLogging(unittest.TestCase):
+    def setUp(self):
+        self.queue = Queue.Queue()
+        self.console = StringIO()
+        self.log_file = StringIO()
+        handler = logging.StreamHandler(self.log_file)
+        handler.setFormatter(rd.utils.ColumnFormatter(
+            '%(func_column)s %(level_column)s %(message)s'))
+        self.listener = rd.utils.QueueListener(self.queue, [handler],
+                                               [self.console, self.log_file])
+        self.logger = logging.getLogger('test.queue')
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        self.logger.addHandler(rd.utils.QueueHandler(self.queue))
+        self.addCleanup(self.logger.handlers.pop)
+
+    def test_records_and_text_keep_their_order(self):
+        writer = rd.utils.QueueWriter(self.queue)
+        self.listener.start()
+        self.logger.debug('These are: %s packages', 2)
+        writer.write('smb4k libsmb4k\n')
+        try:
+            raise ValueError('bad')
+        except ValueError:
+            self.logger.exception('failed')
+        self.listener.stop()
+
+        lines = self.log_file.getvalue().splitlines()
+        self.assertEqual('test_records_and_text_keep_their_order: DEBUG    '
+                         'These are: 2 packages', lines[0])
+        self.assertEqual('smb4k libsmb4k', lines[1])
+        self.assertTrue(lines[2].startswith('test_records_and_text_keep_'
+                                            'their_order: ERROR    failed'))
+        self.assertEqual('ValueError: bad', lines[-1])
+        self.assertEqual('smb4k libsmb4k\n', self.console.getvalue())
+
+    def test_stream_handler_is_not_patched(self):
+        self.assertEqual('logging',
+                         logging.StreamHandler.__dict__['emit'].__module__)
+
+
+class CountingStream(StringIO):
+    '''A StringIO that counts its writes and flushes.'''
+
+    def __init__(self):
+        StringIO.__init__(self)
+        self.writes = self.flushes = 0
+
+    def write(self, data):
+        self.writes += 1
+        StringIO.write(self, data)
+
+    def flush(self):
+        self.flushes += 1
+
+
+class TestStreamSink(unittest.TestCase):
+    def setUp(self):
+        self.stream = CountingStream()
+
+    def test_chunks_are_written_in_blocks(self):
+        sink = rd.utils.StreamSink(self.stream, block_size=100, interval=60)
+        for i in range(50):
+            sink.write('0123456789')
+            # sh flushes after every write:
+            sink.flush()
+        self.assertEqual(5, self.stream.writes)
+        sink.write('tail')
+        sink.close()
+        self.assertEqual(6, self.stream.writes)
+        self.assertEqual('0123456789' * 50 + 'tail', self.stream.getvalue())
+
+    def test_tail_is_bounded(self):
+        sink = rd.utils.StreamSink(self.stream, tail_size=25)
+        for i in range(1000):
+            sink.write('line %04d\n' % i)
+        sink.close()
+        self.assertEqual('0997\nline 0998\nline 0999\n', sink.tail())
+        self.assertLessEqual(len(sink._tail), 4)
+
+    def test_quiet_output_is_flushed_by_the_timer(self):
+        with rd.utils.StreamSink(self.stream, interval=0.01) as sink:
+            sink.write('Reading package lists...')
+            for i in range(200):
+                if self.stream.getvalue():
+                    break
+                time.sleep(0.01)
+            self.assertEqual('Reading package lists...',
+                             self.stream.getvalue())
+
+
+class TestProgressBar(unittest.TestCase):
+    def test_bar_is_filled(self):
+        stream = StringIO()
+        progress = rd.utils.ProgressBar(5, stream=stream)
+        for i in range(4):
+            progress.advance()
+        self.assertEqual(16, stream.getvalue().count('.'))
+        progress.done()
+        self.assertEqual(20, stream.getvalue().count('.'))
+        self.assertTrue(stream.getvalue().endswith('] Done!\n\n'))
+
+
 # run all tests:
 if __name__ == '__main__':
     print("Running tests...")
-    ### load and run tests from other files ###
-    loader = unittest.defaultTestLoader
-    suite = loader.loadTestsFromName('utils.TestConfigValidate')
-    #print(suite.countTestCases())
-    runner = unittest.TextTestRunner(verbosity=1)
-    runner.run(suite)
-
-    ### run tests from this file ###
     unittest.main()
     print("Done!")